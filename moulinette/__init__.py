@@ -78,6 +78,25 @@ def api(
     actionsmap=None,
     locales_dir=None,
     allowed_cors_origins=[],
+    async_workers=1,
+    max_jobs=100,
+    upload_max_size=None,
+    session_cache_size=1024,
+    workers=1,
+    preload=[],
+    admission=None,
+    metrics=False,
+    server_timing=False,
+    cors_max_age=600,
+    reload_interval=None,
+    single_flight=False,
+    unix_socket=None,
+    unix_socket_mode=0o660,
+    access_log=None,
+    diagnostics=False,
+    max_blocking_time=None,
+    idempotency_keys=1024,
+    idempotency_ttl=24 * 3600,
 ):
     """Web server (API) interface
 
@@ -88,6 +107,45 @@ def api(
         - port -- Server port to bind to
         - routes -- A dict of additional routes to add in the form of
             {(method, uri): callback}
+        - async_workers -- The number of actions which can be processed
+            concurrently in background, 0 to disable background jobs
+        - max_jobs -- The maximum number of background jobs to keep track of
+        - upload_max_size -- The maximum size in bytes of the files uploaded
+            with a request, or None for no limit
+        - session_cache_size -- The maximum number of verified sessions to
+            cache for the authenticators which allow it
+        - admission -- A dict of limits on the number of actions processed
+            concurrently, or None for no limit
+        - metrics -- Whether to serve metrics in the Prometheus format on
+            '/metrics'
+        - server_timing -- Whether to report the duration of the phases of
+            each request in a Server-Timing header
+        - cors_max_age -- The time period in seconds during which browsers
+            may cache the result of a CORS preflight request
+        - reload_interval -- The interval in seconds at which the actions
+            map file is checked for changes to reload it, or None to never
+            reload it
+        - single_flight -- Whether identical lock-free GET requests made
+            concurrently are processed once
+        - workers -- The number of worker processes serving the API
+        - preload -- A list of modules to import before forking the worker
+            processes
+        - unix_socket -- The path of a Unix domain socket to listen on
+            instead of the host and port
+        - unix_socket_mode -- The permissions of the Unix domain socket
+        - access_log -- The path of a file to record each request in, in
+            the JSON Lines format
+        - diagnostics -- Whether to serve on '/diagnostics' - and log on
+            SIGUSR1 - a report of what the server processes are busy with
+        - max_blocking_time -- The time in seconds after which a report is
+            logged when the gevent hub is blocked, or None
+        - idempotency_keys -- The maximum number of 'Idempotency-Key'
+            headers whose response is stored, 0 to disable them
+        - idempotency_ttl -- The time period in seconds during which the
+            response to a request with an 'Idempotency-Key' is stored
+
+    The socket passed by systemd with socket activation is listened on
+    if any, rather than the host and port or the Unix domain socket.
 
     """
     from moulinette.interfaces.api import Interface as Api
@@ -99,7 +157,29 @@ def api(
             routes=routes,
             actionsmap=actionsmap,
             allowed_cors_origins=allowed_cors_origins,
-        ).run(host, port)
+            async_workers=async_workers,
+            max_jobs=max_jobs,
+            upload_max_size=upload_max_size,
+            session_cache_size=session_cache_size,
+            admission=admission,
+            metrics=metrics,
+            server_timing=server_timing,
+            cors_max_age=cors_max_age,
+            reload_interval=reload_interval,
+            single_flight=single_flight,
+            access_log=access_log,
+            diagnostics=diagnostics,
+            max_blocking_time=max_blocking_time,
+            idempotency_keys=idempotency_keys,
+            idempotency_ttl=idempotency_ttl,
+        ).run(
+            host,
+            port,
+            workers=workers,
+            preload=preload,
+            unix_socket=unix_socket,
+            unix_socket_mode=unix_socket_mode,
+        )
     except MoulinetteError as e:
         import logging
 
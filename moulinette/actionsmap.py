@@ -22,11 +22,16 @@ import os
 import re
 import logging
 import glob
+import contextvars
+import inspect
+import multiprocessing
 import pickle as pickle
 
 from typing import List, Optional
 from time import time
 from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from importlib import import_module
 from functools import cache
 
@@ -342,6 +347,18 @@ class ExtraArgumentParser:
         except KeyError:
             self._extra_params[tid] = OrderedDict({arg_name: parameters})
 
+    def get_parameters(self, tid):
+        """
+        Return the extra parameters of the arguments of an action
+
+        Keyword arguments:
+            - tid -- The tuple identifier of the action
+
+        """
+        extra_args = OrderedDict(self._extra_params.get("_global", {}))
+        extra_args.update(self._extra_params.get(tid, {}))
+        return extra_args
+
     def parse_args(self, tid, args):
         """
         Parse arguments for an action with extra parameters
@@ -351,8 +368,7 @@ class ExtraArgumentParser:
             - args -- A dict of argument name associated to their value
 
         """
-        extra_args = OrderedDict(self._extra_params.get("_global", {}))
-        extra_args.update(self._extra_params.get(tid, {}))
+        extra_args = self.get_parameters(tid)
 
         # Iterate over action arguments with extra parameters
         for arg_name, extra_params in extra_args.items():
@@ -382,6 +398,116 @@ class ExtraArgumentParser:
         return args
 
 
+# Action executors ----------------------------------------------------
+
+
+def _call_in_process(module_name, func_name, arguments, locale=None):
+    """Import and call an action function from a worker process"""
+    m18n.use_locale(locale)
+    func = getattr(import_module(module_name), func_name)
+    ret = func(**arguments)
+    # Generators can't be sent back to the parent process
+    if isinstance(ret, Iterator):
+        ret = list(ret)
+    return ret
+
+
+def system_thread_pool(max_workers):
+    """Return a pool of system threads, even once gevent has patched them"""
+    pool_class = ThreadPoolExecutor
+    try:
+        from gevent import monkey
+    except ImportError:
+        pass
+    else:
+        if monkey.is_module_patched("threading"):
+            from gevent.threadpool import ThreadPoolExecutor as pool_class
+    return pool_class(max_workers=max_workers)
+
+
+class ActionExecutor:
+    """
+    Run the action functions in the executor they have been declared with.
+
+    Actions can set 'executor' in the actions map to one of:
+        - inline -- the default, the function is called in the current
+            thread - or greenlet, hence 'gevent' is an alias of it
+        - thread -- the function is called in a pool of system threads
+        - process -- the function is called in a pool of pre-forked
+            processes, its arguments and result must be picklable
+
+    Once gevent has patched the standard library, the thread pool is made
+    of real system threads so that a blocking call doesn't freeze the hub.
+    Pool sizes can be set with the 'executors' global parameter, e.g.
+    'executors: {thread: 4, process: 2}'.
+
+    Keyword arguments:
+        - thread -- The number of threads of the thread pool
+        - process -- The number of processes of the process pool
+
+    """
+
+    types = ["inline", "gevent", "thread", "process"]
+
+    def __init__(self, thread=4, process=2):
+        self.thread_workers = thread
+        self.process_workers = process
+
+        self.declared = set()  # set(executor) used by actions
+        self._thread_pool = None
+        self._process_pool = None
+
+    def start(self):
+        """Fork the processes of the process pool now rather than on first use"""
+        if "process" in self.declared and self._process_pool is None:
+            self.process_pool().submit(os.getpid).result()
+
+    def thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = system_thread_pool(self.thread_workers)
+        return self._thread_pool
+
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.process_workers,
+                mp_context=multiprocessing.get_context("fork"),
+            )
+        return self._process_pool
+
+    def run(self, executor, module_name, func_name, func, arguments):
+        """
+        Call an action function in the given executor and return its result
+
+        Exceptions raised by the function are raised back as is.
+
+        Keyword arguments:
+            - executor -- The executor type, one of ActionExecutor.types
+            - module_name -- The name of the module of the function
+            - func_name -- The name of the function
+            - func -- The function itself
+            - arguments -- A dict of arguments to call the function with
+
+        """
+        if executor == "thread":
+            # Run in a copy of the current context to keep context variables
+            context = contextvars.copy_context()
+            future = self.thread_pool().submit(context.run, func, **arguments)
+            return future.result()
+        elif executor == "process":
+            future = self.process_pool().submit(
+                _call_in_process, module_name, func_name, arguments, m18n.locale
+            )
+            return future.result()
+        return func(**arguments)
+
+    def shutdown(self, wait=False):
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=wait)
+        self._thread_pool = self._process_pool = None
+
+
 # Main class ----------------------------------------------------------
 
 
@@ -408,12 +534,18 @@ class ActionsMap:
         )
 
         self.from_cache = False
+        # The files the actions map is loaded from
+        self.files = [actionsmap_yml]
 
         actionsmap_yml_dir = os.path.dirname(actionsmap_yml)
         actionsmap_yml_file = os.path.basename(actionsmap_yml)
         actionsmap_yml_stat = os.stat(actionsmap_yml)
 
-        actionsmap_pkl = f"{actionsmap_yml_dir}/.{actionsmap_yml_file}.{actionsmap_yml_stat.st_size}-{actionsmap_yml_stat.st_mtime}.pkl"
+        # The version of the actions map, which identifies its cache
+        self.version = f"{actionsmap_yml_stat.st_size}-{actionsmap_yml_stat.st_mtime}"
+        actionsmap_pkl = (
+            f"{actionsmap_yml_dir}/.{actionsmap_yml_file}.{self.version}.pkl"
+        )
 
         def generate_cache():
             logger.debug("generating cache for actions map")
@@ -489,16 +621,25 @@ class ActionsMap:
         else:
             return mod.Authenticator()
 
-    def check_authentication_if_required(self, *args, **kwargs):
+    def check_authentication_if_required(self, *args, authenticated=(), **kwargs):
         auth_method = self.parser.auth_method(*args, **kwargs)
 
-        if auth_method is None:
+        if auth_method is None or auth_method in authenticated:
             return
 
         authenticator = self.get_authenticator(auth_method)
         Moulinette.interface.authenticate(authenticator)
 
-    def process(self, args, timeout=None, **kwargs):
+    def process(
+        self,
+        args,
+        timeout=None,
+        timings=None,
+        hints=None,
+        authenticated=(),
+        parsed_action=None,
+        **kwargs,
+    ):
         """
         Parse arguments and process the proper action
 
@@ -506,12 +647,50 @@ class ActionsMap:
             - args -- The arguments to parse
             - timeout -- The time period before failing if the lock
                 cannot be acquired for the action
+            - timings -- A dict in which to record the time in seconds
+                spent authenticating and parsing arguments, as 'auth' and
+                'parse', besides the timings of run_action()
+            - hints -- A dict of optional arguments, see run_action()
+            - authenticated -- The authentication methods already checked
+                for the caller, which are not checked again
+            - parsed_action -- The 2-tuple (tid, arguments) already returned by
+                parse_action() for the arguments, which are not parsed again
             - **kwargs -- Additional interface arguments
 
         """
 
         # Perform authentication if needed
-        self.check_authentication_if_required(args, **kwargs)
+        start = time()
+        self.check_authentication_if_required(
+            args, authenticated=authenticated, **kwargs
+        )
+        parsed = time()
+
+        if parsed_action is None:
+            parsed_action = self.parse_action(args, **kwargs)
+        tid, arguments = parsed_action
+        want_to_take_lock = self.parser.want_to_take_lock(args, **kwargs)
+        if timings is not None:
+            timings["auth"] = parsed - start
+            timings["parse"] = time() - parsed
+
+        return self.run_action(
+            tid, arguments, timeout, want_to_take_lock, timings, hints
+        )
+
+    def parse_action(self, args, **kwargs):
+        """
+        Parse arguments of the requested action
+
+        Keyword arguments:
+            - args -- The arguments to parse
+            - **kwargs -- Additional interface arguments
+
+        Returns:
+            A 2-tuple (tid, arguments) where arguments is a dict of the
+            parsed arguments, extra parameters included
+
+        """
 
         # Parse arguments
         arguments = vars(self.parser.parse_args(args, **kwargs))
@@ -520,7 +699,36 @@ class ActionsMap:
         tid = arguments.pop("_tid")
         arguments = self.extraparser.parse_args(tid, arguments)
 
-        want_to_take_lock = self.parser.want_to_take_lock(args, **kwargs)
+        return tid, arguments
+
+    def run_action(
+        self,
+        tid,
+        arguments,
+        timeout=None,
+        want_to_take_lock=True,
+        timings=None,
+        hints=None,
+    ):
+        """
+        Process an action whose arguments have already been parsed
+
+        Keyword arguments:
+            - tid -- The tuple identifier of the action
+            - arguments -- A dict of parsed arguments for the action
+            - timeout -- The time period before failing if the lock
+                cannot be acquired for the action
+            - want_to_take_lock -- False if the action does not need the
+                lock of the namespace
+            - timings -- A dict in which to record the time in seconds spent
+                waiting for the lock, holding it, importing the module of the
+                action and processing it, as 'lock_wait', 'lock_hold',
+                'import' and 'action'
+            - hints -- A dict of optional arguments which are only given to
+                the function if it accepts them, the other ones being
+                removed from the dict
+
+        """
 
         # Retrieve action information
         if len(tid) == 4:
@@ -544,7 +752,12 @@ class ActionsMap:
             full_action_name = "{}.{}.{}".format(namespace, category, action)
 
         # Lock the moulinette for the namespace
-        with MoulinetteLock(namespace, timeout, self.enable_lock and want_to_take_lock):
+        with MoulinetteLock(
+            namespace,
+            timeout,
+            self.enable_lock and want_to_take_lock,
+            timings=timings,
+        ):
             start = time()
             try:
                 mod = __import__(
@@ -558,7 +771,14 @@ class ActionsMap:
                     "{}.{}".format(namespace, category),
                     time() - start,
                 )
+                if timings is not None:
+                    timings["import"] = time() - start
                 func = getattr(mod, func_name)
+                if hints:
+                    accepted = inspect.signature(func).parameters
+                    for name in [name for name in hints if name not in accepted]:
+                        del hints[name]
+                    arguments = dict(arguments, **hints)
             except (AttributeError, ImportError) as e:
                 import traceback
 
@@ -576,13 +796,70 @@ class ActionsMap:
                 # Load translation and process the action
                 start = time()
                 try:
-                    return func(**arguments)
+                    ret = self.executor.run(
+                        self._action_executors.get(tid, "inline"),
+                        "{}.{}".format(namespace, category),
+                        func_name,
+                        func,
+                        arguments,
+                    )
+                    # Results are only streamed by actions which don't take
+                    # the lock, the others are produced while it is held
+                    if self.enable_lock and want_to_take_lock:
+                        if isinstance(ret, Iterator):
+                            ret = list(ret)
+                    return ret
                 finally:
                     stop = time()
                     logger.debug("action executed in %.3fs", stop - start)
+                    if timings is not None:
+                        timings["action"] = stop - start
+
+    def run_validator(self, tid, name, arguments):
+        """
+        Call the validator of an action
+
+        The validator is a function of the module of the action which is
+        given the parsed arguments it accepts, without taking the lock,
+        and returns a value which changes whenever the result of the
+        action does - e.g. a version or the modification time of a file.
+
+        Keyword arguments:
+            - tid -- The tuple identifier of the action
+            - name -- The name of the validator function
+            - arguments -- A dict of parsed arguments for the action
+
+        """
+        module_name = "{}.{}".format(*tid[:2])
+        try:
+            func = getattr(import_module(module_name), name)
+        except (AttributeError, ImportError) as e:
+            error_message = "unable to load function {}.{} because: {}".format(
+                module_name,
+                name,
+                e,
+            )
+            logger.exception(error_message)
+            raise MoulinetteError(error_message, raw_msg=True)
+
+        accepted = inspect.signature(func).parameters
+        return func(**{k: v for k, v in arguments.items() if k in accepted})
 
     # Private methods
 
+    def _set_action_executor(self, tid, executor):
+        if executor is None or executor in ("inline", "gevent"):
+            return
+        if executor not in ActionExecutor.types:
+            error_message = "invalid executor '%s' for action %s" % (
+                executor,
+                ".".join(tid),
+            )
+            logger.error(error_message)
+            raise MoulinetteError(error_message, raw_msg=True)
+        self._action_executors[tid] = executor
+        self.executor.declared.add(executor)
+
     def _construct_parser(self, actionsmap, top_parser):
         """
         Construct the parser with the actions map
@@ -615,6 +892,8 @@ class ActionsMap:
         self.namespace = _global["namespace"]
         self.enable_lock = _global.get("lock", True)
         self.default_authentication = _global["authentication"][interface_type]
+        self.executor = ActionExecutor(**_global.get("executors", {}))
+        self._action_executors = {}  # dict({tid: executor})
 
         # category_name is stuff like "user", "domain", "hooks"...
         # category_values is the values of this category (like actions)
@@ -633,6 +912,7 @@ class ActionsMap:
                 arguments = action_options.pop("arguments", {})
                 authentication = action_options.pop("authentication", {})
                 tid = (self.namespace, category_name, action_name)
+                self._set_action_executor(tid, action_options.pop("executor", None))
 
                 # Get action parser
                 action_parser = category_parser.add_action_parser(
@@ -679,6 +959,7 @@ class ActionsMap:
                     arguments = action_options.pop("arguments", {})
                     authentication = action_options.pop("authentication", {})
                     tid = (self.namespace, category_name, subcategory_name, action_name)
+                    self._set_action_executor(tid, action_options.pop("executor", None))
 
                     try:
                         # Get action parser
@@ -19,6 +19,9 @@
 #
 
 import logging
+import hashlib
+
+from typing import Optional
 
 from moulinette.core import MoulinetteError, MoulinetteAuthenticationError
 
@@ -40,8 +43,38 @@ class BaseAuthenticator:
     must be given on instantiation - with the corresponding vendor
     configuration of the authenticator.
 
+    Authenticators may let the API cache the sessions they verified by
+    setting 'session_cookie_name' and 'session_cache_ttl': get_session_cookie
+    is then only called again once the session expired from the cache. Note
+    that a session revoked otherwise than through delete_session_cookie - on
+    the backend side for instance - remains valid until then.
+
     """
 
+    # The name of the cookie holding the session
+    session_cookie_name: Optional[str] = None
+
+    # The number of seconds a verified session may be cached, 0 to disable
+    session_cache_ttl = 0
+
+    def get_session_cache_key(self, cookie):
+        """Return a key identifying a session in a cache
+
+        Keyword arguments:
+            - cookie -- The value of the session cookie, as read by the
+                interface
+
+        Returns:
+            The digest of the session cookie, or None if there is no session
+            or if the authenticator doesn't allow to cache its sessions
+
+        """
+        if not self.session_cache_ttl or not self.session_cookie_name or not cookie:
+            return None
+
+        name = getattr(self, "name", self.__class__.__name__)
+        return hashlib.sha256(f"{name}:{cookie}".encode()).hexdigest()
+
     # Virtual methods
     # Each authenticator classes must implement these methods.
 
@@ -23,10 +23,19 @@ import time
 import json
 import logging
 
+from contextvars import ContextVar
+from typing import Optional
+
 import moulinette
 
 logger = logging.getLogger("moulinette.core")
 
+# The locale to use in the current context - e.g. the one of an API request -
+# which takes precedence over the locale set globally
+_context_locale: ContextVar[Optional[str]] = ContextVar(
+    "moulinette_locale", default=None
+)
+
 
 def during_unittests_run():
     return "TESTS_RUN" in os.environ
@@ -69,6 +78,16 @@ class Translator:
                 locales.append(f[:-5])
         return locales
 
+    def load_all(self):
+        """Load the translations of all the available locales"""
+        try:
+            locales = self.get_locales()
+        except OSError as e:
+            logger.error(f"unable to list locales from '{self.locale_dir}': {e}")
+            return
+        for locale in locales:
+            self._load_translations(locale)
+
     def set_locale(self, locale):
         """Set the locale to use
 
@@ -103,18 +122,20 @@ class Translator:
         """Retrieve proper translation for a key
 
         Attempt to retrieve translation for a key using the current locale
-        or the default locale if 'key' is not found.
+        - the one of the current context if any - or the default locale if
+        'key' is not found.
 
         Keyword arguments:
             - key -- The key to translate
 
         """
+        locale = _context_locale.get() or self.locale
         failed_to_format = False
-        if key in self._translations.get(self.locale, {}):
+        if key in self._translations.get(locale, {}):
             try:
-                return self._translations[self.locale][key].format(*args, **kwargs)
+                return self._translations[locale][key].format(*args, **kwargs)
             except Exception as e:
-                unformatted_string = self._translations[self.locale][key]
+                unformatted_string = self._translations[locale][key]
                 error_message = (
                     "Failed to format translated string '%s': '%s' with arguments '%s' and '%s, raising error: %s(%s) (don't panic this is just a warning)"
                     % (key, unformatted_string, args, kwargs, e.__class__.__name__, e)
@@ -128,7 +149,7 @@ class Translator:
                 failed_to_format = True
 
         if failed_to_format or (
-            self.default_locale != self.locale
+            self.default_locale != locale
             and key in self._translations.get(self.default_locale, {})
         ):
             try:
@@ -201,7 +222,7 @@ class Moulinette18n:
 
     def __init__(self, default_locale="en"):
         self.default_locale = default_locale
-        self.locale = default_locale
+        self._locale = default_locale
 
         # Init global translator
         global_locale_dir = "/usr/share/moulinette/locales"
@@ -210,16 +231,45 @@ class Moulinette18n:
 
         self._global = Translator(global_locale_dir, default_locale)
 
+    @property
+    def locale(self):
+        """The locale in use in the current context"""
+        return _context_locale.get() or self._locale
+
     def set_locales_dir(self, locales_dir):
         self.translator = Translator(locales_dir, self.default_locale)
 
     def set_locale(self, locale):
         """Set the locale to use"""
 
-        self.locale = locale
+        self._locale = locale
         self._global.set_locale(locale)
         self.translator.set_locale(locale)
 
+    def load_all_locales(self):
+        """Load the translations of all the available locales
+
+        It is meant to be called once at startup by long-running interfaces,
+        so that use_locale doesn't have to load anything afterwards.
+
+        """
+        self._global.load_all()
+        self.translator.load_all()
+
+    def use_locale(self, locale):
+        """Set the locale to use in the current context only
+
+        Unlike set_locale, it doesn't change the locale of the other threads
+        or greenlets - e.g. concurrent API requests - and doesn't load any
+        translations: keys of a locale which has not been loaded by
+        load_all_locales are translated using the default locale.
+
+        Keyword arguments:
+            - locale -- The locale to use, or None to use the global one
+
+        """
+        _context_locale.set(locale)
+
     def g(self, key: str, *args, **kwargs) -> str:
         """Retrieve proper translation for a moulinette key
 
@@ -274,6 +324,18 @@ class MoulinetteError(Exception):
     def content(self) -> str:
         return self.strerror
 
+    def __reduce__(self):
+        # The message is already translated, don't pass it to __init__ again
+        # when unpickling - e.g. when raised from another process
+        return (_restore_error, (self.__class__, self.args, self.__dict__))
+
+
+def _restore_error(cls, args, state):
+    error = cls.__new__(cls)
+    Exception.__init__(error, *args)
+    error.__dict__.update(state)
+    return error
+
 
 class MoulinetteValidationError(MoulinetteError):
     http_code = 400
@@ -295,16 +357,21 @@ class MoulinetteLock:
             be acquired
         - interval -- The time period before trying again to acquire the
             lock
+        - timings -- A dict in which to record the time spent waiting for
+            the lock and holding it, as 'lock_wait' and 'lock_hold'
 
     """
 
     base_lockfile = "/var/run/moulinette_%s.lock"
 
-    def __init__(self, namespace, timeout=None, enable_lock=True, interval=0.5):
+    def __init__(
+        self, namespace, timeout=None, enable_lock=True, interval=0.5, timings=None
+    ):
         self.namespace = namespace
         self.timeout = timeout
         self.interval = interval
         self.enable_lock = enable_lock
+        self.timings = timings
 
         self._lockfile = self.base_lockfile % namespace
         self._stale_checked = False
@@ -372,6 +439,9 @@ class MoulinetteLock:
             logger.warning(moulinette.m18n.g("warn_the_user_that_lock_is_acquired"))
         logger.debug("lock has been acquired")
         self._locked = True
+        self._locked_at = time.time()
+        if self.timings is not None:
+            self.timings["lock_wait"] = self._locked_at - start_time
 
     def release(self):
         """Release the lock of the moulinette instance
@@ -388,6 +458,26 @@ class MoulinetteLock:
                 )
             logger.debug("lock has been released")
             self._locked = False
+            if self.timings is not None:
+                self.timings["lock_hold"] = time.time() - self._locked_at
+
+    def release_stale(self, pid):
+        """Release the lock if it is held by a process which has exited
+
+        Keyword arguments:
+            - pid -- The PID of the process which has exited
+
+        """
+        if self._lock_PIDs() == [pid]:
+            logger.warning("releasing the lock held by exited process %d" % pid)
+            try:
+                os.unlink(self._lockfile)
+            except FileNotFoundError:
+                pass
+
+    def holders(self):
+        """Return the PIDs of the processes holding the lock"""
+        return self._lock_PIDs()
 
     def _lock(self):
         try:
@@ -24,18 +24,40 @@ import re
 import errno
 import logging
 import argparse
-
-from json import dumps as json_encode
-from tempfile import mkdtemp
+import base64
+import binascii
+import hashlib
+import multiprocessing
+import signal
+import socket
+import stat
+import time
+
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from importlib import import_module
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar, copy_context
+from json import dumps as json_encode, load as json_load, loads as json_decode
+from urllib.parse import urlsplit
+from threading import Condition, Event, Semaphore, Thread
+from typing import Optional
+from email.message import Message
+from tempfile import mkdtemp, NamedTemporaryFile
 from shutil import rmtree
 
 from bottle import redirect, request, response, Bottle, HTTPResponse, FileUpload
-from bottle import abort
+from bottle import GeventServer, HTTPError, Route, Router
+from bottle import LocalRequest, LocalResponse, _local_property
 
 from moulinette import m18n, Moulinette
-from moulinette.actionsmap import ActionsMap
+from moulinette.actionsmap import ActionsMap, system_thread_pool
 from moulinette.core import (
     MoulinetteError,
+    MoulinetteLock,
     MoulinetteValidationError,
     MoulinetteAuthenticationError,
 )
@@ -44,169 +66,2462 @@ from moulinette.interfaces import (
     ExtendedArgumentParser,
     JSONExtendedEncoder,
 )
+from moulinette.utils.text import random_ascii
 
 logger = logging.getLogger("moulinette.interface.api")
 
 
-# API helpers ----------------------------------------------------------
-# We define a global variable to manage in a dirty way the upload...
-UPLOAD_DIR = None
+# API helpers ----------------------------------------------------------
+
+CSRF_TYPES = {"text/plain", "application/x-www-form-urlencoded", "multipart/form-data"}
+
+# Media types selecting newline-delimited JSON for streamed responses
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+
+# Size in bytes above which encoded items of a streamed response are flushed
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Size in bytes of the chunks in which uploaded files are written to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Maximum size in bytes of the headers of a part of a multipart body
+MULTIPART_HEADERS_MAX_SIZE = 64 * 1024
+
+# Maximum number of actions processed at once for a WebSocket connection,
+# further messages being read once one of them is done
+WEBSOCKET_MAX_CALLS = 8
+
+# Maximum number of actions of a batch, and of those processed at once
+BATCH_MAX_ENTRIES = 100
+BATCH_MAX_CALLS = 8
+
+# Phases of the requests reported in the Server-Timing header, in order
+SERVER_TIMING_PHASES = {
+    "middleware": "CSRF/CORS/locale plugins",
+    "args": "Arguments collection",
+    "auth": "Session verification",
+    "parse": "Arguments parsing",
+    "lock_wait": "Lock wait",
+    "import": "Module import",
+    "action": "Action",
+    "serialize": "Serialization",
+}
+
+
+def format_server_timing(timings, total):
+    """Format the timings of a request for the Server-Timing header
+
+    Keyword arguments:
+        - timings -- A dict of durations in seconds by phase
+        - total -- The duration in seconds of the whole request
+
+    """
+    metrics = [
+        f'{phase};desc="{desc}";dur={timings[phase] * 1000:.2f}'
+        for phase, desc in SERVER_TIMING_PHASES.items()
+        if phase in timings
+    ]
+    metrics.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(metrics)
+
+
+def is_csrf():
+    """Checks is this is a CSRF request."""
+
+    if request.method != "POST":
+        return False
+    if request.content_type is None:
+        return True
+    content_type = request.content_type.lower().split(";")[0]
+    if content_type not in CSRF_TYPES:
+        return False
+
+    return request.headers.get("X-Requested-With") is None
+
+
+def is_cross_origin(environ, allowed_origins):
+    """Checks if the origin of a request is neither its host nor allowed
+
+    Keyword arguments:
+        - environ -- The WSGI environment of the request
+        - allowed_origins -- The origins allowed besides the host
+
+    """
+    origin = environ.get("HTTP_ORIGIN")
+    if not origin or origin in allowed_origins:
+        return False
+    host = environ.get("HTTP_X_FORWARDED_HOST") or environ.get("HTTP_HOST")
+    return urlsplit(origin).netloc != host
+
+
+def websocket_handler(allowed_origins):
+    """Return a gevent handler class upgrading requests to WebSocket
+
+    Browsers send the cookies of the API along with WebSocket requests of
+    any origin, which the same-origin policy does not cover: requests
+    from a page of another origin than the host and the allowed ones are
+    rejected before the connection is upgraded.
+
+    Keyword arguments:
+        - allowed_origins -- The origins allowed besides the host
+
+    """
+    from geventwebsocket.handler import WebSocketHandler
+
+    class _WebSocketHandler(WebSocketHandler):
+        def upgrade_websocket(self):
+            if self.environ.get("HTTP_UPGRADE", "").lower() == "websocket" and (
+                is_cross_origin(self.environ, allowed_origins)
+            ):
+                self.start_response("403 Forbidden", [("Content-Type", "text/plain")])
+                return [b"Origin not allowed"]
+            return super().upgrade_websocket()
+
+    return _WebSocketHandler
+
+
+class _RequestPipeline:
+    """Bottle plugin which prepares requests and their responses
+
+    It is applied once to each route and does in a single wrapper what is
+    common to all of them: the protection against CSRF, the CORS headers,
+    the locale of the request, the sync of the process-local caches and the
+    Server-Timing header - and the record of the request in the access log.
+    What depends on the route - e.g. whether it can be
+    a CSRF request - is determined once when the route is compiled.
+
+    The protection against CSRF is disabled for a route with the 'csrf'
+    route config set to False, while routes with 'preflight' set to True
+    only answer CORS preflight requests. Routes with 'same_origin' set to
+    True reject the requests whose Origin is neither the host nor one of
+    the allowed origins.
+
+    Keyword arguments:
+        - allowed_cors_origins -- A list of origins allowed for CORS requests
+        - cors_max_age -- The time period in seconds during which browsers
+            may cache the result of a preflight request, or None
+        - caches -- A _CacheGeneration instance to sync before each request
+        - server_timing -- Whether to always add the Server-Timing header
+        - access_log -- An _AccessLog instance to record the requests in, or
+            None
+        - diagnostics -- A _Diagnostics instance to keep the requests being
+            processed in, or None
+
+    """
+
+    name = "pipeline"
+    api = 2
+
+    def __init__(
+        self,
+        allowed_cors_origins=[],
+        cors_max_age=None,
+        caches=None,
+        server_timing=False,
+        access_log=None,
+        diagnostics=None,
+    ):
+        self.allowed_cors_origins = frozenset(allowed_cors_origins)
+        self.caches = caches
+        self.server_timing = server_timing
+        self.access_log = access_log
+        self.diagnostics = diagnostics
+
+        self.cors_headers = [
+            ("Access-Control-Allow-Methods", "GET, HEAD, POST, PUT, OPTIONS, DELETE"),
+            (
+                "Access-Control-Allow-Headers",
+                "Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token, "
+                "Locale, Prefer, X-Server-Timing, Idempotency-Key",
+            ),
+            (
+                "Access-Control-Expose-Headers",
+                "X-Total-Count, X-Next-Cursor, Idempotent-Replayed",
+            ),
+            ("Access-Control-Allow-Credentials", "true"),
+        ]
+        self.preflight_headers = self.cors_headers + [("Vary", "Origin")]
+        if cors_max_age is not None:
+            self.preflight_headers.append(("Access-Control-Max-Age", str(cors_max_age)))
+
+    def apply(self, callback, route):
+        if route.config.get("preflight", False):
+            return self._compile_preflight(callback)
+
+        check_csrf = route.config.get("csrf", True) and route.method in ("POST", "ANY")
+        check_origin = route.config.get("same_origin", False)
+        allowed_cors_origins = self.allowed_cors_origins
+        cors_headers = self.cors_headers
+        caches = self.caches
+        server_timing = self.server_timing
+        access_log = self.access_log
+        route_name = f"{route.method} {route.rule}"
+        use_locale = m18n.use_locale
+
+        def wrapper(*args, **kwargs):
+            environ = request.environ
+            start = time.perf_counter()
+            timings = None
+            if server_timing or "HTTP_X_SERVER_TIMING" in environ:
+                timings = environ["moulinette.timings"] = {"start": start}
+
+            if check_csrf and is_csrf():
+                r = HTTPError(403, "CSRF protection")
+            elif check_origin and is_cross_origin(environ, allowed_cors_origins):
+                r = HTTPError(403, "Origin not allowed")
+            else:
+                if caches is not None:
+                    caches.sync()
+                use_locale(environ.get("HTTP_LOCALE") or m18n.default_locale)
+                try:
+                    r = callback(*args, **kwargs)
+                except HTTPResponse as e:
+                    r = e
+                except Exception:
+                    if access_log is not None:
+                        access_log.track(HTTPResponse(status=500), route_name, start)
+                    raise
+
+                origin = environ.get("HTTP_ORIGIN")
+                if origin and origin in allowed_cors_origins:
+                    resp = r if isinstance(r, HTTPResponse) else response
+                    resp.set_header("Access-Control-Allow-Origin", origin)
+                    for name, value in cors_headers:
+                        resp.set_header(name, value)
+                    # Keep what the response varies on otherwise
+                    vary = resp.get_header("Vary")
+                    resp.set_header("Vary", f"{vary}, Origin" if vary else "Origin")
+
+            if timings is not None:
+                resp = r if isinstance(r, HTTPResponse) else response
+                resp.set_header(
+                    "Server-Timing",
+                    format_server_timing(timings, time.perf_counter() - start),
+                )
+            if access_log is not None:
+                r = access_log.track(r, route_name, start)
+            return r
+
+        if self.diagnostics is not None:
+            diagnostics = self.diagnostics
+
+            def tracked_wrapper(*args, **kwargs):
+                return diagnostics.track(wrapper, *args, **kwargs)
+
+            return tracked_wrapper
+
+        return wrapper
+
+    def _compile_preflight(self, callback):
+        allowed_cors_origins = self.allowed_cors_origins
+        preflight_headers = self.preflight_headers
+
+        def wrapper(*args, **kwargs):
+            r = callback(*args, **kwargs)
+            origin = request.environ.get("HTTP_ORIGIN")
+            if origin and origin in allowed_cors_origins:
+                r.set_header("Access-Control-Allow-Origin", origin)
+                for name, value in preflight_headers:
+                    r.set_header(name, value)
+            return r
+
+        return wrapper
+
+
+class _TTLCache:
+    """A bounded mapping whose entries expire after a time-to-live
+
+    Once 'max_size' is reached, the oldest entries are evicted first.
+
+    Keyword arguments:
+        - max_size -- The maximum number of entries
+        - ttl -- The default time-to-live of entries, in seconds
+
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # dict({key: (expires_at, value)})
+
+    def get(self, key, default=None):
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return default
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data.pop(key, None)
+        self._data[key] = (time.monotonic() + ttl, value)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        try:
+            return self._data.pop(key)[1]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _RouteNode:
+    __slots__ = ("static", "params", "rest", "value")
+
+    def __init__(self):
+        self.static = {}  # dict({segment: _RouteNode})
+        self.params = []  # list([(name, match, _RouteNode)])
+        self.rest = []  # list([(name, match, value)])
+        self.value = None
+
+
+def _may_match_slash(pattern):
+    """Return whether a regular expression may match a string with a slash
+
+    The parsed expression is walked by the parser of the re module, and
+    its constructs which are not known to never match a slash are deemed
+    to match one. As this parser is not a public API, any expression is
+    deemed to match a slash if it cannot be used.
+
+    """
+    try:
+        from re import _constants as sre, _parser as sre_parse
+    except ImportError:
+        # Python < 3.11
+        try:
+            import sre_parse
+            import sre_constants as sre
+        except ImportError:
+            return True
+
+    try:
+        return _walk_may_match_slash(sre, sre_parse.parse(pattern))
+    except Exception:
+        return True
+
+
+def _walk_may_match_slash(sre, items):
+    slash = ord("/")
+    slash_categories = {
+        sre.CATEGORY_NOT_DIGIT,
+        sre.CATEGORY_NOT_SPACE,
+        sre.CATEGORY_NOT_WORD,
+    }
+    # Possessive repeats and atomic groups are only parsed since Python 3.11
+    repeats = {sre.MAX_REPEAT, sre.MIN_REPEAT, getattr(sre, "POSSESSIVE_REPEAT", None)}
+
+    def in_set(items):
+        negate = bool(items) and items[0][0] is sre.NEGATE
+        for op, av in items:
+            if (
+                (op is sre.LITERAL and av == slash)
+                or (op is sre.RANGE and av[0] <= slash <= av[1])
+                or (op is sre.CATEGORY and av in slash_categories)
+            ):
+                return not negate
+        return negate
+
+    def walk(items):
+        for op, av in items:
+            if op in (sre.AT, sre.ASSERT, sre.ASSERT_NOT, sre.GROUPREF):
+                # Nothing is consumed, or what a group already matched
+                continue
+            if op is sre.LITERAL:
+                found = av == slash
+            elif op is sre.NOT_LITERAL:
+                found = av != slash
+            elif op is sre.IN:
+                found = in_set(av)
+            elif op is sre.BRANCH:
+                found = any(walk(branch) for branch in av[1])
+            elif op is sre.SUBPATTERN:
+                found = walk(av[-1])
+            elif op in repeats:
+                found = walk(av[2])
+            elif op is getattr(sre, "ATOMIC_GROUP", None):
+                found = walk(av)
+            else:
+                found = True
+            if found:
+                return True
+        return False
+
+    return walk(items)
+
+
+class _RouteTable:
+    """A router resolving paths with a radix tree of path segments
+
+    Rules follow the syntax of Bottle (e.g. '/users/<username>'), with
+    wildcards spanning whole path segments - or the rest of the path for
+    the 'path' filter. For each HTTP method, the rules are stored in a
+    tree of their segments so that a path is resolved in a time which
+    does not depend on the number of rules. Static segments are preferred
+    over wildcards, which are tried in the order the rules were added.
+
+    Captured arguments are kept as strings, the 'int', 'float' and 're'
+    filters only restricting the segments they match.
+
+    """
+
+    filters = {
+        "default": r"[^/]+",
+        "int": r"-?\d+",
+        "float": r"-?[\d.]+",
+        "path": r".+?",
+    }
+
+    def __init__(self):
+        self._trees = {}  # dict({method: _RouteNode})
+        self._static = {}  # dict({method: {path: value}})
+        self._tokenizer = Router()
+
+    def add(self, method, rule, value):
+        """Add a rule to the table
+
+        Return False if the rule cannot be resolved by the table, i.e.
+        if it has wildcards which do not span whole path segments or 're'
+        ones which may match a slash.
+
+        Keyword arguments:
+            - method -- The HTTP method of the rule
+            - rule -- The rule of the paths to match
+            - value -- The value to resolve the matching paths to
+
+        """
+        segments = [[]]
+        for key, mode, conf in self._tokenizer._itertokens(rule):
+            if mode is None:
+                parts = key.split("/")
+                segments[-1].append(parts[0])
+                segments.extend([part] for part in parts[1:])
+            else:
+                if mode == "re":
+                    pattern = conf
+                    if _may_match_slash(pattern):
+                        return False
+                elif mode in self.filters:
+                    pattern = self.filters[mode]
+                else:
+                    return False
+                segments[-1].append((key, mode, re.compile(pattern).fullmatch))
+        if segments.pop(0) != [""]:
+            return False
+
+        node = self._trees.setdefault(method, _RouteNode())
+        if all(isinstance(part, str) for parts in segments for part in parts):
+            # Paths without wildcards are resolved at once
+            self._static.setdefault(method, {})[rule] = value
+        for i, parts in enumerate(segments):
+            parts = [part for part in parts if part != ""] or [""]
+            if len(parts) > 1:
+                return False
+            (part,) = parts
+            if isinstance(part, str):
+                node = node.static.setdefault(part, _RouteNode())
+                continue
+            name, mode, match = part
+            if mode == "path":
+                if i != len(segments) - 1:
+                    return False
+                node.rest.append((name, match, value))
+                return True
+            for param in node.params:
+                if param[:2] == (name, match):
+                    node = param[2]
+                    break
+            else:
+                child = _RouteNode()
+                node.params.append((name, match, child))
+                node = child
+        node.value = value
+        return True
+
+    def match(self, method, path):
+        """Resolve a path
+
+        Return the value of the matching rule and the arguments captured
+        in the path, or None if no rule matches.
+
+        Keyword arguments:
+            - method -- The HTTP method of the request
+            - path -- The path of the request
+
+        """
+        if method == "HEAD" and method not in self._trees:
+            method = "GET"
+        value = self._static.get(method, {}).get(path)
+        if value is not None:
+            return value, {}
+        tree = self._trees.get(method)
+        if tree is None or not path.startswith("/"):
+            return None
+        args = {}
+        value = self._match(tree, path[1:].split("/"), 0, args)
+        if value is None:
+            return None
+        return value, args
+
+    def allowed_methods(self, path):
+        """Return the HTTP methods of the rules matching a path"""
+        return [m for m in self._trees if self.match(m, path) is not None]
+
+    def _match(self, node, segments, i, args):
+        if i == len(segments):
+            return node.value
+        segment = segments[i]
+        child = node.static.get(segment)
+        if child is not None:
+            value = self._match(child, segments, i + 1, args)
+            if value is not None:
+                return value
+        if segment:
+            for name, match, child in node.params:
+                if match(segment):
+                    args[name] = segment
+                    value = self._match(child, segments, i + 1, args)
+                    if value is not None:
+                        return value
+                    del args[name]
+        for name, match, value in node.rest:
+            rest = "/".join(segments[i:])
+            if match(rest):
+                args[name] = rest
+                return value
+        return None
+
+
+class _ActionsMapRouter:
+    """Resolve the requests to the routes of the actions map
+
+    Requests are first resolved against the router of the actions map
+    parser and then handed over to the router of Bottle, whose match()
+    method is replaced by this one once installed. The actions map which
+    resolved a request is kept in its environment, so that the request is
+    processed with it even if the actions map is reloaded meanwhile.
+
+    Keyword arguments:
+        - actionsmap -- The ActionsMap instance
+        - routes -- A dict of the Bottle routes of the actions in the form
+            of {(method, path): route}
+
+    """
+
+    def __init__(self, actionsmap, routes):
+        # Both are replaced at once when the actions map is reloaded
+        self.state = (actionsmap, routes)
+        self._fallback = None
+
+    def install(self, router):
+        self._fallback = router.match
+        router.match = self.match
+
+    def match(self, environ):
+        actionsmap, routes = self.state
+        path = environ["PATH_INFO"] or "/"
+        match = actionsmap.parser.match(environ["REQUEST_METHOD"].upper(), path)
+        if match is not None:
+            route, args = match
+            environ["moulinette.actionsmap"] = actionsmap
+            return routes[route], args
+
+        try:
+            return self._fallback(environ)
+        except HTTPError as e:
+            if e.status_code not in (404, 405):
+                raise
+            allowed = set(actionsmap.parser.router.allowed_methods(path))
+            if not allowed:
+                raise
+            if e.status_code == 405:
+                allowed.update(e.headers["Allow"].split(","))
+            raise HTTPError(405, "Method not allowed.", Allow=",".join(sorted(allowed)))
+
+
+class _HTTPArgumentParser:
+    """Argument parser for HTTP requests
+
+    Object for parsing HTTP requests into Python objects. It is based
+    on ExtendedArgumentParser class and implements some of its methods.
+
+    """
+
+    def __init__(self):
+        # Initialize the ArgumentParser object
+        self._parser = ExtendedArgumentParser(
+            usage="", prefix_chars="@", add_help=False
+        )
+        self._parser.error = self._error
+
+        self._positional = []  # list(arg_name)
+        self._optional = {}  # dict({arg_name: option_strings})
+        # Whether arguments of any type are given the path of uploaded files
+        self.upload_path = False
+
+    def set_defaults(self, **kwargs):
+        return self._parser.set_defaults(**kwargs)
+
+    def get_default(self, dest):
+        return self._parser.get_default(dest)
+
+    def has_argument(self, dest):
+        return dest in self._optional or any(a.dest == dest for a in self._positional)
+
+    def describe(self, extra={}):
+        """Describe the arguments of the parser
+
+        The messages of the patterns are translated in the current locale.
+
+        Keyword arguments:
+            - extra -- A dict of the extra parameters of the arguments
+
+        """
+        arguments = []
+        for action in self._positional + list(self._optional.values()):
+            argument = {
+                "name": action.dest,
+                "required": action.required,
+                "help": action.help,
+            }
+            if isinstance(action, argparse._StoreConstAction):
+                argument["type"] = "bool"
+            elif action.type is open or isinstance(action.type, argparse.FileType):
+                argument["type"] = "file"
+            elif action.type is not None:
+                argument["type"] = getattr(action.type, "__name__", str(action.type))
+            if action.nargs in ("*", "+") or isinstance(action, argparse._AppendAction):
+                argument["multiple"] = True
+            if action.default not in (None, argparse.SUPPRESS):
+                argument["default"] = action.default
+            if action.choices is not None:
+                argument["choices"] = list(action.choices)
+
+            parameters = extra.get(action.dest, {})
+            if parameters.get("required"):
+                argument["required"] = True
+            if "pattern" in parameters:
+                pattern, message = parameters["pattern"]
+                # Attempt to retrieve message translation
+                msg = m18n.n(message)
+                if msg == message:
+                    msg = m18n.g(message)
+                argument["pattern"] = {"regex": pattern, "message": msg}
+            arguments.append(argument)
+
+        return arguments
+
+    def add_arguments(
+        self, arguments, extraparser, format_arg_names=None, validate_extra=True
+    ):
+        for argument_name, argument_options in arguments.items():
+            # will adapt arguments name for cli or api context
+            names = format_arg_names(
+                str(argument_name), argument_options.pop("full", None)
+            )
+
+            if "type" in argument_options:
+                argument_options["type"] = eval(argument_options["type"])
+
+            if "extra" in argument_options:
+                extra = argument_options.pop("extra")
+                argument_dest = self.add_argument(*names, **argument_options).dest
+                extraparser.add_argument(
+                    self.get_default("_tid"), argument_dest, extra, validate_extra
+                )
+                continue
+
+            self.add_argument(*names, **argument_options)
+
+    def add_argument(self, *args, **kwargs):
+        action = self._parser.add_argument(*args, **kwargs)
+
+        # Append newly created action
+        if len(action.option_strings) == 0:
+            self._positional.append(action)
+        else:
+            self._optional[action.dest] = action
+
+        return action
+
+    def parse_args(self, args={}, namespace=None):
+        arg_strings = []
+
+        # Append an argument to the current one
+        def append(arg_strings, value, action):
+            option_string = None
+            if len(action.option_strings) > 0:
+                option_string = action.option_strings[0]
+
+            if isinstance(value, bool) or isinstance(action.const, bool):
+                # Append the option string only
+                if option_string is not None and value != 0:
+                    arg_strings.append(option_string)
+            elif isinstance(value, FileUpload) and (
+                isinstance(action.type, argparse.FileType)
+                or action.type == open
+                or self.upload_path
+            ):
+                # Hand the path of the spooled file over to the action - which
+                # is opened by the parser for arguments of type open/FileType
+                path = get_upload_spool().save(value)
+                if option_string is not None:
+                    arg_strings.append(option_string)
+                arg_strings.append(path)
+            elif isinstance(value, str):
+                if option_string is not None:
+                    arg_strings.append(option_string)
+                    # TODO: Review this fix
+                    if value:
+                        arg_strings.append(value)
+                else:
+                    arg_strings.append(value)
+            elif isinstance(value, list):
+                if option_string is not None:
+                    arg_strings.append(option_string)
+                for v in value:
+                    if isinstance(v, str):
+                        arg_strings.append(v)
+                    else:
+                        logger.warning(
+                            "unsupported argument value type %r "
+                            "in %s for option string %s",
+                            v,
+                            value,
+                            option_string,
+                        )
+            else:
+                logger.warning(
+                    "unsupported argument type %r for option " "string %s",
+                    value,
+                    option_string,
+                )
+
+            return arg_strings
+
+        # Iterate over positional arguments
+        for action in self._positional:
+            if action.dest in args:
+                arg_strings = append(arg_strings, args[action.dest], action)
+
+        # Iterate over optional arguments
+        for dest, action in self._optional.items():
+            if dest in args:
+                arg_strings = append(arg_strings, args[dest], action)
+
+        return self._parser.parse_args(arg_strings, namespace)
+
+    def _error(self, message):
+        raise MoulinetteValidationError(message, raw_msg=True)
+
+
+# Uploads --------------------------------------------------------------
+
+
+class _UploadTooLarge(Exception):
+    """The files uploaded with a request exceed the size limit"""
+
+
+class _InvalidMultipart(Exception):
+    """The multipart body of a request is malformed"""
+
+
+def get_upload_spool():
+    """Return the spool of the files uploaded with the current request"""
+    return request.environ.setdefault("moulinette.upload_spool", _UploadSpool())
+
+
+class _UploadSpool:
+    """Temporary directory of the files uploaded with a request
+
+    Each request has its own spool, so that concurrent uploads don't
+    clobber each other. The directory is only created when a file is
+    saved, and removed with its content by cleanup() once the request
+    - or the job it was handed over to - is done.
+
+    Keyword arguments:
+        - max_size -- The maximum size in bytes of the uploaded files, or
+            None for no limit
+
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.path = None
+
+    def check_content_length(self):
+        """Reject the request before reading a body which is too large"""
+        if self.max_size is not None and request.content_length > self.max_size:
+            raise HTTPResponse("Uploaded files are too large", 413)
+
+    def read_multipart(self):
+        """Parse the multipart body of the request from the input stream
+
+        Bottle would first copy the whole body to a temporary file, then each
+        file to another one. Parsing the input stream directly writes the
+        files to the spool once, in chunks, and enforces the size limit while
+        streaming.
+
+        Returns:
+            A list of (name, value) where value is a string for fields and
+            a FileUpload for files
+
+        """
+        self.check_content_length()
+
+        # The boundary is case sensitive, while request.content_type is lowered
+        header = Message()
+        header["Content-Type"] = request.environ["CONTENT_TYPE"]
+        boundary = header.get_param("boundary")
+        charset = header.get_param("charset") or "utf8"
+        try:
+            if not boundary:
+                raise _InvalidMultipart("no boundary")
+            return list(self._parse_multipart(boundary.encode(), charset))
+        except _UploadTooLarge:
+            raise HTTPResponse("Uploaded files are too large", 413)
+        except _InvalidMultipart as e:
+            raise HTTPResponse(f"Invalid multipart body: {e}", 400)
+
+    def _parse_multipart(self, boundary, charset):
+        stream = request.environ["wsgi.input"]
+        remaining = request.content_length
+
+        def read():
+            nonlocal remaining
+            size = (
+                UPLOAD_CHUNK_SIZE
+                if remaining < 0
+                else min(remaining, UPLOAD_CHUNK_SIZE)
+            )
+            chunk = stream.read(size) if size else b""
+            remaining -= len(chunk)
+            return chunk
+
+        delimiter = b"\r\n--" + boundary
+        # The body starts right with the first delimiter, without the CRLF
+        buffer = b"\r\n"
+        while True:
+            index = buffer.find(delimiter)
+            if index >= 0:
+                break
+            chunk = read()
+            if not chunk or len(buffer) > MULTIPART_HEADERS_MAX_SIZE:
+                raise _InvalidMultipart("no boundary found")
+            buffer += chunk
+        buffer = buffer[index + len(delimiter) :]
+
+        while True:
+            # Either the CRLF before the headers of a part or the final '--'
+            while len(buffer) < 2:
+                chunk = read()
+                if not chunk:
+                    raise _InvalidMultipart("unexpected end of body")
+                buffer += chunk
+            if buffer.startswith(b"--"):
+                return
+            if not buffer.startswith(b"\r\n"):
+                raise _InvalidMultipart("invalid boundary")
+
+            while True:
+                index = buffer.find(b"\r\n\r\n")
+                if index >= 0:
+                    break
+                chunk = read()
+                if not chunk or len(buffer) > MULTIPART_HEADERS_MAX_SIZE:
+                    raise _InvalidMultipart("invalid part headers")
+                buffer += chunk
+            headers = []
+            for line in buffer[2:index].decode(charset).split("\r\n"):
+                name, sep, value = line.partition(":")
+                if not sep:
+                    raise _InvalidMultipart("invalid part header")
+                headers.append((name.strip(), value.strip()))
+            buffer = buffer[index + 4 :]
+
+            disposition = Message()
+            for name, value in headers:
+                disposition[name] = value
+            name = disposition.get_param("name", header="Content-Disposition")
+            filename = disposition.get_filename()
+            if name is None:
+                raise _InvalidMultipart("part without name")
+
+            if filename is None:
+                # Fields are kept in memory
+                while True:
+                    index = buffer.find(delimiter)
+                    if index >= 0:
+                        value = buffer[:index]
+                        break
+                    chunk = read()
+                    if not chunk:
+                        raise _InvalidMultipart("unexpected end of body")
+                    buffer += chunk
+                    if len(buffer) > request.MEMFILE_MAX:
+                        raise _UploadTooLarge()
+                yield name, value.decode(charset)
+            else:
+                # Files are written to the spool as they come
+                if self.path is None:
+                    self.path = mkdtemp(prefix="moulinette_upload_")
+                file = NamedTemporaryFile(dir=self.path, prefix=".part-", delete=False)
+                while True:
+                    index = buffer.find(delimiter)
+                    if index >= 0:
+                        data, buffer = buffer[:index], buffer[index:]
+                    else:
+                        # Keep what could be the start of the delimiter
+                        keep = len(delimiter) - 1
+                        data = buffer[:-keep] if len(buffer) > keep else b""
+                        buffer = buffer[len(data) :]
+                    self.size += len(data)
+                    if self.max_size is not None and self.size > self.max_size:
+                        file.close()
+                        raise _UploadTooLarge()
+                    file.write(data)
+                    if index >= 0:
+                        break
+                    chunk = read()
+                    if not chunk:
+                        file.close()
+                        raise _InvalidMultipart("unexpected end of body")
+                    buffer += chunk
+                file.seek(0)
+                yield name, FileUpload(file, name, filename, headers)
+            buffer = buffer[buffer.find(delimiter) + len(delimiter) :]
+
+    def save(self, upload):
+        """Save an uploaded file in the spool and return its path
+
+        Files which have already been written to a temporary file are hard
+        linked into the spool rather than copied.
+
+        """
+        if self.path is None:
+            self.path = mkdtemp(prefix="moulinette_upload_")
+
+        src = upload.file
+        name = getattr(src, "name", None)
+        spooled = isinstance(name, str) and os.path.dirname(name) == self.path
+        if not spooled:
+            # Files parsed by read_multipart() have already been counted
+            src.seek(0, os.SEEK_END)
+            self.size += src.tell()
+            src.seek(0)
+            if self.max_size is not None and self.size > self.max_size:
+                raise HTTPResponse("Uploaded files are too large", 413)
+
+        destination = os.path.join(self.path, upload.filename)
+        i = 0
+        while os.path.exists(destination):
+            i += 1
+            destination = os.path.join(self.path, f"{i}-{upload.filename}")
+
+        if isinstance(name, str) and os.path.isfile(name):
+            try:
+                os.link(name, destination)
+            except OSError:
+                # e.g. the spool is on another filesystem
+                pass
+            else:
+                return destination
+
+        with open(destination, "wb") as dst:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        src.seek(0)
+
+        return destination
+
+    def cleanup(self):
+        if self.path is not None:
+            rmtree(self.path, True)
+            self.path = None
+
+
+# Background jobs ------------------------------------------------------
+
+# The job which is processed in the current context, if any
+_current_job: ContextVar[Optional["_Job"]] = ContextVar(
+    "moulinette_current_job", default=None
+)
+
+
+def prefers_async():
+    """Checks if the client asked to process the request asynchronously."""
+
+    prefer = request.get_header("Prefer") or ""
+    return any(p.strip().lower() == "respond-async" for p in prefer.split(","))
+
+
+class _Job:
+    """An action processed in background
+
+    Keyword arguments:
+        - route -- The action route as a 2-tuple (method, path)
+        - authentication -- The authentication profile of the route
+        - publish -- A callable to notify of the job events
+
+    """
+
+    def __init__(self, route, authentication=None, publish=None):
+        self.id = random_ascii(24)
+        self.route = route
+        self.authentication = authentication
+        self._publish = publish or (lambda job, event, data: None)
+        self.status = "pending"
+        self.result = None
+        self.error = None  # tuple(http_code, content)
+        self.logs = []  # list({level, message})
+        self.created_at = time.time()
+        self.started_at = None
+        self.ended_at = None
+
+    @property
+    def done(self):
+        return self.status in ("success", "error")
+
+    def log(self, level, message):
+        entry = {"level": level, "message": message}
+        self.logs.append(entry)
+        self._publish(self, "log", entry)
+
+    def infos(self):
+        return {
+            "id": self.id,
+            "route": " ".join(self.route),
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "logs": len(self.logs),
+        }
+
+
+class _JobLogHandler(logging.Handler):
+    """Capture the log records emitted while processing a job"""
+
+    def emit(self, record):
+        job = _current_job.get()
+        if job is None:
+            return
+        try:
+            message = record.getMessage()
+        except Exception:
+            self.handleError(record)
+        else:
+            job.log(record.levelname.lower(), message)
+
+
+_job_log_handler = _JobLogHandler(logging.INFO)
+
+
+def _capture_logs():
+    """Make sure the log records are captured for the current job"""
+    root_logger = logging.getLogger()
+    if _job_log_handler not in root_logger.handlers:
+        root_logger.addHandler(_job_log_handler)
+
+
+def _release_logs():
+    """Stop capturing the log records for the jobs"""
+    logging.getLogger().removeHandler(_job_log_handler)
+
+
+class _JobManager:
+    """Process actions in background on bounded worker pools
+
+    Each namespace has its own pool of worker threads - which are greenlets
+    once gevent has patched the standard library - so that the number of
+    actions running concurrently in background is limited per namespace.
+    Jobs are kept in memory until 'max_jobs' is reached, the oldest
+    finished ones being forgotten first.
+
+    Keyword arguments:
+        - actionsmap -- The ActionsMap instance processing the actions
+        - max_workers -- The number of jobs run concurrently per namespace
+        - max_jobs -- The maximum number of jobs to keep track of
+        - publish -- A callable to publish the events of jobs as SSE
+            messages, or None
+
+    """
+
+    def __init__(self, actionsmap, max_workers=1, max_jobs=100, publish=None):
+        self.actionsmap = actionsmap
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.publish = publish
+
+        self._pools = {}  # dict({namespace: ThreadPoolExecutor})
+        self._jobs = OrderedDict()  # dict({job_id: _Job})
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        return list(self._jobs.values())
+
+    def submit(self, route, tid, arguments, want_to_take_lock=True, cleanup=None):
+        """Process an action in background
+
+        Keyword arguments:
+            - route -- The action route as a 2-tuple (method, path)
+            - tid -- The tuple identifier of the action
+            - arguments -- A dict of parsed arguments for the action
+            - want_to_take_lock -- False if the action does not need the lock
+            - cleanup -- A callable to call once the job is done
+
+        Returns:
+            The created _Job instance
+
+        """
+        self._forget_old_jobs()
+        if len(self._jobs) >= self.max_jobs:
+            raise HTTPResponse(
+                "Too many jobs are being processed", 503, headers={"Retry-After": "5"}
+            )
+
+        job = _Job(
+            route, self.actionsmap.parser.auth_method(None, route), self._publish
+        )
+        self._jobs[job.id] = job
+
+        _capture_logs()
+        namespace = tid[0]
+        if namespace not in self._pools:
+            self._pools[namespace] = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix=f"moulinette_job_{namespace}",
+            )
+        # Run in a copy of the request context to keep its locale
+        self._pools[namespace].submit(
+            copy_context().run,
+            self._run,
+            job,
+            tid,
+            arguments,
+            want_to_take_lock,
+            cleanup,
+        )
+        self._publish(job, "status", job.infos())
+
+        return job
+
+    def shutdown(self, wait=False):
+        """Stop the worker pools and the capture of the log records"""
+        for pool in self._pools.values():
+            pool.shutdown(wait=wait)
+        self._pools = {}
+        _release_logs()
+
+    # Private methods
+
+    def _run(self, job, tid, arguments, want_to_take_lock, cleanup):
+        token = _current_job.set(job)
+        job.status = "running"
+        job.started_at = time.time()
+        self._publish(job, "status", job.infos())
+        try:
+            ret = self.actionsmap.run_action(
+                tid, arguments, want_to_take_lock=want_to_take_lock
+            )
+            if isinstance(ret, Iterator):
+                ret = list(ret)
+        except MoulinetteError as e:
+            job.error = (e.http_code, e.content())
+            job.status = "error"
+        except Exception as e:
+            logger.exception("job %s failed", job.id)
+            job.error = (500, str(e))
+            job.status = "error"
+        else:
+            job.result = ret
+            job.status = "success"
+        finally:
+            job.ended_at = time.time()
+            _current_job.reset(token)
+            if cleanup is not None:
+                cleanup()
+            self._publish(job, "status", job.infos())
+
+    def _forget_old_jobs(self):
+        for job_id in list(self._jobs):
+            if len(self._jobs) < self.max_jobs:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+
+    def _publish(self, job, event, data):
+        if self.publish is None:
+            return
+        data = json_encode(dict(data, job=job.id), cls=JSONExtendedEncoder)
+        self.publish(f"event: job_{event}\ndata: {data}\n\n")
+
+
+# Server-sent events ---------------------------------------------------
+
+
+def _upstream_sse_stream():
+    from yunohost.utils.sse import sse_stream
+
+    return sse_stream()
+
+
+class _SSEHub:
+    """Fan out a stream of server-sent events to many clients
+
+    A single producer thread - a greenlet once gevent has patched the
+    standard library - reads the upstream stream and appends its messages,
+    as well as the published ones, to a bounded ring buffer where each one
+    gets an increasing id. Every client reads the buffer from its own
+    cursor, so that a slow client never blocks the others: when it falls
+    behind the buffer, it gets a 'lagged' event with the number of dropped
+    messages and goes on with the oldest one kept. Clients may resume from
+    the id of the last message they got, and heartbeat comments keep idle
+    connections open.
+
+    Keyword arguments:
+        - source -- A callable returning the upstream iterator of messages,
+            or None to only fan out published messages
+        - size -- The number of messages kept in the buffer
+        - heartbeat -- The time period in seconds after which an idle client
+            gets a heartbeat comment
+
+    """
+
+    def __init__(self, source=_upstream_sse_stream, size=1000, heartbeat=15):
+        self.source = source
+        self.heartbeat = heartbeat
+
+        self.subscribers = 0
+        self._buffer = deque(maxlen=size)  # deque((id, message))
+        self._next_id = 1
+        self._producing = False
+        # The condition is created on first use so that it is the one of
+        # gevent once the server is running
+        self._condition = None
+
+    def publish(self, message):
+        """Append a message to the buffer and wake up the clients"""
+        if self._condition is None:
+            # Nobody has subscribed yet
+            return
+        with self._condition:
+            self._buffer.append((self._next_id, message))
+            self._next_id += 1
+            self._condition.notify_all()
+
+    def subscribe(self, last_event_id=None):
+        """Yield the messages of the stream for a client
+
+        Keyword arguments:
+            - last_event_id -- The id of the last message the client got,
+                to resume from the next one
+
+        """
+        if self._condition is None:
+            self._condition = Condition()
+
+        with self._condition:
+            if not self._producing and self.source is not None:
+                self._producing = True
+                Thread(target=self._produce, daemon=True).start()
+            cursor = self._next_id
+            if last_event_id is not None and last_event_id < self._next_id:
+                cursor = last_event_id + 1
+            self.subscribers += 1
+
+        try:
+            while True:
+                with self._condition:
+                    if cursor >= self._next_id:
+                        self._condition.wait(self.heartbeat)
+                    messages, dropped = self._read(cursor)
+
+                if dropped:
+                    yield f"event: lagged\ndata: {json_encode({'dropped': dropped})}\n\n"
+                if not messages:
+                    yield ": heartbeat\n\n"
+                    continue
+                for event_id, message in messages:
+                    yield f"id: {event_id}\n{message}"
+                cursor = messages[-1][0] + 1
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+    def _read(self, cursor):
+        oldest = self._buffer[0][0] if self._buffer else self._next_id
+        dropped = max(oldest - cursor, 0)
+        start = max(cursor - oldest, 0)
+        return list(islice(self._buffer, start, None)), dropped
+
+    def _produce(self):
+        try:
+            for message in self.source():
+                self.publish(message)
+        except Exception:
+            logger.exception("the upstream stream of server-sent events failed")
+        finally:
+            with self._condition:
+                self._producing = False
+
+
+# WebSocket ------------------------------------------------------------
+
+
+class _WebSocketCall:
+    """An action called through a WebSocket connection
+
+    Its log records and displayed messages are sent as they happen, like
+    its result once it is done.
+
+    Keyword arguments:
+        - id -- The identifier of the call given by the client
+        - send -- A callable to send a message to the client
+
+    """
+
+    def __init__(self, id, send):
+        self.id = id
+        self.send = send
+
+    def log(self, level, message):
+        self.send({"id": self.id, "type": "log", "level": level, "message": message})
+
+    def result(self, result):
+        self.send({"id": self.id, "type": "result", "result": result})
+
+    def error(self, status, error):
+        self.send({"id": self.id, "type": "error", "status": status, "error": error})
+
+
+# Admission control ----------------------------------------------------
+
+
+class _AdmissionController:
+    """Limit the number of actions processed concurrently
+
+    Actions are admitted while there are free slots overall and for their
+    class - i.e. whether they take the lock of the namespace or not. Other
+    requests wait in a bounded queue and are rejected with a '503 Service
+    Unavailable' response when it is full or when they have waited too
+    long, rather than piling up while waiting for the lock.
+
+    Keyword arguments:
+        - max_requests -- The maximum number of actions processed at once
+        - max_locking_requests -- The maximum number of actions taking the
+            lock processed at once
+        - max_lock_free_requests -- The maximum number of actions not
+            taking the lock processed at once
+        - max_waiting_requests -- The maximum number of requests waiting
+            to be admitted
+        - queue_timeout -- The time period in seconds a request waits to
+            be admitted before being rejected
+        - retry_after -- The time period in seconds clients are told to
+            wait before retrying a rejected request
+
+    Limits set to None are not enforced.
+
+    """
+
+    def __init__(
+        self,
+        max_requests=None,
+        max_locking_requests=None,
+        max_lock_free_requests=None,
+        max_waiting_requests=100,
+        queue_timeout=30,
+        retry_after=5,
+    ):
+        self.limits = {
+            "all": max_requests,
+            "locking": max_locking_requests,
+            "lock_free": max_lock_free_requests,
+        }
+        self.max_waiting_requests = max_waiting_requests
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        # Semaphores are created on first use so that they are the ones
+        # of gevent once the server is running
+        self._slots = None
+        self.in_flight = dict.fromkeys(self.limits, 0)
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @contextmanager
+    def admit(self, locking):
+        """Wait for a slot to process an action or raise a 503 response
+
+        Keyword arguments:
+            - locking -- True if the action takes the lock of the namespace
+
+        """
+        if self._slots is None:
+            self._slots = {
+                key: Semaphore(limit)
+                for key, limit in self.limits.items()
+                if limit is not None
+            }
+
+        keys = ["all", "locking" if locking else "lock_free"]
+        acquired = []
+        try:
+            for key in keys:
+                slots = self._slots.get(key)
+                if slots is not None and not slots.acquire(blocking=False):
+                    self._wait(slots)
+                acquired.append(key)
+                self.in_flight[key] += 1
+            self.admitted += 1
+            yield
+        finally:
+            for key in acquired:
+                self.in_flight[key] -= 1
+                if key in self._slots:
+                    self._slots[key].release()
+
+    def _wait(self, slots):
+        if self.waiting >= self.max_waiting_requests:
+            self.rejected += 1
+            raise self._unavailable()
+
+        self.waiting += 1
+        try:
+            admitted = slots.acquire(timeout=self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        if not admitted:
+            self.timed_out += 1
+            raise self._unavailable()
+
+    def _unavailable(self):
+        logger.warning("too many requests, rejecting one (%d waiting)", self.waiting)
+        return HTTPResponse(
+            json_encode({"error": m18n.g("server_busy"), **self.stats()}),
+            503,
+            headers={
+                "Content-type": "application/json",
+                "Retry-After": str(self.retry_after),
+            },
+        )
+
+    def stats(self):
+        """Return the counters of the admission control"""
+        return {
+            "in_flight": dict(self.in_flight),
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+# Single-flight --------------------------------------------------------
+
+
+class _SingleFlight:
+    """Coalesce identical calls made concurrently
+
+    The first call for a key is processed while the identical ones made
+    meanwhile wait for its result - or its error - instead of being
+    processed too. The calls are kept in a plain dict which is updated
+    without locking since requests are processed by greenlets.
+
+    """
+
+    def __init__(self):
+        self._calls = {}  # dict({key: _SingleFlightCall})
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Call a function unless an identical call is in flight
+
+        Return a 2-tuple (result, shared) where shared is True if the
+        result is the one of an identical call in flight.
+
+        Keyword arguments:
+            - key -- The key identifying identical calls
+            - func -- The function to call
+
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        call = self._calls[key] = _SingleFlightCall()
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _SingleFlightCall:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        # Created on use so that it is the one of gevent once it is running
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+# Idempotency ----------------------------------------------------------
+
+
+class _IdempotencyKeyReused(Exception):
+    """An idempotency key was given with another request"""
+
+
+class _IdempotencyStore:
+    """Remember the responses of the requests made with an idempotency key
+
+    A request retried with the same key waits for the first one if it is
+    still in flight, or else gets its stored response, instead of being
+    processed again. Keys are stored along with a fingerprint of their
+    request so that a key reused with another request is rejected. Like
+    the other caches, the store is local to the worker process.
+
+    Keyword arguments:
+        - max_size -- The maximum number of completed keys to store
+        - ttl -- The time in seconds during which a completed key is stored
+
+    """
+
+    def __init__(self, max_size=1024, ttl=24 * 3600):
+        # dict({key: (fingerprint, response)})
+        self._responses = _TTLCache(max_size, ttl)
+        self._calls = {}  # dict({key: (fingerprint, _SingleFlightCall)})
+        self.replayed = 0
+
+    def do(self, key, fingerprint, func, *args, **kwargs):
+        """Call a function unless it has been called with the key
+
+        The function returns the response as a 3-tuple (status, headers,
+        body), which is stored unless it is a server error - so that the
+        request can be retried then. Return a 2-tuple (response, replayed)
+        where replayed is True if the response is the one of a previous
+        call.
+
+        Keyword arguments:
+            - key -- The idempotency key of the request
+            - fingerprint -- The fingerprint of the request
+            - func -- The function to call
+
+        """
+        stored = self._responses.get(key)
+        if stored is None:
+            stored = self._calls.get(key)
+        if stored is not None:
+            stored_fingerprint, ret = stored
+            if stored_fingerprint != fingerprint:
+                raise _IdempotencyKeyReused(key)
+            if isinstance(ret, _SingleFlightCall):
+                ret.done.wait()
+                if ret.error is not None:
+                    raise ret.error
+                ret = ret.result
+            self.replayed += 1
+            return ret, True
+
+        call = _SingleFlightCall()
+        self._calls[key] = (fingerprint, call)
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
+        if call.result[0] < 500:
+            self._responses.set(key, (fingerprint, call.result))
+        return call.result, False
+
+    def __len__(self):
+        return len(self._responses) + len(self._calls)
+
+
+# Metrics --------------------------------------------------------------
+
+# Upper bounds in seconds of the buckets of the duration histograms
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Metrics:
+    """Collect metrics of the API and render them in the Prometheus format
+
+    Metrics are kept in plain dicts which are updated without locking since
+    requests are processed by greenlets. When several worker processes
+    serve the API, each one dumps its metrics in a directory shared with
+    the others - periodically and on exit - and the metrics of all the
+    processes are summed up when rendered.
+
+    Keyword arguments:
+        - directory -- The directory shared by the worker processes, or
+            None if there is a single process
+        - dump_interval -- The time period in seconds between two dumps
+
+    """
+
+    descriptions = {
+        "moulinette_requests_total": (
+            "counter",
+            "Requests processed by route and status",
+        ),
+        "moulinette_request_duration_seconds": (
+            "histogram",
+            "Time spent processing requests by route",
+        ),
+        "moulinette_authentication_duration_seconds": (
+            "histogram",
+            "Time spent verifying sessions",
+        ),
+        "moulinette_serialization_duration_seconds": (
+            "histogram",
+            "Time spent formatting results for the response",
+        ),
+        "moulinette_lock_wait_seconds": (
+            "histogram",
+            "Time spent waiting for the lock of the namespace",
+        ),
+        "moulinette_lock_hold_seconds": (
+            "histogram",
+            "Time the lock of the namespace has been held",
+        ),
+        "moulinette_requests_in_flight": (
+            "gauge",
+            "Requests being processed",
+        ),
+        "moulinette_admission_waiting_requests": (
+            "gauge",
+            "Requests waiting to be admitted",
+        ),
+        "moulinette_admission_rejected_total": (
+            "counter",
+            "Requests rejected by the admission control by reason",
+        ),
+        "moulinette_single_flight_coalesced_total": (
+            "counter",
+            "Requests served by an identical request in flight by route",
+        ),
+        "moulinette_idempotent_replays_total": (
+            "counter",
+            "Requests served the response of a previous one by route",
+        ),
+        "moulinette_process_resident_memory_bytes": (
+            "gauge",
+            "Resident memory size of the server processes",
+        ),
+    }
+
+    def __init__(self, directory=None, dump_interval=5):
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self.admission = None
+
+        self.counters = {}  # dict({(name, labels): value})
+        self.histograms = {}  # dict({(name, labels): [counts per bucket, sum]})
+        self.in_flight = 0
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # The last bucket is +Inf and is followed by the sum
+            histogram = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+        histogram[bisect_left(METRICS_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def track(self, route, callback, *args, **kwargs):
+        """Call a route callback and record its status and duration"""
+        start = time.perf_counter()
+        status = 500
+        self.in_flight += 1
+        try:
+            ret = callback(*args, **kwargs)
+            if isinstance(ret, HTTPResponse):
+                status = ret.status_code
+            else:
+                status = response.status_code
+            return ret
+        except HTTPResponse as e:
+            status = e.status_code
+            raise
+        finally:
+            self.in_flight -= 1
+            labels = (("route", route),)
+            self.inc("moulinette_requests_total", labels + (("status", status),))
+            self.observe(
+                "moulinette_request_duration_seconds",
+                time.perf_counter() - start,
+                labels,
+            )
+
+    def snapshot(self):
+        """Return the metrics of the current process as a dict"""
+        import psutil
+
+        counters = list(self.counters.items())
+        gauges = [
+            (("moulinette_requests_in_flight", ()), self.in_flight),
+            (
+                ("moulinette_process_resident_memory_bytes", (("pid", os.getpid()),)),
+                psutil.Process().memory_info().rss,
+            ),
+        ]
+        if self.admission is not None:
+            stats = self.admission.stats()
+            gauges.append(
+                (("moulinette_admission_waiting_requests", ()), stats["waiting"])
+            )
+            for reason in ("rejected", "timed_out"):
+                key = ("moulinette_admission_rejected_total", (("reason", reason),))
+                counters.append((key, stats[reason]))
+
+        def entries(items):
+            return [[name, list(labels), value] for (name, labels), value in items]
+
+        return {
+            "counters": entries(counters),
+            "histograms": entries(self.histograms.items()),
+            "gauges": entries(gauges),
+        }
+
+    # Worker processes
+
+    def dump(self):
+        """Write the metrics of the current process to the shared directory"""
+        path = os.path.join(self.directory, "%d.json" % os.getpid())
+        with open(path + ".tmp", "w") as f:
+            f.write(json_encode(self.snapshot()))
+        os.replace(path + ".tmp", path)
+
+    def dump_periodically(self):
+        while True:
+            time.sleep(self.dump_interval)
+            try:
+                self.dump()
+            except OSError as e:
+                logger.warning("unable to dump the metrics: %s", e)
+
+    def retire(self, pid):
+        """Keep the counters of a worker process which has exited
+
+        Its counters and histograms are added to the ones of all the exited
+        processes, while its gauges are dropped.
+
+        """
+        path = os.path.join(self.directory, "%d.json" % pid)
+        exited_path = os.path.join(self.directory, "exited.json")
+        try:
+            with open(path) as f:
+                snapshots = [json_load(f)]
+        except (OSError, ValueError):
+            return
+        if os.path.exists(exited_path):
+            with open(exited_path) as f:
+                snapshots.append(json_load(f))
+
+        exited = self._merge(snapshots)
+        exited["gauges"] = []
+        with open(exited_path + ".tmp", "w") as f:
+            f.write(json_encode(exited))
+        os.replace(exited_path + ".tmp", exited_path)
+        os.unlink(path)
+
+    # Rendering
+
+    def render(self):
+        """Render the metrics of all the processes in the text format"""
+        snapshots = [self.snapshot()]
+        if self.directory is not None:
+            own = "%d.json" % os.getpid()
+            for filename in os.listdir(self.directory):
+                if filename == own or not filename.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        snapshots.append(json_load(f))
+                except (OSError, ValueError):
+                    continue
+        metrics = self._merge(snapshots)
+
+        lines = []
+        described = set()
+        for kind in ("counters", "gauges", "histograms"):
+            for name, labels, value in sorted(metrics.get(kind, []), key=str):
+                if name not in described:
+                    described.add(name)
+                    metric_type, description = self.descriptions[name]
+                    lines.append(f"# HELP {name} {description}")
+                    lines.append(f"# TYPE {name} {metric_type}")
+                if kind != "histograms":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                bounds = [f"{b}" for b in METRICS_BUCKETS] + ["+Inf"]
+                for bound, count in zip(bounds, value[:-1]):
+                    cumulative += count
+                    le = self._labels(labels + [["le", bound]])
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _merge(snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for kind, entries in snapshot.items():
+                values = merged.setdefault(kind, {})
+                for name, labels, value in entries:
+                    key = (name, tuple(tuple(label) for label in labels))
+                    if key not in values:
+                        values[key] = value
+                    elif kind == "histograms":
+                        values[key] = [a + b for a, b in zip(values[key], value)]
+                    else:
+                        values[key] += value
+        return {
+            kind: [
+                [name, [list(label) for label in labels], value]
+                for (name, labels), value in values.items()
+            ]
+            for kind, values in merged.items()
+        }
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        escaped = (
+            (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+# Access log -----------------------------------------------------------
+
+
+class _AccessLog:
+    """Write a record of each request to a file in the JSON Lines format
+
+    Request greenlets only append their records to an in-memory queue,
+    which a dedicated system thread - even once gevent has patched the
+    standard library - writes to the file in batches, so that logging never
+    blocks the gevent hub. The oldest records are dropped if the writer
+    falls behind by more than 'queue_size' records.
+
+    The file is rotated once it exceeds 'max_size', keeping 'backups'
+    former files suffixed with '.1', '.2', ... Worker processes append to
+    the same file, and reopen it once another one has rotated it.
+
+    Keyword arguments:
+        - path -- The path of the file
+        - max_size -- The size in bytes above which the file is rotated
+        - backups -- The number of rotated files to keep
+        - queue_size -- The maximum number of records waiting to be written
+        - flush_interval -- The time period in seconds between two writes
+
+    """
+
+    def __init__(
+        self,
+        path,
+        max_size=10 * 1024 * 1024,
+        backups=5,
+        queue_size=10000,
+        flush_interval=1,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.flush_interval = flush_interval
+
+        self._queue = deque(maxlen=queue_size)
+        self._file = None
+        self._writer = None
+        self._stopping = False
+
+    def track(self, r, route, start):
+        """Record the access of the current request
+
+        The record is queued once the response body has been sent if it is
+        streamed, or else right away. Return the response, whose body may
+        be wrapped to count the bytes sent.
+
+        Keyword arguments:
+            - r -- The value returned by the route callback
+            - route -- The route of the request, e.g. 'GET /users/<user>'
+            - start -- The performance counter value when it started
+
+        """
+        resp = r if isinstance(r, HTTPResponse) else response
+        body = r.body if isinstance(r, HTTPResponse) else r
+        environ = request.environ
+        timings = environ.get("moulinette.timings") or {}
+        tid = environ.get("moulinette.tid")
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "method": environ["REQUEST_METHOD"],
+            "path": environ.get("PATH_INFO") or "/",
+            "route": route,
+            "tid": ".".join(tid) if tid is not None else None,
+            "status": resp.status_code,
+            "bytes": None,
+            "latency": None,
+            "lock_wait": timings.get("lock_wait"),
+            "user": environ.get("moulinette.user"),
+        }
+
+        length = resp.get_header("Content-Length")
+        if length is not None:
+            entry["bytes"] = int(length)
+        elif isinstance(body, bytes):
+            entry["bytes"] = len(body)
+        elif isinstance(body, str):
+            entry["bytes"] = len(body) if body.isascii() else len(body.encode())
+        elif body is None:
+            entry["bytes"] = 0
+        elif isinstance(body, Iterator) and not hasattr(body, "read"):
+            body = self._count(body, entry, start)
+            if isinstance(r, HTTPResponse):
+                r.body = body
+                return r
+            return body
+
+        entry["latency"] = time.perf_counter() - start
+        self.record(entry)
+        return r
+
+    def _count(self, body, entry, start):
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            entry["bytes"] = size
+            entry["latency"] = time.perf_counter() - start
+            self.record(entry)
+
+    def record(self, entry):
+        """Queue a record to be written"""
+        self._queue.append(entry)
+
+    def flush(self):
+        """Write the queued records to the file"""
+        queue = self._queue
+        lines = []
+        while queue:
+            lines.append(json_encode(queue.popleft(), cls=JSONExtendedEncoder))
+        if not lines:
+            return
+
+        data = ("\n".join(lines) + "\n").encode()
+        try:
+            size = self._open()
+            if size and size + len(data) > self.max_size:
+                self._rotate()
+                size = self._open()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            logger.warning("unable to write the access log '%s': %s", self.path, e)
+
+    def start(self):
+        """Start writing the queued records periodically"""
+        self._stopping = False
+        self._writer = system_thread_pool(1)
+        self._writer.submit(self._write_periodically)
+
+    def stop(self):
+        """Write the records left and stop the writer"""
+        if self._writer is not None:
+            self._stopping = True
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_periodically(self):
+        while not self._stopping:
+            self.flush()
+            time.sleep(self.flush_interval)
+
+    def _open(self):
+        """Open the file unless it is still the one at its path
+
+        Return its size.
+
+        """
+        if self._file is not None:
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            st = os.fstat(self._file.fileno())
+            if st.st_ino == current:
+                return st.st_size
+            # Rotated by another process
+            self._file.close()
+            self._file = None
+
+        self._file = open(self.path, "ab")
+        return os.fstat(self._file.fileno()).st_size
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+# Diagnostics ----------------------------------------------------------
+
+
+class _Diagnostics:
+    """Report what the server process is busy with
+
+    The requests being processed are kept in a table along with the
+    greenlet processing them. Once started, the time each greenlet has been
+    running is measured on each switch, and if 'max_blocking_time' is set a
+    monitor thread logs the stack of the greenlet which blocks the gevent
+    hub - and its request - whenever it does not switch for longer.
+
+    Keyword arguments:
+        - namespace -- The namespace whose lock holder is reported
+        - max_blocking_time -- The time in seconds after which the blocked
+            gevent hub is reported, or None
+
+    """
+
+    def __init__(self, namespace, max_blocking_time=None):
+        self.namespace = namespace
+        self.max_blocking_time = max_blocking_time
+        self.requests = {}  # dict({id(environ): (environ, start, greenlet)})
+        self.run_times = None  # WeakKeyDictionary({greenlet: seconds})
+
+        self._previous_trace = None
+        self._switched_at = None
+        self._switches = 0
+        self._active = None
+        self._hub = None
+        self._thread_ident = None
+        self._monitor = None
+        self._stopping = False
+
+    def track(self, callback, *args, **kwargs):
+        """Call a route callback and keep its request in the table"""
+        from greenlet import getcurrent
+
+        environ = request.environ
+        key = id(environ)
+        self.requests[key] = (environ, time.perf_counter(), getcurrent())
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            del self.requests[key]
+
+    def start(self):
+        """Measure the run time of the greenlets and monitor the hub"""
+        import greenlet
+        import threading
+        from weakref import WeakKeyDictionary
+
+        self._hub = None
+        self._thread_ident = threading.get_ident()
+        try:
+            from gevent import get_hub, monkey
+        except ImportError:
+            pass
+        else:
+            if monkey.is_module_patched("threading"):
+                self._hub = get_hub()
+                self._thread_ident = self._hub.thread_ident
+
+        self.run_times = WeakKeyDictionary()
+        self._switched_at = time.perf_counter()
+        self._active = greenlet.getcurrent()
+        self._previous_trace = greenlet.settrace(self._trace)
+
+        if self.max_blocking_time is not None:
+            self._stopping = False
+            self._monitor = system_thread_pool(1)
+            self._monitor.submit(self._monitor_hub)
+
+    def stop(self):
+        import greenlet
+
+        if self._monitor is not None:
+            self._stopping = True
+            self._monitor.shutdown(wait=True)
+            self._monitor = None
+        if self.run_times is not None:
+            greenlet.settrace(self._previous_trace)
+            self.run_times = None
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            origin, target = args
+            now = time.perf_counter()
+            self.run_times[origin] = (
+                self.run_times.get(origin, 0) + now - self._switched_at
+            )
+            self._switched_at = now
+            self._active = target
+            self._switches += 1
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _monitor_hub(self):
+        import traceback
+
+        reported = None
+        while not self._stopping:
+            time.sleep(self.max_blocking_time / 2)
+            switches, active = self._switches, self._active
+            blocked = time.perf_counter() - self._switched_at
+            if (
+                blocked < self.max_blocking_time
+                or switches == reported
+                or active is self._hub
+            ):
+                continue
+            reported = switches
+
+            blocking = "unknown request"
+            for environ, start, glet in list(self.requests.values()):
+                if glet is active:
+                    blocking = self._describe_request(environ, start)
+            frame = sys._current_frames().get(self._thread_ident)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logger.warning(
+                "the event loop has been blocked for %.3fs by %r, processing %s:\n%s",
+                blocked,
+                active,
+                blocking,
+                stack.rstrip(),
+            )
+
+    @staticmethod
+    def _describe_request(environ, start):
+        tid = environ.get("moulinette.tid")
+        timings = environ.get("moulinette.timings") or {}
+        description = "%s %s" % (environ["REQUEST_METHOD"], environ["PATH_INFO"])
+        if tid is not None:
+            description += " (%s)" % ".".join(tid)
+        description += " for %.3fs" % (time.perf_counter() - start)
+        if "lock_wait" in timings and "lock_hold" not in timings:
+            description += ", holding the lock"
+        return description
+
+    def report(self):
+        """Return a report of the process as text
+
+        It gives the holder of the lock, the requests being processed, the
+        run time of the greenlets and the stacks of all the threads and
+        greenlets.
+
+        """
+        import gc
+        import threading
+        import traceback
+        from greenlet import greenlet, getcurrent
+
+        lines = [f"Process {os.getpid()}", ""]
+
+        holders = MoulinetteLock(self.namespace).holders()
+        if holders:
+            holders = ", ".join(str(pid) for pid in holders)
+            lines.append(f"Lock of '{self.namespace}' held by process {holders}")
+        else:
+            lines.append(f"Lock of '{self.namespace}' free")
+        lines.append("")
+
+        requests = list(self.requests.values())
+        lines.append(f"{len(requests)} request(s) being processed:")
+        for environ, start, glet in requests:
+            lines.append(f"  {self._describe_request(environ, start)} in {glet!r}")
+        lines.append("")
+
+        if self.run_times is not None:
+            lines.append("Run time of the greenlets:")
+            run_times = sorted(self.run_times.items(), key=lambda i: -i[1])
+            for glet, run_time in run_times:
+                lines.append(f"  {run_time:.6f}s {glet!r}")
+            lines.append("")
+
+        # The locals of the greenlets are not rendered - as gevent does -
+        # since those of Bottle can't be inspected from another greenlet
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            lines.append(f"Thread {ident:#x} ({names.get(ident)}):")
+            lines.append("".join(traceback.format_stack(frame)).rstrip())
+            lines.append("")
+        for glet in gc.get_objects():
+            if not isinstance(glet, greenlet) or glet is getcurrent():
+                continue
+            if glet.gr_frame is not None:
+                lines.append(f"Greenlet {glet!r}:")
+                lines.append("".join(traceback.format_stack(glet.gr_frame)).rstrip())
+                lines.append("")
+
+        return "\n".join(lines)
+
+    def log_report(self, *args):
+        """Log the report of the process, e.g. on SIGUSR1"""
+        logger.warning("diagnostics report:\n%s", self.report())
 
-CSRF_TYPES = {"text/plain", "application/x-www-form-urlencoded", "multipart/form-data"}
 
+# Pre-fork server ------------------------------------------------------
 
-def is_csrf():
-    """Checks is this is a CSRF request."""
 
-    if request.method != "POST":
-        return False
-    if request.content_type is None:
-        return True
-    content_type = request.content_type.lower().split(";")[0]
-    if content_type not in CSRF_TYPES:
-        return False
+class _CacheGeneration:
+    """Keep process-local caches coherent across worker processes
 
-    return request.headers.get("X-Requested-With") is None
+    A counter is shared by all the processes forked after its creation.
+    Bumping it from any of them makes each process clear its registered
+    caches the next time it syncs, i.e. before handling a request.
 
+    Keyword arguments:
+        - caches -- A list of caches, i.e. objects with a clear() method
 
-# Protection against CSRF
-def filter_csrf(callback):
-    def wrapper(*args, **kwargs):
-        if is_csrf():
-            abort(403, "CSRF protection")
-        else:
-            return callback(*args, **kwargs)
+    """
 
-    return wrapper
+    def __init__(self, caches=[]):
+        self.caches = list(caches)
+        self._value = multiprocessing.Value("Q", 0)
+        self._seen = 0
 
+    def bump(self):
+        with self._value.get_lock():
+            self._value.value += 1
 
-class _HTTPArgumentParser:
-    """Argument parser for HTTP requests
+    def sync(self):
+        generation = self._value.value
+        if generation != self._seen:
+            self._seen = generation
+            for cache in self.caches:
+                cache.clear()
 
-    Object for parsing HTTP requests into Python objects. It is based
-    on ExtendedArgumentParser class and implements some of its methods.
 
-    """
+# The first file descriptor passed by systemd with socket activation
+SD_LISTEN_FDS_START = 3
 
-    def __init__(self):
-        # Initialize the ArgumentParser object
-        self._parser = ExtendedArgumentParser(
-            usage="", prefix_chars="@", add_help=False
-        )
-        self._parser.error = self._error
 
-        self._positional = []  # list(arg_name)
-        self._optional = {}  # dict({arg_name: option_strings})
-        self._upload_dir = None
+def systemd_listener():
+    """Return the socket passed by systemd with socket activation, if any
 
-    def set_defaults(self, **kwargs):
-        return self._parser.set_defaults(**kwargs)
+    The environment variables of the socket activation are removed so
+    that they are not inherited by child processes.
 
-    def get_default(self, dest):
-        return self._parser.get_default(dest)
+    """
+    try:
+        listen_pid = int(os.environ.pop("LISTEN_PID", ""))
+        listen_fds = int(os.environ.pop("LISTEN_FDS", ""))
+    except ValueError:
+        return None
+    finally:
+        os.environ.pop("LISTEN_FDNAMES", None)
+    if listen_pid != os.getpid() or listen_fds < 1:
+        return None
+    if listen_fds > 1:
+        logger.warning("only the first of the %d sockets passed is served", listen_fds)
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+def unix_listener(path, mode=0o660):
+    """Listen on a Unix domain socket
+
+    A socket file left by a previous server instance is replaced, unless
+    the instance is still running. The socket file is created with its
+    permissions by setting the umask of the process meanwhile, so that
+    it is never accessible with other ones.
 
-    def add_arguments(
-        self, arguments, extraparser, format_arg_names=None, validate_extra=True
-    ):
-        for argument_name, argument_options in arguments.items():
-            # will adapt arguments name for cli or api context
-            names = format_arg_names(
-                str(argument_name), argument_options.pop("full", None)
-            )
+    Keyword arguments:
+        - path -- The path of the socket file
+        - mode -- The permissions of the socket file
 
-            if "type" in argument_options:
-                argument_options["type"] = eval(argument_options["type"])
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(path) == 0:
+                    raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+            os.remove(path)
+    except FileNotFoundError:
+        pass
 
-            if "extra" in argument_options:
-                extra = argument_options.pop("extra")
-                argument_dest = self.add_argument(*names, **argument_options).dest
-                extraparser.add_argument(
-                    self.get_default("_tid"), argument_dest, extra, validate_extra
-                )
-                continue
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        umask = os.umask(~mode & 0o777)
+        try:
+            listener.bind(path)
+        finally:
+            os.umask(umask)
+        listener.listen(1024)
+    except OSError:
+        listener.close()
+        raise
+    return listener
 
-            self.add_argument(*names, **argument_options)
 
-    def add_argument(self, *args, **kwargs):
-        action = self._parser.add_argument(*args, **kwargs)
+class _GeventSocketServer(GeventServer):
+    """Gevent server adapter serving an already listening socket"""
 
-        # Append newly created action
-        if len(action.option_strings) == 0:
-            self._positional.append(action)
+    def __init__(self, listener, **options):
+        address = listener.getsockname()
+        if isinstance(address, tuple):
+            host, port = address[:2]
         else:
-            self._optional[action.dest] = action
+            # The address of a Unix domain socket is its path
+            host, port = address, 0
+        super().__init__(host, port, **options)
+        self.listener = listener
 
-        return action
+    def run(self, handler):
+        from gevent import pywsgi, socket as gsocket
 
-    def parse_args(self, args={}, namespace=None):
-        arg_strings = []
+        # Hand the socket over to gevent so that it is not blocking
+        listener = gsocket.socket(fileno=self.listener.detach())
+        server = pywsgi.WSGIServer(listener, handler, **self.options)
+        # Finish the requests in progress before exiting
+        signal.signal(signal.SIGTERM, lambda s, f: server.stop(timeout=10))
+        server.serve_forever()
 
-        # Append an argument to the current one
-        def append(arg_strings, value, action):
-            option_string = None
-            if len(action.option_strings) > 0:
-                option_string = action.option_strings[0]
 
-            if isinstance(value, bool) or isinstance(action.const, bool):
-                # Append the option string only
-                if option_string is not None and value != 0:
-                    arg_strings.append(option_string)
-            elif isinstance(value, FileUpload) and (
-                isinstance(action.type, argparse.FileType) or action.type == open
-            ):
-                # Upload the file in a temp directory
-                global UPLOAD_DIR
-                if UPLOAD_DIR is None:
-                    UPLOAD_DIR = mkdtemp(prefix="moulinette_upload_")
-                value.save(UPLOAD_DIR)
-                if option_string is not None:
-                    arg_strings.append(option_string)
-                arg_strings.append(UPLOAD_DIR + "/" + value.filename)
-            elif isinstance(value, str):
-                if option_string is not None:
-                    arg_strings.append(option_string)
-                    # TODO: Review this fix
-                    if value:
-                        arg_strings.append(value)
-                else:
-                    arg_strings.append(value)
-            elif isinstance(value, list):
-                if option_string is not None:
-                    arg_strings.append(option_string)
-                for v in value:
-                    if isinstance(v, str):
-                        arg_strings.append(v)
-                    else:
-                        logger.warning(
-                            "unsupported argument value type %r "
-                            "in %s for option string %s",
-                            v,
-                            value,
-                            option_string,
-                        )
-            else:
-                logger.warning(
-                    "unsupported argument type %r for option " "string %s",
-                    value,
-                    option_string,
-                )
+class _WorkerPool:
+    """Fork and supervise the worker processes of the server
 
-            return arg_strings
+    Worker processes which exit are restarted until the pool is stopped,
+    i.e. when the master process receives SIGTERM or SIGINT.
 
-        # Iterate over positional arguments
-        for action in self._positional:
-            if action.dest in args:
-                arg_strings = append(arg_strings, args[action.dest], action)
+    Keyword arguments:
+        - serve -- The function to run in each worker process
+        - workers -- The number of worker processes
+        - on_exit -- A function called with the PID of each worker process
+            which has exited
+        - forward -- A list of signals which the master process forwards
+            to the worker processes
 
-        # Iterate over optional arguments
-        for dest, action in self._optional.items():
-            if dest in args:
-                arg_strings = append(arg_strings, args[dest], action)
+    """
 
-        return self._parser.parse_args(arg_strings, namespace)
+    # Minimum lifetime in seconds of a worker process below which its
+    # restart is delayed, so that a failing worker doesn't loop
+    restart_delay = 1
+
+    def __init__(self, serve, workers, on_exit=None, forward=[]):
+        self.serve = serve
+        self.workers = workers
+        self.on_exit = on_exit
+        self.forward = list(forward)
+        self.pids = {}  # dict({pid: start time})
+        self._stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            for sig in [signal.SIGTERM, signal.SIGINT] + self.forward:
+                signal.signal(sig, signal.SIG_DFL)
+            status = 0
+            try:
+                self.serve()
+            except BaseException:
+                logger.exception("worker process %d failed", os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+
+        logger.debug("worker process %d started", pid)
+        self.pids[pid] = time.monotonic()
+        return pid
+
+    def stop(self, *args):
+        self._stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, sig, *args):
+        for pid in self.pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
 
-    def _error(self, message):
-        raise MoulinetteValidationError(message, raw_msg=True)
+    def run(self):
+        handlers = {
+            sig: signal.signal(sig, self.stop)
+            for sig in (signal.SIGTERM, signal.SIGINT)
+        }
+        for sig in self.forward:
+            handlers[sig] = signal.signal(sig, self.signal_workers)
+        try:
+            while len(self.pids) < self.workers:
+                self.spawn()
+
+            while self.pids:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                started = self.pids.pop(pid, None)
+                if started is None:
+                    continue
+                if self.on_exit is not None:
+                    self.on_exit(pid)
+                if self._stopping:
+                    continue
+
+                logger.warning(
+                    "worker process %d exited with code %d, restarting it",
+                    pid,
+                    os.waitstatus_to_exitcode(status),
+                )
+                if time.monotonic() - started < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                if not self._stopping:
+                    self.spawn()
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
 
 
 class _ActionsMapPlugin:
@@ -217,14 +2532,63 @@ class _ActionsMapPlugin:
 
     Keyword arguments:
         - actionsmap -- An ActionsMap instance
+        - jobs -- A _JobManager instance to process actions in background,
+            or None to disable the asynchronous mode
+        - upload_max_size -- The maximum size in bytes of the files uploaded
+            with a request, or None for no limit
+        - session_cache_size -- The maximum number of verified sessions to
+            cache for the authenticators which allow it
+        - admission -- An _AdmissionController instance to limit the number
+            of actions processed concurrently, or None for no limit
+        - metrics -- A _Metrics instance to collect metrics of the requests
+            and serve them on '/metrics', or None to disable metrics
+        - sse_hub -- The _SSEHub instance serving '/sse'
+        - single_flight -- A _SingleFlight instance to coalesce identical
+            lock-free GET requests, or None to process each of them
+        - diagnostics -- A _Diagnostics instance whose report is served on
+            '/diagnostics', or None
+        - idempotency -- An _IdempotencyStore instance to deduplicate the
+            requests to lock-taking routes retried with the same
+            'Idempotency-Key' header, or None to process each of them
+        - caches -- The _CacheGeneration shared with the other worker
+            processes, bumped when a session is forgotten so that they
+            forget it too, or None
 
     """
 
     name = "actionsmap"
     api = 2
 
-    def __init__(self, actionsmap):
-        self.actionsmap = actionsmap
+    def __init__(
+        self,
+        actionsmap,
+        jobs=None,
+        upload_max_size=None,
+        session_cache_size=1024,
+        admission=None,
+        metrics=None,
+        sse_hub=None,
+        single_flight=None,
+        diagnostics=None,
+        idempotency=None,
+        caches=None,
+    ):
+        self.router = _ActionsMapRouter(actionsmap, {})
+        self.diagnostics = diagnostics
+        self.idempotency = idempotency
+        self.single_flight = single_flight
+        self.jobs = jobs
+        self.admission = admission
+        self.metrics = metrics
+        self.sse_hub = sse_hub if sse_hub is not None else _SSEHub()
+        self.upload_max_size = upload_max_size
+        self.sessions = _TTLCache(session_cache_size)
+        self.caches = caches
+        if caches is not None:
+            caches.caches.append(self.sessions)
+        # The descriptions of the actions map served on '/actionsmap' as
+        # {(version, locale): (body, etag)}
+        self._descriptions = {}
 
     def setup(self, app):
         """Setup plugin on the application
@@ -235,6 +2599,7 @@ class _ActionsMapPlugin:
             - app -- The application instance
 
         """
+        self.app = app
 
         # Append authentication routes
         app.route(
@@ -242,7 +2607,8 @@ class _ActionsMapPlugin:
             name="login",
             method="POST",
             callback=self.login,
-            skip=[filter_csrf, "actionsmap"],
+            skip=["actionsmap"],
+            csrf=False,
         )
         app.route(
             "/logout",
@@ -260,9 +2626,134 @@ class _ActionsMapPlugin:
             skip=["actionsmap"],
         )
 
-        # Append routes from the actions map
-        for m, p in self.actionsmap.parser.routes:
+        app.route(
+            "/ws",
+            name="websocket",
+            method="GET",
+            callback=self.websocket,
+            skip=["actionsmap"],
+            same_origin=True,
+        )
+
+        app.route(
+            "/batch",
+            name="batch",
+            method="POST",
+            callback=self.batch,
+            skip=["actionsmap"],
+        )
+
+        # Neither the lock nor an authenticator is touched, for probes
+        app.route(
+            "/healthz",
+            name="healthz",
+            method="GET",
+            callback=self.healthz,
+            skip=["actionsmap"],
+        )
+
+        app.route(
+            "/actionsmap",
+            name="introspection",
+            method="GET",
+            callback=self.introspect,
+            skip=["actionsmap"],
+        )
+
+        if self.diagnostics is not None:
+            app.route(
+                "/diagnostics",
+                name="diagnostics",
+                method="GET",
+                callback=self.render_diagnostics,
+                skip=["actionsmap"],
+            )
+
+        if self.metrics is not None:
+            app.route(
+                "/metrics",
+                name="metrics",
+                method="GET",
+                callback=self.render_metrics,
+                skip=["actionsmap"],
+            )
+
+        # Append routes to follow the actions processed in background
+        if self.jobs is not None:
+            app.route(
+                "/jobs",
+                name="jobs",
+                method="GET",
+                callback=self.list_jobs,
+                skip=["actionsmap"],
+            )
+            app.route(
+                "/jobs/<job_id>",
+                name="job",
+                method="GET",
+                callback=self.job_status,
+                skip=["actionsmap"],
+            )
+            app.route(
+                "/jobs/<job_id>/result",
+                name="job_result",
+                method="GET",
+                callback=self.job_result,
+                skip=["actionsmap"],
+            )
+            app.route(
+                "/jobs/<job_id>/logs",
+                name="job_logs",
+                method="GET",
+                callback=self.job_logs,
+                skip=["actionsmap"],
+            )
+
+        # Append routes from the actions map, which are resolved by its own
+        # router unless their rule is not supported by it
+        actionsmap = self.router.state[0]
+        for m, p in actionsmap.parser.fallback_routes:
             app.route(p, method=m, callback=self.process)
+        self.reload(actionsmap)
+        self.router.install(app.router)
+
+    @property
+    def actionsmap(self):
+        """The actions map of the current request, or else the live one"""
+        try:
+            return request.environ["moulinette.actionsmap"]
+        except (KeyError, RuntimeError):
+            return self.router.state[0]
+
+    def reload(self, actionsmap):
+        """Replace the actions map whose routes are served
+
+        The requests being processed keep the actions map they have been
+        resolved with. Routes whose rule is not supported by the router of
+        the actions map are not reloaded.
+
+        Keyword arguments:
+            - actionsmap -- The new ActionsMap instance
+
+        """
+        current, current_routes = self.router.state
+        if actionsmap is not current:
+            # Keep the pools of the running executor
+            current.executor.declared.update(actionsmap.executor.declared)
+            actionsmap.executor = current.executor
+
+        routes = {}
+        for m, p in actionsmap.parser.routes:
+            if (m, p) not in actionsmap.parser.fallback_routes:
+                routes[(m, p)] = Route(self.app, p, m, self.process)
+        stale = set(current_routes.values())
+        self.app.routes[:] = [r for r in self.app.routes if r not in stale]
+        self.app.routes.extend(routes.values())
+
+        self.router.state = (actionsmap, routes)
+        if self.jobs is not None:
+            self.jobs.actionsmap = actionsmap
+        self._descriptions = {}
 
     def apply(self, callback, context):
         """Apply plugin to the route callback
@@ -282,18 +2773,31 @@ class _ActionsMapPlugin:
             return value
 
         def wrapper(*args, **kwargs):
+            timings = request.environ.get("moulinette.timings")
+            if timings is not None:
+                start = time.perf_counter()
+                timings["middleware"] = start - timings.pop("start")
+
             if request.get_header("Content-Type") == "application/json":
-                return callback((request.method, context.rule), request.json)
+                return callback((context.method, context.rule), request.json)
 
             params = kwargs
             # Format boolean params
             for a in args:
                 params[a] = True
 
+            spool = _UploadSpool(self.upload_max_size)
+            request.environ["moulinette.upload_spool"] = spool
+
             # Append other request params
-            req_params = list(request.params.dict.items())
-            # TODO test special chars in filename
-            req_params += list(request.files.dict.items())
+            if request.content_type.startswith("multipart/form-data"):
+                req_params = list(request.query.dict.items())
+                req_params += spool.read_multipart()
+            else:
+                spool.check_content_length()
+                req_params = list(request.params.dict.items())
+                # TODO test special chars in filename
+                req_params += list(request.files.dict.items())
             for k, v in req_params:
                 v = _format(v)
                 if k not in params.keys():
@@ -310,8 +2814,19 @@ class _ActionsMapPlugin:
                         curr_v.append(v)
                     params[k] = curr_v
 
+            if timings is not None:
+                timings["args"] = time.perf_counter() - start
+
             # Process the action
-            return callback((request.method, context.rule), params)
+            return callback((context.method, context.rule), params)
+
+        if self.metrics is not None:
+            route = f"{context.method} {context.rule}"
+
+            def tracked_wrapper(*args, **kwargs):
+                return self.metrics.track(route, wrapper, *args, **kwargs)
+
+            return tracked_wrapper
 
         return wrapper
 
@@ -358,6 +2873,7 @@ class _ActionsMapPlugin:
                 pass
             raise HTTPResponse(e.strerror, 401)
         else:
+            self.forget_session(authenticator)
             authenticator.set_session_cookie(auth_infos)
             referer = request.get_header("Referer")
             if "referer_redirect" in request.params and referer:
@@ -367,15 +2883,66 @@ class _ActionsMapPlugin:
 
     # This is called before each time a route is going to be processed
     def authenticate(self, authenticator):
+        if self.metrics is None:
+            return self._verify_session(authenticator)
+
+        start = time.perf_counter()
+        try:
+            return self._verify_session(authenticator)
+        finally:
+            self.metrics.observe(
+                "moulinette_authentication_duration_seconds",
+                time.perf_counter() - start,
+            )
+
+    def _verify_session(self, authenticator):
+        cache_key = self._session_cache_key(authenticator)
+        if cache_key is not None:
+            session_infos = self.sessions.get(cache_key)
+            if session_infos is not None:
+                self._set_user(session_infos)
+                return session_infos
+
         try:
             session_infos = authenticator.get_session_cookie()
         except Exception:
+            self.forget_session(authenticator)
             authenticator.delete_session_cookie()
             msg = m18n.g("authentication_required")
             raise HTTPResponse(msg, 401)
 
+        if cache_key is not None:
+            self.sessions.set(cache_key, session_infos, authenticator.session_cache_ttl)
+        self._set_user(session_infos)
         return session_infos
 
+    @staticmethod
+    def _session_cache_key(authenticator):
+        name = authenticator.session_cookie_name
+        if not name:
+            return None
+        return authenticator.get_session_cache_key(request.get_cookie(name))
+
+    @staticmethod
+    def _set_user(session_infos):
+        # Keep the user of the session for the access log
+        if isinstance(session_infos, dict):
+            request.environ["moulinette.user"] = session_infos.get("user")
+
+    def forget_session(self, authenticator):
+        """Remove the current session of an authenticator from the caches
+
+        The session is removed from the cache of this process, and those
+        of the other worker processes are cleared before they handle their
+        next request.
+
+        """
+        cache_key = self._session_cache_key(authenticator)
+        if cache_key is not None:
+            self.sessions.pop(cache_key)
+            if self.caches is not None:
+                self.caches.bump()
+
     def logout(self):
         profile = request.params.get("profile", self.actionsmap.default_authentication)
         authenticator = self.actionsmap.get_authenticator(profile)
@@ -386,6 +2953,7 @@ class _ActionsMapPlugin:
             raise HTTPResponse(m18n.g("not_logged_in"), 401)
         else:
             # Delete cookie and clean the session
+            self.forget_session(authenticator)
             authenticator.delete_session_cookie()
             referer = request.get_header("Referer")
             if "referer_redirect" in request.params and referer:
@@ -395,23 +2963,339 @@ class _ActionsMapPlugin:
 
     def sse(self):
 
-        profile = request.params.get("profile", self.actionsmap.default_authentication)
-        authenticator = self.actionsmap.get_authenticator(profile)
+        profile = request.params.get("profile", self.actionsmap.default_authentication)
+        authenticator = self.actionsmap.get_authenticator(profile)
+
+        # Hardcoded yunohost stuff for the SSE stream to not require authentication when postinstall isnt done yet...
+        if os.path.exists("/etc/yunohost/installed"):
+            try:
+                authenticator.get_session_cookie()
+            except MoulinetteAuthenticationError:
+                raise HTTPResponse(m18n.g("not_logged_in"), 401)
+
+        response.content_type = "text/event-stream"
+        response.cache_control = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+
+        try:
+            last_event_id = int(request.get_header("Last-Event-ID"))
+        except (TypeError, ValueError):
+            last_event_id = None
+
+        yield from self.sse_hub.subscribe(last_event_id)
+
+    def websocket(self):
+        """Process actions called through a WebSocket connection
+
+        Each message of the client is a JSON object calling an action with
+        an 'id' of its choice, a 'method', a 'path' and optional 'args'.
+        Actions are processed concurrently and each one answers with 'log'
+        messages as it goes and either a 'result' or an 'error' message,
+        all of them carrying the id of the call.
+
+        The session is verified once when the connection is opened, and
+        at most WEBSOCKET_MAX_CALLS actions are processed at once.
+
+        """
+        from geventwebsocket.exceptions import WebSocketError
+
+        wsock = request.environ.get("wsgi.websocket")
+        if wsock is None:
+            raise HTTPResponse(m18n.g("websocket_request_expected"), 400)
+
+        self.authenticate(
+            self.actionsmap.get_authenticator(self.actionsmap.default_authentication)
+        )
+        _capture_logs()
+
+        environ = request.environ
+        authenticated = {self.actionsmap.default_authentication}
+        sending = Semaphore()
+        calls = Semaphore(WEBSOCKET_MAX_CALLS)
+
+        def send(message):
+            with sending:
+                try:
+                    wsock.send(json_encode(message, cls=JSONExtendedEncoder))
+                except WebSocketError:
+                    logger.debug("the WebSocket connection is closed")
+
+        while True:
+            try:
+                data = wsock.receive()
+            except WebSocketError:
+                break
+            if data is None:
+                break
+
+            try:
+                message = json_decode(data)
+                call = _WebSocketCall(message.get("id"), send)
+            except (AttributeError, ValueError):
+                send({"type": "error", "status": 400, "error": "Invalid message"})
+                continue
+            calls.acquire()
+            # Run in a copy of the request context to keep its locale
+            Thread(
+                target=copy_context().run,
+                args=(
+                    self._process_websocket_call,
+                    environ,
+                    call,
+                    message,
+                    authenticated,
+                    calls,
+                ),
+                daemon=True,
+            ).start()
+
+        # There is nothing more to respond once the connection is closed
+        return ""
+
+    def _match_action(self, environ, method, path):
+        """Resolve an action route from a method and a path
+
+        Return the action route, the arguments given in the path and a
+        copy of the request environment for this route, or raise a '404
+        Not Found' response if no action matches.
+
+        Keyword arguments:
+            - environ -- The environment of the actual request
+            - method -- The HTTP method of the action
+            - path -- The path of the action
+
+        """
+        method = str(method).upper()
+        environ = dict(
+            environ,
+            REQUEST_METHOD=method,
+            PATH_INFO=str(path),
+            QUERY_STRING="",
+        )
+        environ.pop("CONTENT_TYPE", None)
+        try:
+            route, url_args = self.app.router.match(environ)
+        except HTTPError:
+            route, url_args = None, {}
+        _route = (method, route.rule if route is not None else None)
+        if _route not in self.actionsmap.parser.routes:
+            raise HTTPResponse("Unknown action", 404)
+        return _route, url_args, environ
+
+    def _process_websocket_call(self, environ, call, message, authenticated, calls):
+        try:
+            _route, url_args, environ = self._match_action(
+                environ, message.get("method", "GET"), message.get("path", "")
+            )
+            arguments = dict(message.get("args") or {}, **url_args)
+
+            # Bind the request of the connection to this thread, and a
+            # response of its own for what the action sets on it - e.g. the
+            # session cookie deleted when the authentication fails
+            request.bind(environ)
+            response.bind()
+            token = _current_job.set(call)
+            try:
+                with ExitStack() as exits:
+                    ret = self._process_action(
+                        _route, arguments, exits=exits, authenticated=authenticated
+                    )
+                    if isinstance(ret, Iterator):
+                        ret = list(ret)
+            finally:
+                _current_job.reset(token)
+        except MoulinetteError as e:
+            call.error(e.http_code, e.content())
+        except HTTPResponse as e:
+            call.error(e.status_code, e.body)
+        except Exception as e:
+            logger.exception("action called through a WebSocket failed")
+            call.error(500, str(e))
+        else:
+            call.result(ret)
+        finally:
+            calls.release()
+
+    def batch(self):
+        """Process several actions within a single request
+
+        The body of the request is a JSON list of actions to call, each
+        one given as an object with a 'method', a 'path' and optional
+        'params'. Consecutive actions which do not need the lock are
+        processed concurrently while the other ones are processed one at
+        a time, in order. The response lists the 'status' and the 'body'
+        of each action, as they would be in the response to the action
+        called on its own.
+
+        The session is verified once for the whole batch. Batches of more
+        than BATCH_MAX_ENTRIES actions are rejected, and at most
+        BATCH_MAX_CALLS actions are processed at once.
+
+        """
+        try:
+            entries = json_decode(request.body.read() or b"null")
+        except ValueError:
+            entries = None
+        if not isinstance(entries, list) or not all(
+            isinstance(entry, dict) for entry in entries
+        ):
+            raise HTTPResponse("Invalid batch", 400)
+        if len(entries) > BATCH_MAX_ENTRIES:
+            raise HTTPResponse("Too many actions in the batch", 413)
+
+        self.authenticate(
+            self.actionsmap.get_authenticator(self.actionsmap.default_authentication)
+        )
+        authenticated = {self.actionsmap.default_authentication}
+
+        environ = request.environ
+        results = [None] * len(entries)
+        calls = []
+        for i, entry in enumerate(entries):
+            try:
+                _route, url_args, entry_environ = self._match_action(
+                    environ, entry.get("method", "GET"), entry.get("path", "")
+                )
+            except HTTPResponse as e:
+                results[i] = {"status": e.status_code, "body": e.body}
+                continue
+            arguments = dict(entry.get("params") or {}, **url_args)
+            calls.append((i, _route, arguments, entry_environ))
+
+        def run(i, _route, arguments, entry_environ):
+            results[i] = self._process_batch_entry(
+                _route, arguments, entry_environ, authenticated
+            )
+
+        def run_in_thread(*call):
+            # Bind a response of its own for what the action sets on it -
+            # e.g. the session cookie deleted when the authentication fails
+            response.bind()
+            run(*call)
+
+        pending = []
+        for call in calls:
+            _route, arguments = call[1], call[2]
+            if (
+                self.actionsmap.enable_lock
+                and self.actionsmap.parser.want_to_take_lock(arguments, route=_route)
+            ):
+                # Wait for the previous actions before taking the lock
+                for thread in pending:
+                    thread.join()
+                pending = []
+                run(*call)
+            else:
+                if len(pending) >= BATCH_MAX_CALLS:
+                    pending.pop(0).join()
+                # Run in a copy of the request context to keep its locale
+                thread = Thread(target=copy_context().run, args=(run_in_thread,) + call)
+                thread.start()
+                pending.append(thread)
+        for thread in pending:
+            thread.join()
+
+        # Restore the request of this context for the response
+        request.bind(environ)
+        return {"results": results}
+
+    def _process_batch_entry(self, _route, arguments, environ, authenticated):
+        request.bind(environ)
+        try:
+            with ExitStack() as exits:
+                ret = self._process_action(
+                    _route, arguments, exits=exits, authenticated=authenticated
+                )
+                if isinstance(ret, Iterator):
+                    ret = list(ret)
+        except MoulinetteError as e:
+            return {"status": e.http_code, "body": e.content()}
+        except HTTPResponse as e:
+            return {"status": e.status_code, "body": e.body}
+        except Exception as e:
+            logger.exception("action called within a batch failed")
+            return {"status": 500, "body": str(e)}
+        status = response_status(request.method, ret)
+        return {"status": status, "body": "" if status == 204 else ret}
+
+    def list_jobs(self):
+        self.authenticate(
+            self.actionsmap.get_authenticator(self.actionsmap.default_authentication)
+        )
+        return {"jobs": [job.infos() for job in self.jobs.list()]}
+
+    def job_status(self, job_id):
+        return self._get_job(job_id).infos()
+
+    def job_result(self, job_id):
+        job = self._get_job(job_id)
+        if not job.done:
+            return HTTPResponse(
+                json_encode(job.infos()),
+                202,
+                headers={"Content-type": "application/json"},
+            )
+        if job.error is not None:
+            http_code, content = job.error
+            if isinstance(content, dict):
+                return HTTPResponse(
+                    json_encode(content),
+                    http_code,
+                    headers={"Content-type": "application/json"},
+                )
+            return HTTPResponse(content, http_code)
+        return format_for_response(job.result)
+
+    def job_logs(self, job_id):
+        job = self._get_job(job_id)
+        try:
+            since = int(request.params.get("since", 0))
+        except ValueError:
+            raise HTTPResponse("Invalid 'since' parameter", 400)
+        return {"logs": job.logs[since:], "next": len(job.logs)}
+
+    def _get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPResponse("Unknown job", 404)
+        if job.authentication is not None:
+            self.authenticate(self.actionsmap.get_authenticator(job.authentication))
+        return job
+
+    def submit_job(self, _route, arguments):
+        """Process the relevant action for the route in background
+
+        Authenticate and parse the arguments within the request, then hand
+        the action over to the job manager and answer with '202 Accepted'
+        and the location of the created job.
 
-        # Hardcoded yunohost stuff for the SSE stream to not require authentication when postinstall isnt done yet...
-        if os.path.exists("/etc/yunohost/installed"):
-            try:
-                authenticator.get_session_cookie()
-            except MoulinetteAuthenticationError:
-                raise HTTPResponse(m18n.g("not_logged_in"), 401)
+        Keyword arguments:
+            - _route -- The action route as a 2-tuple (method, path)
+            - arguments -- A dict of arguments for the route
 
-        response.content_type = "text/event-stream"
-        response.cache_control = "no-cache"
-        response.headers["X-Accel-Buffering"] = "no"
+        """
+        self.actionsmap.check_authentication_if_required(arguments, route=_route)
+        tid, parsed_arguments = self.actionsmap.parse_action(arguments, route=_route)
+        want_to_take_lock = self.actionsmap.parser.want_to_take_lock(
+            arguments, route=_route
+        )
 
-        from yunohost.utils.sse import sse_stream
+        # The job takes the ownership of the uploaded files
+        spool = request.environ.pop("moulinette.upload_spool", None)
+        cleanup = spool.cleanup if spool is not None else None
 
-        yield from sse_stream()
+        job = self.jobs.submit(
+            _route, tid, parsed_arguments, want_to_take_lock, cleanup
+        )
+        return HTTPResponse(
+            json_encode(job.infos()),
+            202,
+            headers={
+                "Content-type": "application/json",
+                "Location": f"{request.script_name}jobs/{job.id}",
+                "Preference-Applied": "respond-async",
+            },
+        )
 
     def process(self, _route, arguments={}):
         """Process the relevant action for the route
@@ -425,9 +3309,231 @@ class _ActionsMapPlugin:
             - arguments -- A dict of arguments for the route
 
         """
+        if request.method in ("GET", "HEAD"):
+            try:
+                etag = self._validate(_route, arguments)
+            except MoulinetteError as e:
+                raise moulinette_error_to_http_response(e)
+            if etag is not None:
+                headers = {"ETag": etag, "Vary": "Locale, Accept"}
+                if etag_matches(request.get_header("If-None-Match"), etag):
+                    return HTTPResponse(status=304, headers=headers)
+                if request.method == "HEAD":
+                    headers["Content-Type"] = "application/json"
+                    return HTTPResponse(headers=headers)
+                for name, value in headers.items():
+                    response.set_header(name, value)
+
+        idempotency_key = request.get_header("Idempotency-Key")
+        if (
+            idempotency_key
+            and self.idempotency is not None
+            and self._takes_lock(_route, arguments)
+        ):
+            return self._process_idempotent(idempotency_key, _route, arguments)
+
+        if self.single_flight is not None and self._can_coalesce(_route, arguments):
+            return self._process_coalesced(_route, arguments)
+        return self._process(_route, arguments)
+
+    def _validate(self, _route, arguments):
+        """Return the ETag of the response to a request, or None
+
+        The ETag is derived from the value returned by the validator of
+        the action - given the parsed arguments and called without the
+        lock - along with what the representation depends on, so that
+        conditional and HEAD requests are answered without processing the
+        action. None is returned if the action has no validator or if it
+        returns None. The authentication and parsed arguments are kept in
+        the environment of the request for the action to be processed.
+
+        """
+        actionsmap = self.actionsmap
+        validator = actionsmap.parser.validator(_route)
+        if validator is None:
+            return None
+
+        actionsmap.check_authentication_if_required(arguments, route=_route)
+        tid, parsed_arguments = actionsmap.parse_action(arguments, route=_route)
+        # Kept so that the action isn't authenticated and parsed again
+        request.environ["moulinette.authenticated"] = {
+            actionsmap.parser.auth_method(arguments, route=_route)
+        }
+        request.environ["moulinette.parsed_action"] = (tid, parsed_arguments)
+        value = actionsmap.run_validator(tid, validator, parsed_arguments)
+        if value is None:
+            return None
+
+        data = json_encode([value, m18n.locale, wants_ndjson()], default=str)
+        return '"%s"' % hashlib.sha256(data.encode()).hexdigest()[:32]
+
+    def _takes_lock(self, _route, arguments):
+        return self.actionsmap.enable_lock and self.actionsmap.parser.want_to_take_lock(
+            arguments, route=_route
+        )
+
+    def _can_coalesce(self, _route, arguments):
+        if request.method != "GET" or (self.jobs is not None and prefers_async()):
+            return False
+        return not self._takes_lock(_route, arguments)
+
+    def _session_key(self, _route, arguments):
+        """Return what identifies the session of a request, or None"""
+        auth_method = self.actionsmap.parser.auth_method(arguments, route=_route)
+        if auth_method is None:
+            return None
+        authenticator = self.actionsmap.get_authenticator(auth_method)
+        name = authenticator.session_cookie_name
+        return (
+            auth_method,
+            request.get_cookie(name) if name else request.get_header("Cookie"),
+        )
+
+    def _process_idempotent(self, idempotency_key, _route, arguments):
+        """Process a lock-taking action unless it was with the same key
+
+        Keys are scoped to the route and session of the request. Each
+        request is authenticated before getting the response of a
+        previous one, which is sent again with an 'Idempotent-Replayed'
+        header.
+
+        """
+        try:
+            self.actionsmap.check_authentication_if_required(
+                arguments,
+                route=_route,
+                authenticated=request.environ.get("moulinette.authenticated", ()),
+            )
+        except MoulinetteError as e:
+            raise moulinette_error_to_http_response(e)
+
+        def default(value):
+            # Uploaded files are identified by their name and size
+            if isinstance(value, FileUpload):
+                return [value.raw_filename, value.content_length]
+            return str(value)
+
+        key = (idempotency_key, _route, self._session_key(_route, arguments))
+        fingerprint = (
+            json_encode(arguments, sort_keys=True, default=default),
+            prefers_async(),
+        )
+        try:
+            (status, headers, body), replayed = self.idempotency.do(
+                key, fingerprint, self._process_shared, _route, arguments
+            )
+        except _IdempotencyKeyReused:
+            raise HTTPResponse(
+                json_encode({"error": m18n.g("idempotency_key_reused")}),
+                422,
+                headers={"Content-type": "application/json"},
+            )
+
+        response.status = status
+        _replay_headers(headers)
+        if replayed:
+            response.set_header("Idempotent-Replayed", "true")
+            if self.metrics is not None:
+                self.metrics.inc(
+                    "moulinette_idempotent_replays_total",
+                    (("route", f"{_route[0]} {_route[1]}"),),
+                )
+        return body
+
+    def _process_coalesced(self, _route, arguments):
+        """Process a lock-free action unless an identical one is in flight
+
+        Requests are identical if they have the same route, arguments,
+        session and locale. Each one is authenticated before waiting for
+        another one, and all of them get the same encoded response.
+
+        """
+        try:
+            self.actionsmap.check_authentication_if_required(
+                arguments,
+                route=_route,
+                authenticated=request.environ.get("moulinette.authenticated", ()),
+            )
+        except MoulinetteError as e:
+            raise moulinette_error_to_http_response(e)
+
+        key = (
+            _route,
+            json_encode(arguments, sort_keys=True, default=str),
+            self._session_key(_route, arguments),
+            m18n.locale,
+            wants_ndjson(),
+        )
+
+        (status, headers, body), shared = self.single_flight.do(
+            key, self._process_shared, _route, arguments
+        )
+        if shared and self.metrics is not None:
+            self.metrics.inc(
+                "moulinette_single_flight_coalesced_total",
+                (("route", f"{_route[0]} {_route[1]}"),),
+            )
 
+        response.status = status
+        _replay_headers(headers)
+        return body
+
+    def _process_shared(self, _route, arguments):
+        # Encode the response at once so that it can be sent several times
+        try:
+            ret = self._process(_route, arguments)
+        except HTTPResponse as e:
+            ret = e
+        if isinstance(ret, HTTPResponse):
+            status, headers, body = ret.status_code, ret.headerlist, ret.body
+        else:
+            status, headers, body = response.status_code, response.headerlist, ret
+        if not isinstance(body, (bytes, str)):
+            body = "".join(body)
+        if isinstance(body, str):
+            body = body.encode()
+        return status, headers, body
+
+    def _process(self, _route, arguments):
+        # Kept in the environment for the access log to get the lock wait
+        timings = request.environ.setdefault("moulinette.timings", {})
+        # What is held until the response body has been sent, e.g. the
+        # admission slot of the request
+        exits = ExitStack()
         try:
-            ret = self.actionsmap.process(arguments, timeout=30, route=_route)
+            if self.jobs is not None and prefers_async():
+                return self.submit_job(_route, arguments)
+
+            parser = self.actionsmap.parser
+            request.environ["moulinette.tid"] = parser.tid(_route)
+            paging = None
+            paginate = parser.paginate(_route)
+            if paginate:
+                paging = get_paging(arguments)
+            hints = {}
+            if paging is not None:
+                hints = {"limit": paging[0], "offset": paging[1]}
+            # Actions may have an argument of their own named 'fields'
+            fields = None
+            if "fields" in arguments and not parser.has_argument("fields", _route):
+                fields = parse_fields(arguments["fields"])
+                selectors = arguments["fields"]
+                if isinstance(selectors, list):
+                    selectors = ",".join(selectors)
+                hints["fields"] = selectors
+
+            ret = self._process_action(_route, arguments, timings, hints, exits)
+
+            if paginate:
+                ret = self._paginate(ret, paginate, paging, hints)
+            if fields and request.method != "HEAD":
+                ret = project_fields(ret, fields)
+            if self.metrics is not None:
+                for timing in ("lock_wait", "lock_hold"):
+                    if timing in timings:
+                        self.metrics.observe(
+                            f"moulinette_{timing}_seconds", timings[timing]
+                        )
         except MoulinetteError as e:
             raise moulinette_error_to_http_response(e)
         except Exception as e:
@@ -437,28 +3543,327 @@ class _ActionsMapPlugin:
 
             tb = traceback.format_exc()
             logs = {"route": _route, "arguments": arguments, "traceback": tb}
-            print(tb, file=sys.stderr)
+            logger.exception("unable to process the action of the route %s %s", *_route)
             return HTTPResponse(json_encode(logs), 500)
         else:
-            return format_for_response(ret)
+            start = time.perf_counter()
+            try:
+                body = format_for_response(ret)
+            finally:
+                timings["serialize"] = time.perf_counter() - start
+                if self.metrics is not None:
+                    self.metrics.observe(
+                        "moulinette_serialization_duration_seconds",
+                        timings["serialize"],
+                    )
+            if isinstance(body, Iterator):
+                # The action is still running while its result is streamed
+                spool = request.environ.pop("moulinette.upload_spool", None)
+                if spool is not None:
+                    exits.callback(spool.cleanup)
+                body = _close_after(body, exits.pop_all().close)
+            return body
         finally:
-            # Clean upload directory
-            # FIXME do that in a better way
-            global UPLOAD_DIR
-            if UPLOAD_DIR is not None:
-                rmtree(UPLOAD_DIR, True)
-                UPLOAD_DIR = None
+            exits.close()
+            # Clean the files uploaded with the request
+            spool = request.environ.get("moulinette.upload_spool")
+            if spool is not None:
+                spool.cleanup()
+
+    def _process_action(
+        self,
+        _route,
+        arguments,
+        timings=None,
+        hints=None,
+        exits=None,
+        authenticated=(),
+    ):
+        with ExitStack() as stack:
+            if self.admission is not None:
+                locking = self.actionsmap.enable_lock and (
+                    self.actionsmap.parser.want_to_take_lock(arguments, route=_route)
+                )
+                # The slot is kept until 'exits' is closed if it is given
+                slot = self.admission.admit(locking)
+                (stack if exits is None else exits).enter_context(slot)
+            # What has been checked by _validate() for the request
+            authenticated = set(authenticated)
+            authenticated.update(request.environ.get("moulinette.authenticated", ()))
+            return self.actionsmap.process(
+                arguments,
+                timeout=30,
+                timings=timings,
+                hints=hints,
+                authenticated=authenticated,
+                parsed_action=request.environ.get("moulinette.parsed_action"),
+                route=_route,
+            )
+
+    def _paginate(self, ret, paginate, paging, hints):
+        limit, offset = paging if paging is not None else (None, 0)
+        key = paginate if isinstance(paginate, str) else None
+        ret, total, next_offset = select_page(
+            ret, limit, offset, key, paged="limit" in hints
+        )
+        if total is not None:
+            response.set_header("X-Total-Count", str(total))
+        if next_offset is not None:
+            response.set_header("X-Next-Cursor", encode_cursor(next_offset))
+        return ret
+
+    def introspect(self):
+        """Describe the routes of the actions map and their arguments
+
+        The description is generated once per version of the actions map
+        and locale, and is served with a strong ETag so that clients only
+        fetch it again when the actions map changes - they still revalidate
+        it on each use.
+
+        """
+        actionsmap = self.actionsmap
+        key = (actionsmap.version, m18n.locale)
+        try:
+            body, etag = self._descriptions[key]
+        except KeyError:
+            description = {
+                "version": actionsmap.version,
+                "locale": m18n.locale,
+                "routes": actionsmap.parser.describe(actionsmap.extraparser),
+            }
+            body = json_encode(description, cls=JSONExtendedEncoder)
+            etag = '"%s"' % hashlib.sha256(body.encode()).hexdigest()[:32]
+            self._descriptions[key] = (body, etag)
+
+        headers = {
+            "ETag": etag,
+            # Its URL doesn't change with the actions map, so that clients
+            # have to revalidate it
+            "Cache-Control": "no-cache",
+            "Vary": "Locale",
+        }
+        if etag_matches(request.get_header("If-None-Match"), etag):
+            return HTTPResponse(status=304, headers=headers)
+        headers["Content-Type"] = "application/json"
+        return HTTPResponse(body, headers=headers)
+
+    def healthz(self):
+        response.content_type = "application/json"
+        response.set_header("Cache-Control", "no-store")
+        return json_encode({"status": "ok"})
+
+    def render_metrics(self):
+        response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return self.metrics.render()
+
+    def render_diagnostics(self):
+        profile = request.params.get("profile", self.actionsmap.default_authentication)
+        self.authenticate(self.actionsmap.get_authenticator(profile))
+
+        response.content_type = "text/plain; charset=utf-8"
+        response.set_header("Cache-Control", "no-store")
+        return self.diagnostics.report()
 
     def display(self, message, style="info"):
-        pass
+        # Only messages of actions processed in background are kept
+        job = _current_job.get()
+        if job is not None:
+            job.log(style, message)
 
     def prompt(self, *args, **kwargs):
         raise NotImplementedError("Prompt is not implemented for this interface")
 
 
+# Pagination -----------------------------------------------------------
+
+
+def encode_cursor(offset):
+    """Encode an offset in a list into an opaque cursor"""
+    data = json_encode({"offset": offset}).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode the offset of a cursor, or raise a ValueError"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        offset = json_decode(data)["offset"]
+    except (TypeError, KeyError, binascii.Error) as e:
+        raise ValueError(f"invalid cursor: {e}")
+    if not isinstance(offset, int):
+        raise ValueError("invalid cursor")
+    return offset
+
+
+def get_paging(params):
+    """Get the page of the results asked by a request
+
+    The page is given with the 'limit' parameter and either the 'offset'
+    or the 'cursor' one. Return a 2-tuple (limit, offset) - where limit is
+    None for no limit - or None if no page is asked.
+
+    Keyword arguments:
+        - params -- A dict of the parameters of the request
+
+    """
+    if not any(name in params for name in ("limit", "offset", "cursor")):
+        return None
+    try:
+        limit = params.get("limit")
+        limit = int(limit) if limit not in (None, "") else None
+        if params.get("cursor"):
+            offset = decode_cursor(params["cursor"])
+        else:
+            offset = int(params.get("offset") or 0)
+    except (TypeError, ValueError):
+        raise HTTPResponse("Invalid paging parameters", 400)
+    if offset < 0 or (limit is not None and limit < 0):
+        raise HTTPResponse("Invalid paging parameters", 400)
+    return limit, offset
+
+
+def select_page(content, limit, offset, key=None, paged=False):
+    """Select a page of the entries of the result of an action
+
+    Entries are the items of a list or of a dict, or of an iterator - which
+    is sliced lazily and whose total is thus unknown. Return a 3-tuple
+    (content, total, next_offset) where total and next_offset are None if
+    unknown or, for the latter, if there is no next page.
+
+    Keyword arguments:
+        - content -- The result of the action
+        - limit -- The maximum number of entries, or None for no limit
+        - offset -- The index of the first entry
+        - key -- The key of the entries in the result if it is a dict, or
+            None if the result is the entries
+        - paged -- True if the action already selected the page itself
+
+    """
+    entries = content
+    if key is not None:
+        if not isinstance(content, dict) or key not in content:
+            return content, None, None
+        entries = content[key]
+
+    end = offset + limit if limit is not None else None
+    if paged:
+        # Only a full page can be followed by another one
+        if isinstance(entries, (list, dict)) and len(entries) == limit:
+            return content, None, end
+        return content, None, None
+    if isinstance(entries, Iterator):
+        return _replace_entries(content, key, islice(entries, offset, end)), None, None
+    if isinstance(entries, dict):
+        total = len(entries)
+        page = dict(islice(entries.items(), offset, end))
+    elif isinstance(entries, list):
+        total = len(entries)
+        page = entries[offset:end]
+    else:
+        return content, None, None
+
+    next_offset = end if end is not None and end < total else None
+    return _replace_entries(content, key, page), total, next_offset
+
+
+def _replace_entries(content, key, entries):
+    if key is None:
+        return entries
+    return dict(content, **{key: entries})
+
+
+# Projection -----------------------------------------------------------
+
+
+def parse_fields(selectors):
+    """Parse the fields to keep in the result of an action
+
+    Fields are given as comma-separated dotted paths of keys, '*' matching
+    any key, e.g. 'users.*.username,users.*.mail'. Lists are transparent,
+    the paths applying to each of their items. Return the fields as a tree
+    of dicts, where an empty dict keeps the whole value.
+
+    Keyword arguments:
+        - selectors -- A string or a list of strings of fields
+
+    """
+    if isinstance(selectors, str):
+        selectors = [selectors]
+
+    tree = {}
+    for selector in selectors:
+        if not isinstance(selector, str):
+            raise HTTPResponse("Invalid 'fields' parameter", 400)
+        for field in selector.split(","):
+            field = field.strip()
+            if not field:
+                continue
+            keys = field.split(".")
+            if "" in keys:
+                raise HTTPResponse("Invalid 'fields' parameter", 400)
+            node = tree
+            for key in keys[:-1]:
+                if node.get(key) == {}:
+                    # The whole value is already kept
+                    break
+                node = node.setdefault(key, {})
+            else:
+                node[keys[-1]] = {}
+    return tree
+
+
+def project_fields(content, fields):
+    """Keep only some fields of the result of an action
+
+    Keyword arguments:
+        - content -- The result of the action
+        - fields -- The fields to keep, as returned by parse_fields()
+
+    """
+    if not fields:
+        return content
+    if isinstance(content, dict):
+        wildcard = fields.get("*")
+        ret = {}
+        for key, value in content.items():
+            subfields = fields.get(str(key))
+            if subfields is None:
+                subfields = wildcard
+            elif wildcard is not None:
+                subfields = _merge_fields(subfields, wildcard)
+            if subfields is not None:
+                ret[key] = project_fields(value, subfields)
+        return ret
+    if isinstance(content, (list, tuple)):
+        return [project_fields(item, fields) for item in content]
+    if isinstance(content, Iterator):
+        return (project_fields(item, fields) for item in content)
+    return content
+
+
+def _merge_fields(a, b):
+    if not a or not b:
+        return {}
+    ret = dict(a)
+    for key, value in b.items():
+        ret[key] = _merge_fields(ret[key], value) if key in ret else value
+    return ret
+
+
 # HTTP Responses -------------------------------------------------------
 
 
+def etag_matches(if_none_match, etag):
+    """Return True if an If-None-Match header matches an entity tag"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
 def moulinette_error_to_http_response(error):
     content = error.content()
     if isinstance(content, dict):
@@ -471,27 +3876,151 @@ def moulinette_error_to_http_response(error):
         return HTTPResponse(content, error.http_code)
 
 
+def response_status(method, content):
+    """Return the status of the response to an action processed successfully
+
+    Keyword arguments:
+        - method -- The HTTP method of the request
+        - content -- The resulted content of the action
+
+    """
+    if method == "POST":
+        return 201  # Created
+    if method in ("GET", "HEAD"):
+        return 200  # Ok
+    if content is None or (not isinstance(content, Iterator) and len(content) == 0):
+        return 204  # No Content
+    return 200
+
+
 def format_for_response(content):
     """Format the resulted content of a request for the HTTP response."""
-    if request.method == "POST":
-        response.status = 201  # Created
-    elif request.method == "GET":
-        response.status = 200  # Ok
-    else:
-        # Return empty string if no content
-        if content is None or len(content) == 0:
-            response.status = 204  # No Content
-            return ""
-        response.status = 200
+    response.status = response_status(request.method, content)
+    # Return empty string if no content
+    if response.status_code == 204:
+        return ""
 
     if isinstance(content, HTTPResponse):
         return content
 
+    # The body of the response to a HEAD request is not encoded
+    if request.method == "HEAD":
+        if isinstance(content, Iterator) and wants_ndjson():
+            response.content_type = "application/x-ndjson"
+        else:
+            response.content_type = "application/json"
+        return ""
+
+    # Stream iterators item by item instead of materializing them
+    if isinstance(content, Iterator):
+        ndjson = wants_ndjson()
+        if ndjson:
+            response.content_type = "application/x-ndjson"
+        else:
+            response.content_type = "application/json"
+        return stream_for_response(content, ndjson)
+
     # Return JSON-style response
     response.content_type = "application/json"
     return json_encode(content, cls=JSONExtendedEncoder)
 
 
+def wants_ndjson():
+    """Checks if the client asked for newline-delimited JSON."""
+
+    accept = request.get_header("Accept") or ""
+    for media_type in accept.lower().split(","):
+        if media_type.split(";")[0].strip() in NDJSON_TYPES:
+            return True
+    return False
+
+
+def _replay_headers(headers):
+    """Set the headers of a stored response on the current one
+
+    The stored headers replace the ones of the same name, but repeated
+    headers - e.g. several cookies - are all kept. Cookies which are
+    already set on the current response are not set twice.
+
+    """
+    cookies = [v for n, v in response.headerlist if n == "Set-Cookie"]
+    replaced = set()
+    for name, value in headers:
+        if name.title() == "Set-Cookie":
+            if value not in cookies:
+                response.add_header(name, value)
+        elif name in replaced:
+            response.add_header(name, value)
+        else:
+            response.set_header(name, value)
+            replaced.add(name)
+
+
+def _close_after(iterator, close):
+    """Yield the items of an iterator and call close() once it is closed"""
+    try:
+        yield from iterator
+    finally:
+        close()
+
+
+def stream_for_response(iterator, ndjson=False):
+    """Encode the items of an iterator while they are produced
+
+    Yield the items as a JSON array - or one JSON document per line if
+    'ndjson' is True - in chunks of about STREAM_CHUNK_SIZE bytes, so that
+    Bottle sends them with chunked transfer encoding. The first item is
+    flushed alone to keep the time to first byte low.
+
+    Note that the iterator is consumed once the action has returned, which
+    is why only the results of actions which don't take the lock are
+    streamed. Since the status has already been sent when an error occurs,
+    the stream then ends with an item {"error": message} - closing the JSON
+    array.
+
+    Keyword arguments:
+        - iterator -- The iterator returned by the action
+        - ndjson -- True to encode as newline-delimited JSON
+
+    """
+    encode = JSONExtendedEncoder().encode
+    chunk = [] if ndjson else ["["]
+    size = 0
+    first = True
+
+    try:
+        for item in iterator:
+            data = encode(item)
+            if ndjson:
+                chunk.append(data + "\n")
+            elif first:
+                chunk.append(data)
+            else:
+                chunk.append("," + data)
+            size += len(data) + 1
+
+            if first or size >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+            first = False
+    except Exception as e:
+        logger.exception("error while streaming response, output is truncated")
+        message = e.strerror if isinstance(e, MoulinetteError) else str(e)
+        error = encode({"error": message})
+        if ndjson:
+            chunk.append(error + "\n")
+        else:
+            chunk.append(("" if first else ",") + error + "]")
+        yield "".join(chunk)
+        return
+
+    if not ndjson:
+        chunk.append("]")
+    if chunk:
+        yield "".join(chunk)
+
+
 # API Classes Implementation -------------------------------------------
 
 
@@ -509,6 +4038,10 @@ class ActionsMapParser(BaseActionsMapParser):
         self._parsers = {}  # dict({(method, path): _HTTPArgumentParser})
         self._route_re = re.compile(r"(GET|POST|PUT|DELETE) (/\S+)")
 
+        # The routes which cannot be resolved by the router are left to Bottle
+        self.router = _RouteTable()
+        self.fallback_routes = []
+
     @property
     def routes(self):
         """Get current routes"""
@@ -536,11 +4069,28 @@ class ActionsMapParser(BaseActionsMapParser):
     def add_subcategory_parser(self, name, **kwargs):
         return self
 
-    def add_action_parser(self, name, tid, api=None, **kwargs):
+    def add_action_parser(
+        self,
+        name,
+        tid,
+        api=None,
+        paginate=None,
+        validator=None,
+        upload_path=False,
+        **kwargs,
+    ):
         """Add a parser for an action
 
         Keyword arguments:
             - api -- The action route (e.g. 'GET /' )
+            - paginate -- True if the result of the action can be paginated,
+                or the key of its entries if the result is a dict
+            - validator -- The name of a function of the module of the
+                action returning a cheap validator of its result, from
+                which the ETag of the response is derived
+            - upload_path -- True if the arguments of the action which are
+                not of type open/FileType are given the path of the files
+                uploaded for them
 
         Returns:
             A new _HTTPArgumentParser object for the route
@@ -568,12 +4118,30 @@ class ActionsMapParser(BaseActionsMapParser):
 
         # Create and append parser
         parser = _HTTPArgumentParser()
+        parser.paginate = paginate
+        parser.validator = validator
+        parser.upload_path = upload_path
         for k in keys:
             self._parsers[k] = (tid, parser)
+            if not self.router.add(k[0], k[1], k):
+                self.fallback_routes.append(k)
 
         # Return the created parser
         return parser
 
+    def match(self, method, path):
+        """Resolve the action route of a request
+
+        Return the action route as a 2-tuple (method, path) and the
+        arguments given in the path, or None if no route matches.
+
+        Keyword arguments:
+            - method -- The HTTP method of the request
+            - path -- The path of the request
+
+        """
+        return self.router.match(method, path)
+
     def auth_method(self, _, route):
         try:
             # Retrieve the tid for the route
@@ -592,6 +4160,58 @@ class ActionsMapParser(BaseActionsMapParser):
 
         return getattr(parser, "want_to_take_lock", True)
 
+    def tid(self, route):
+        """Return the tuple identifier of the action of a route"""
+        tid, _ = self._parsers[route]
+
+        return tid
+
+    def paginate(self, route):
+        """Return the 'paginate' option of the action of a route"""
+        _, parser = self._parsers[route]
+
+        return parser.paginate
+
+    def validator(self, route):
+        """Return the 'validator' option of the action of a route"""
+        _, parser = self._parsers[route]
+
+        return getattr(parser, "validator", None)
+
+    def has_argument(self, dest, route):
+        """Return True if the action of a route has an argument 'dest'"""
+        _, parser = self._parsers[route]
+
+        return parser.has_argument(dest)
+
+    def describe(self, extraparser):
+        """Describe the action routes and their arguments
+
+        Return a list of dicts, one per action route, with its method,
+        path, action, authentication profile, whether it takes the lock,
+        its 'paginate' option, whether it has a validator and the
+        description of its arguments.
+
+        Keyword arguments:
+            - extraparser -- The ExtraArgumentParser of the actions map
+
+        """
+        routes = []
+        for (method, path), (tid, parser) in self._parsers.items():
+            routes.append(
+                {
+                    "method": method,
+                    "path": path,
+                    "action": " ".join(tid[1:]),
+                    "authentication": parser.authentication,
+                    "lock": getattr(parser, "want_to_take_lock", True),
+                    "paginate": parser.paginate,
+                    "validator": getattr(parser, "validator", None) is not None,
+                    "arguments": parser.describe(extraparser.get_parameters(tid)),
+                }
+            )
+        return routes
+
     def parse_args(self, args, **kwargs):
         """Parse arguments
 
@@ -647,59 +4267,131 @@ class Interface:
     Keyword arguments:
         - routes -- A dict of additional routes to add in the form of
             {(method, path): callback}
+        - async_workers -- The number of actions which can be processed
+            concurrently in background per namespace, or 0 - the default -
+            to disable the asynchronous mode (i.e. 'Prefer: respond-async'
+            requests)
+        - max_jobs -- The maximum number of background jobs to keep track of
+        - upload_max_size -- The maximum size in bytes of the files uploaded
+            with a request, or None for no limit
+        - session_cache_size -- The maximum number of verified sessions to
+            cache for the authenticators which allow it
+        - admission -- A dict of limits on the number of actions processed
+            concurrently, see _AdmissionController for the keys, or None
+            for no limit
+        - metrics -- Whether to collect metrics of the requests and serve
+            them in the Prometheus format on '/metrics'
+        - server_timing -- Whether to report the duration of the phases of
+            each request in a Server-Timing header, which is otherwise only
+            done for requests with a 'X-Server-Timing' header
+        - cors_max_age -- The time period in seconds during which browsers
+            may cache the result of a CORS preflight request
+        - reload_interval -- The interval in seconds at which the files of
+            the actions map are checked for changes to reload it while
+            serving, or None to never reload it
+        - single_flight -- Whether identical lock-free GET requests made
+            concurrently are processed once, all of them getting the same
+            response - which is then no longer streamed
+        - access_log -- The path of a file to record each request in, in
+            the JSON Lines format, or None
+        - diagnostics -- Whether to serve on '/diagnostics' - and log on
+            SIGUSR1 - a report of the lock holder, the requests being
+            processed, the run time of the greenlets and their stacks
+        - max_blocking_time -- The time in seconds after which a report is
+            logged when the gevent hub is blocked, or None
+        - idempotency_keys -- The maximum number of 'Idempotency-Key'
+            headers whose response is stored to be sent again when the
+            request to a lock-taking route is retried, 0 to process each
+            request
+        - idempotency_ttl -- The time period in seconds during which the
+            response to a request with an 'Idempotency-Key' is stored
     """
 
     type = "api"
 
-    def __init__(self, routes={}, actionsmap=None, allowed_cors_origins=[]):
+    def __init__(
+        self,
+        routes={},
+        actionsmap=None,
+        allowed_cors_origins=[],
+        async_workers=0,
+        max_jobs=100,
+        upload_max_size=None,
+        session_cache_size=1024,
+        admission=None,
+        metrics=False,
+        server_timing=False,
+        cors_max_age=600,
+        reload_interval=None,
+        single_flight=False,
+        access_log=None,
+        diagnostics=False,
+        max_blocking_time=None,
+        idempotency_keys=1024,
+        idempotency_ttl=24 * 3600,
+    ):
+        self._actionsmap_yml = actionsmap
+        self.reload_interval = reload_interval
         actionsmap = ActionsMap(actionsmap, ActionsMapParser())
 
         self.allowed_cors_origins = allowed_cors_origins
 
-        # TODO: Return OK to 'OPTIONS' xhr requests (l173)
         app = Bottle(autojson=True)
 
-        def cors(callback):
-            def wrapper(*args, **kwargs):
-                try:
-                    r = callback(*args, **kwargs)
-                except HTTPResponse as e:
-                    r = e
-
-                origin = request.headers.environ.get("HTTP_ORIGIN", "")
-                if origin and origin in self.allowed_cors_origins:
-                    resp = r if isinstance(r, HTTPResponse) else response
-                    resp.headers["Access-Control-Allow-Origin"] = origin
-                    resp.headers["Access-Control-Allow-Methods"] = (
-                        "GET, HEAD, POST, PUT, OPTIONS, DELETE"
-                    )
-                    resp.headers["Access-Control-Allow-Headers"] = (
-                        "Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token"
-                    )
-                    resp.headers["Access-Control-Allow-Credentials"] = "true"
-
-                return r
-
-            return wrapper
-
-        # Attempt to retrieve and set locale
-        def api18n(callback):
-            def wrapper(*args, **kwargs):
-                try:
-                    locale = request.get_header("locale")
-                except Exception:
-                    locale = None
-                locale = locale or m18n.default_locale
-                m18n.set_locale(locale)
-                return callback(*args, **kwargs)
+        # Translations are loaded once for all so that each request only has
+        # to set the locale of its own context
+        m18n.load_all_locales()
+
+        sse_hub = _SSEHub()
+        jobs = None
+        if async_workers:
+            jobs = _JobManager(actionsmap, async_workers, max_jobs, sse_hub.publish)
+        self.admission = None
+        if admission is not None:
+            self.admission = _AdmissionController(**admission)
+        self._metrics = None
+        if metrics:
+            self._metrics = _Metrics()
+            self._metrics.admission = self.admission
+        self._diagnostics = None
+        if diagnostics or max_blocking_time is not None:
+            self._diagnostics = _Diagnostics(actionsmap.namespace, max_blocking_time)
+
+        # Process-local caches are cleared when another worker process
+        # invalidates them, see invalidate_caches()
+        self._caches = _CacheGeneration()
+
+        actionsmapplugin = _ActionsMapPlugin(
+            actionsmap,
+            jobs,
+            upload_max_size,
+            session_cache_size,
+            self.admission,
+            self._metrics,
+            sse_hub,
+            _SingleFlight() if single_flight else None,
+            self._diagnostics if diagnostics else None,
+            (
+                _IdempotencyStore(idempotency_keys, idempotency_ttl)
+                if idempotency_keys
+                else None
+            ),
+            self._caches,
+        )
 
-            return wrapper
+        self._access_log = _AccessLog(access_log) if access_log else None
 
         # Install plugins
-        app.install(filter_csrf)
-        app.install(cors)
-        app.install(api18n)
-        actionsmapplugin = _ActionsMapPlugin(actionsmap)
+        app.install(
+            _RequestPipeline(
+                allowed_cors_origins,
+                cors_max_age,
+                self._caches,
+                server_timing,
+                self._access_log,
+                self._diagnostics,
+            )
+        )
         app.install(actionsmapplugin)
 
         self.authenticate = actionsmapplugin.authenticate
@@ -710,7 +4402,11 @@ class Interface:
             return HTTPResponse("", 204)
 
         app.route(
-            "/<:re:.*>", method="OPTIONS", callback=handle_options, skip=["actionsmap"]
+            "/<:re:.*>",
+            method="OPTIONS",
+            callback=handle_options,
+            skip=["actionsmap"],
+            preflight=True,
         )
 
         # Append additional routes
@@ -719,41 +4415,239 @@ class Interface:
             app.route(p, method=m, callback=c, skip=["actionsmap"])
 
         self._app = app
+        self._actionsmap = actionsmap
+        self._actionsmapplugin = actionsmapplugin
 
         Moulinette._interface = self
 
-    def run(self, host="localhost", port=80):
+    def invalidate_caches(self):
+        """Invalidate the process-local caches
+
+        Caches such as the verified sessions are kept by each worker
+        process. This clears them in all the worker processes, each one
+        doing so before handling its next request.
+
+        """
+        self._caches.bump()
+
+    def register_cache(self, cache):
+        """Register a process-local cache to keep coherent
+
+        Keyword arguments:
+            - cache -- An object with a clear() method which is called
+                when the caches are invalidated
+
+        """
+        self._caches.caches.append(cache)
+
+    def reload_actionsmap(self):
+        """Reload the actions map from its file
+
+        The new actions map is built aside and then swapped with the current
+        one, which is kept if the new one cannot be loaded. Requests being
+        processed meanwhile finish with the actions map they started with.
+
+        A new actions map with actions processed in the process executor
+        is refused if the current one has none: its pool is forked before
+        gevent patches the server and cannot be started afterwards.
+
+        Returns:
+            True if the actions map has been reloaded
+
+        """
+        try:
+            actionsmap = ActionsMap(self._actionsmap_yml, ActionsMapParser())
+        except Exception as e:
+            logger.error(
+                "unable to reload the actions map '%s', keeping the current one: %s",
+                self._actionsmap_yml,
+                e,
+            )
+            return False
+
+        declared = self._actionsmap.executor.declared
+        if "process" in actionsmap.executor.declared and "process" not in declared:
+            logger.error(
+                "unable to reload the actions map '%s', keeping the current one: "
+                "the process executor can only be used once the server restarts",
+                self._actionsmap_yml,
+            )
+            return False
+
+        self._actionsmapplugin.reload(actionsmap)
+        self._actionsmap = actionsmap
+        logger.info("actions map '%s' reloaded", self._actionsmap_yml)
+        return True
+
+    def watch_actionsmap(self):
+        """Reload the actions map whenever one of its files changes
+
+        The files the current actions map has been loaded from are polled
+        every 'reload_interval' seconds.
+
+        """
+
+        def stat():
+            stats = {}
+            for path in self._actionsmap.files:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Wait for the file to be written again
+                    return None
+                stats[path] = (st.st_mtime_ns, st.st_size)
+            return stats
+
+        last = stat()
+        while True:
+            time.sleep(self.reload_interval)
+            current = stat()
+            if current is not None and current != last:
+                self.reload_actionsmap()
+                # The files of the reloaded actions map may be other ones
+                last = stat()
+
+    def run(
+        self,
+        host="localhost",
+        port=80,
+        workers=1,
+        preload=[],
+        unix_socket=None,
+        unix_socket_mode=0o660,
+    ):
         """Run the moulinette
 
         Start a server instance on the given port to serve moulinette
-        actions.
+        actions - or on the socket passed by systemd with socket
+        activation, or on a Unix domain socket.
+
+        With more than one worker, the actions map, the translations and
+        the modules to preload are loaded once in a master process which
+        then forks the worker processes serving the same socket. Worker
+        processes which exit are restarted, and the lock they may have
+        held is released. As each worker process has its own caches,
+        invalidate_caches() must be called when the data they hold is
+        changed.
 
         Keyword arguments:
             - host -- Server address to bind to
             - port -- Server port to bind to
+            - workers -- The number of worker processes
+            - preload -- A list of modules to import before forking
+                worker processes, e.g. the ones of the actions
+            - unix_socket -- The path of a Unix domain socket to listen on
+                instead of the host and port
+            - unix_socket_mode -- The permissions of the Unix domain socket
 
         """
 
-        logger.debug(
-            "starting the server instance in %s:%d",
-            host,
-            port,
-        )
+        listener = systemd_listener()
+        if listener is not None:
+            address = "the socket passed by systemd"
+        elif unix_socket is not None:
+            address = unix_socket
+        else:
+            address = "%s:%d" % (host, port)
+        logger.debug("starting the server instance on %s", address)
 
         try:
-            from gevent import monkey
+            for module in preload:
+                import_module(module)
 
-            monkey.patch_all()
-            from bottle import GeventServer
-
-            GeventServer(host, port).run(self._app)
+            if listener is None and unix_socket is not None:
+                listener = unix_listener(unix_socket, unix_socket_mode)
+            else:
+                unix_socket = None
+
+            if workers > 1:
+                if self._metrics is not None:
+                    self._metrics.directory = mkdtemp(prefix="moulinette-metrics-")
+                if listener is None:
+                    listener = socket.create_server(
+                        (host, port),
+                        family=socket.AF_INET6 if ":" in host else socket.AF_INET,
+                        backlog=1024,
+                    )
+                pool = _WorkerPool(
+                    lambda: self._serve(listener=listener),
+                    workers,
+                    on_exit=self._worker_exited,
+                    forward=[signal.SIGUSR1] if self._diagnostics else [],
+                )
+                try:
+                    pool.run()
+                finally:
+                    if self._metrics is not None:
+                        rmtree(self._metrics.directory, ignore_errors=True)
+            elif listener is not None:
+                self._serve(listener=listener)
+            else:
+                self._serve(host, port)
         except IOError as e:
-            error_message = "unable to start the server instance on %s:%d: %s" % (
-                host,
-                port,
+            error_message = "unable to start the server instance on %s: %s" % (
+                address,
                 e,
             )
             logger.exception(error_message)
             if e.args[0] == errno.EADDRINUSE:
                 raise MoulinetteError("server_already_running")
             raise MoulinetteError(error_message)
+        finally:
+            # Remove the file of the Unix domain socket listened on
+            if unix_socket is not None and listener is not None:
+                try:
+                    os.remove(unix_socket)
+                except OSError:
+                    pass
+
+    def _serve(self, host=None, port=None, listener=None):
+        # Fork the process pool of actions before gevent patches things
+        self._actionsmap.executor.start()
+
+        from gevent import monkey
+
+        monkey.patch_all()
+
+        # Bottle keeps the request and response in thread locals created when
+        # it was imported, i.e. before gevent patched them: recreate them so
+        # that each greenlet has its own
+        LocalRequest.environ = _local_property()
+        for name in ("_status_line", "_status_code", "_cookies", "_headers", "body"):
+            setattr(LocalResponse, name, _local_property())
+
+        if self._metrics is not None and self._metrics.directory is not None:
+            Thread(target=self._metrics.dump_periodically, daemon=True).start()
+        if self.reload_interval:
+            Thread(target=self.watch_actionsmap, daemon=True).start()
+        if self._access_log is not None:
+            self._access_log.start()
+        if self._diagnostics is not None:
+            self._diagnostics.start()
+            signal.signal(signal.SIGUSR1, self._diagnostics.log_report)
+
+        handler_class = websocket_handler(frozenset(self.allowed_cors_origins))
+        try:
+            if listener is not None:
+                _GeventSocketServer(listener, handler_class=handler_class).run(
+                    self._app
+                )
+            else:
+                GeventServer(host, port, handler_class=handler_class).run(self._app)
+        finally:
+            self._actionsmap.executor.shutdown(wait=True)
+            if self._actionsmapplugin.jobs is not None:
+                self._actionsmapplugin.jobs.shutdown()
+            # Also captured for the actions called through WebSockets
+            _release_logs()
+            if self._access_log is not None:
+                self._access_log.stop()
+            if self._diagnostics is not None:
+                self._diagnostics.stop()
+            if self._metrics is not None and self._metrics.directory is not None:
+                self._metrics.dump()
+
+    def _worker_exited(self, pid):
+        MoulinetteLock(self._actionsmap.namespace).release_stale(pid)
+        if self._metrics is not None:
+            self._metrics.retire(pid)
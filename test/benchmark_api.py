@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 YunoHost Contributors
+#
+# This file is part of YunoHost (see https://yunohost.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Measure the requests per second the API serves on trivial routes
+
+Requests are passed directly to the WSGI application, so that what is
+measured is the request pipeline of the moulinette and not the server.
+
+    python test/benchmark_api.py [--requests N]
+
+"""
+
+import argparse
+import io
+import shutil
+import sys
+import tempfile
+import time
+
+
+def setup_api(tmp_dir):
+    import moulinette
+    import moulinette.core
+    from moulinette.interfaces.api import Interface
+
+    namespace = "moulitest"
+    shutil.copy("./test/actionsmap/moulitest.yml", f"{tmp_dir}/moulitest.yml")
+    shutil.copytree("./test/src", f"{tmp_dir}/lib/{namespace}/")
+    shutil.copytree("./test/locales", f"{tmp_dir}/locales")
+    sys.path.insert(0, f"{tmp_dir}/lib")
+
+    moulinette.core.MoulinetteLock.base_lockfile = f"{tmp_dir}/moulinette_%s.lock"
+    moulinette.m18n.set_locales_dir(f"{tmp_dir}/locales")
+
+    return Interface(
+        actionsmap=f"{tmp_dir}/moulitest.yml",
+        allowed_cors_origins=["https://example.org"],
+    )._app
+
+
+def bench(app, method, path, headers={}, requests=10000):
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def environ():
+        env = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": "",
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr,
+        }
+        env.update(headers)
+        return env
+
+    # Warm up the route
+    for _ in range(100):
+        b"".join(app(environ(), start_response))
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        b"".join(app(environ(), start_response))
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    args = parser.parse_args()
+
+    cors = {"HTTP_ORIGIN": "https://example.org"}
+    cases = [
+        ("GET /test-auth/none", "GET", "/test-auth/none", {}),
+        ("GET /test-auth/none (CORS)", "GET", "/test-auth/none", cors),
+        ("OPTIONS /test-auth/none (preflight)", "OPTIONS", "/test-auth/none", cors),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = setup_api(tmp_dir)
+        for name, method, path, headers in cases:
+            rps = bench(app, method, path, headers, args.requests)
+            print(f"{name:40} {rps:10.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
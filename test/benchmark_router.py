@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 YunoHost Contributors
+#
+# This file is part of YunoHost (see https://yunohost.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Compare the Bottle router with the router of the actions map routes
+
+Both routers are filled with the same generated routes, half of them
+with a wildcard, and resolve the paths of the first and the last ones.
+
+    python test/benchmark_router.py [--routes N] [--lookups N]
+
+"""
+
+import argparse
+import time
+
+from bottle import Router
+
+from moulinette.interfaces.api import _RouteTable
+
+
+def generate_routes(count):
+    routes = []
+    for i in range(count):
+        if i % 2:
+            routes.append((f"/category{i}/<name>/action", f"/category{i}/foo/action"))
+        else:
+            routes.append((f"/category{i}/action", f"/category{i}/action"))
+    return routes
+
+
+def bench(match, paths, lookups):
+    start = time.perf_counter()
+    for _ in range(lookups):
+        for path in paths:
+            match(path)
+    return lookups * len(paths) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    routes = generate_routes(args.routes)
+    bottle_router = Router()
+    table = _RouteTable()
+    for rule, _ in routes:
+        bottle_router.add(rule, "GET", rule)
+        table.add("GET", rule, rule)
+
+    def bottle_match(path):
+        return bottle_router.match({"REQUEST_METHOD": "GET", "PATH_INFO": path})
+
+    def table_match(path):
+        return table.match("GET", path)
+
+    cases = [
+        ("first static route", [routes[0][1]]),
+        ("first wildcard route", [routes[1][1]]),
+        ("last static route", [routes[-2][1]]),
+        ("last wildcard route", [routes[-1][1]]),
+    ]
+    print(f"{args.routes} routes")
+    for name, paths in cases:
+        bottle_rate = bench(bottle_match, paths, args.lookups)
+        table_rate = bench(table_match, paths, args.lookups)
+        print(
+            f"{name:25} bottle {bottle_rate:10.0f}/s   radix {table_rate:10.0f}/s"
+            f"   x{table_rate / bottle_rate:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -118,7 +118,8 @@ def moulinette(tmp_path_factory):
 
 
 @pytest.fixture
-def moulinette_webapi(moulinette):
+def moulinette_webapi_factory(moulinette):
+    """Build an API interface with the given arguments, and a test app on it"""
     from webtest import TestApp
     from webtest.app import CookiePolicy
 
@@ -131,7 +132,26 @@ def moulinette_webapi(moulinette):
 
     from moulinette.interfaces.api import Interface as Api
 
-    return TestApp(Api(routes={}, actionsmap=moulinette._actionsmap_path)._app)
+    def factory(**kwargs):
+        kwargs.setdefault("actionsmap", moulinette._actionsmap_path)
+        interface = Api(routes={}, **kwargs)
+        return interface, TestApp(interface._app)
+
+    return factory
+
+
+@pytest.fixture
+def moulinette_webapi(moulinette_webapi_factory):
+    return moulinette_webapi_factory()[1]
+
+
+@pytest.fixture
+def actionsmap(moulinette, tmp_path):
+    """Copy the test actions map to a temporary file that tests can modify"""
+    path = tmp_path / "moulitest.yml"
+    with open(moulinette._actionsmap_path) as f:
+        path.write_text(f.read())
+    return path
 
 
 @pytest.fixture
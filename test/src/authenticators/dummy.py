@@ -36,6 +36,9 @@ class Authenticator(BaseAuthenticator):
 
     name = "dummy"
 
+    session_cookie_name = "moulitest"
+    session_cache_ttl = 60
+
     def __init__(self, *args, **kwargs):
         pass
 
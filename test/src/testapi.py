@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 YunoHost Contributors
+#
+# This file is part of YunoHost (see https://yunohost.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import logging
+import threading
+
+from moulinette import Moulinette
+from moulinette.core import MoulinetteValidationError
+
+logger = logging.getLogger("moulitest.testapi")
+
+
+def testapi_stream(count):
+    for i in range(count):
+        yield {"id": i}
+
+
+def testapi_list(count):
+    return {"items": {f"item{i}": {"id": i} for i in range(count)}, "count": count}
+
+
+def testapi_paged(limit=None, offset=0):
+    items = list(range(10))
+    end = offset + limit if limit is not None else None
+    return items[offset:end]
+
+
+def testapi_users(fields=None):
+    users = {
+        "alice": {"username": "alice", "mail": "alice@example.org", "groups": []},
+        "bob": {"username": "bob", "mail": "bob@example.org", "groups": ["admins"]},
+    }
+    return {"users": users, "count": len(users), "requested_fields": fields}
+
+
+# The versions of the resources, and the number of times they were read
+versions = {"default": 1}
+reads = []
+
+
+def testapi_version(name):
+    reads.append(name)
+    return {"name": name, "version": versions.get(name)}
+
+
+def testapi_version_validator(name):
+    return versions.get(name)
+
+
+def testapi_job(message):
+    logger.info("processing %s", message)
+    Moulinette.display("done", "success")
+    return {"message": message}
+
+
+def testapi_thread():
+    return threading.current_thread() is not threading.main_thread()
+
+
+def testapi_process(fail=False):
+    if fail:
+        raise MoulinetteValidationError("Failed in process", raw_msg=True)
+    return os.getpid()
+
+
+def testapi_upload(file, path=None):
+    ret = {"content": file.read(), "file": file.name}
+    if path is not None:
+        with open(path) as f:
+            ret["path"] = path
+            ret["path_content"] = f.read()
+    return ret
@@ -0,0 +1,2002 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2024 YunoHost Contributors
+#
+# This file is part of YunoHost (see https://yunohost.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import time
+import threading
+
+import pytest
+
+from moulinette import m18n
+
+
+class TestStreamingAPI:
+    def test_stream_json_array(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/stream?count=5", status=200)
+
+        assert r.content_type == "application/json"
+        assert json.loads(r.text) == [{"id": i} for i in range(5)]
+
+    def test_stream_empty(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/stream?count=0", status=200)
+
+        assert json.loads(r.text) == []
+
+    def test_stream_ndjson(self, moulinette_webapi):
+        r = moulinette_webapi.get(
+            "/test-api/stream?count=3",
+            headers={"Accept": "application/x-ndjson"},
+            status=200,
+        )
+
+        assert r.content_type == "application/x-ndjson"
+        lines = r.text.splitlines()
+        assert [json.loads(line) for line in lines] == [{"id": i} for i in range(3)]
+
+    def test_stream_error(self):
+        from moulinette.core import MoulinetteValidationError
+        from moulinette.interfaces.api import stream_for_response
+
+        def items():
+            yield {"id": 0}
+            raise MoulinetteValidationError("Failed while streaming", raw_msg=True)
+
+        body = "".join(stream_for_response(items()))
+        assert json.loads(body) == [{"id": 0}, {"error": "Failed while streaming"}]
+
+        lines = "".join(stream_for_response(items(), ndjson=True)).splitlines()
+        assert json.loads(lines[-1]) == {"error": "Failed while streaming"}
+
+    def test_lock_taking_results_not_streamed(self, moulinette):
+        from collections.abc import Iterator
+        from moulinette.actionsmap import ActionsMap
+        from moulinette.interfaces.api import ActionsMapParser
+
+        actionsmap = ActionsMap(moulinette._actionsmap_path, ActionsMapParser())
+        tid = ("moulitest", "testapi", "stream")
+        ret = actionsmap.run_action(tid, {"count": 2}, want_to_take_lock=False)
+        assert isinstance(ret, Iterator)
+
+        # The items are produced while the lock is held
+        ret = actionsmap.run_action(tid, {"count": 2}, 5, want_to_take_lock=True)
+        assert ret == [{"id": 0}, {"id": 1}]
+
+
+class TestJobsAPI:
+    def wait_for(self, webapi, job_id):
+        for _ in range(100):
+            infos = webapi.get(f"/jobs/{job_id}", status=200).json
+            if infos["status"] in ("success", "error"):
+                return infos
+            time.sleep(0.05)
+        raise AssertionError("job did not complete")
+
+    @pytest.fixture
+    def webapi(self, moulinette_webapi_factory):
+        return moulinette_webapi_factory(async_workers=1)[1]
+
+    def test_job(self, webapi):
+        r = webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"Prefer": "respond-async", "X-Requested-With": ""},
+            status=202,
+        )
+        job_id = r.json["id"]
+        assert r.headers["Location"].endswith(f"/jobs/{job_id}")
+
+        assert self.wait_for(webapi, job_id)["status"] == "success"
+        assert webapi.get(f"/jobs/{job_id}/result").json == {"message": "hello"}
+
+        logs = webapi.get(f"/jobs/{job_id}/logs").json
+        assert {"level": "info", "message": "processing hello"} in logs["logs"]
+        assert {"level": "success", "message": "done"} in logs["logs"]
+
+        logs = webapi.get(f"/jobs/{job_id}/logs?since={logs['next']}")
+        assert logs.json["logs"] == []
+
+    def test_job_without_prefer_is_processed_inline(self, webapi):
+        r = webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"X-Requested-With": ""},
+            status=201,
+        )
+        assert r.json == {"message": "hello"}
+
+    def test_unknown_job(self, webapi):
+        webapi.get("/jobs/unknown", status=404)
+
+    def test_disabled_by_default(self, moulinette_webapi):
+        moulinette_webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"Prefer": "respond-async", "X-Requested-With": ""},
+            status=201,
+        )
+        moulinette_webapi.get("/jobs", status=405)
+
+    def test_log_capture(self, moulinette_webapi_factory):
+        import logging
+        from moulinette.interfaces.api import _job_log_handler, _release_logs
+
+        # Captured for the WebSocket calls of other tests
+        _release_logs()
+        api, webapi = moulinette_webapi_factory(async_workers=1)
+        assert _job_log_handler not in logging.getLogger().handlers
+
+        r = webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"Prefer": "respond-async", "X-Requested-With": ""},
+            status=202,
+        )
+        self.wait_for(webapi, r.json["id"])
+        assert _job_log_handler in logging.getLogger().handlers
+
+        api._actionsmapplugin.jobs.shutdown()
+        assert _job_log_handler not in logging.getLogger().handlers
+
+
+class TestExecutorsAPI:
+    def test_thread_executor(self, moulinette_webapi):
+        assert moulinette_webapi.get("/test-api/thread", status=200).json is True
+
+    def test_process_executor(self, moulinette_webapi):
+        pid = moulinette_webapi.get("/test-api/process", status=200).json
+        assert pid != os.getpid()
+
+    def test_process_executor_error(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/process?fail", status=400)
+        assert r.text == "Failed in process"
+
+    def test_unexpected_error(self, moulinette_webapi, monkeypatch, caplog):
+        from moulitest import testapi
+
+        def testapi_thread():
+            raise ValueError("unexpected")
+
+        monkeypatch.setattr(testapi, "testapi_thread", testapi_thread)
+        r = moulinette_webapi.get("/test-api/thread", status=500)
+        assert "ValueError: unexpected" in json.loads(r.text)["traceback"]
+        assert (
+            "unable to process the action of the route GET /test-api/thread"
+            in caplog.text
+        )
+        assert "ValueError: unexpected" in caplog.text
+
+
+class TestLocaleAPI:
+    def test_request_locale(self, moulinette_webapi):
+        r = moulinette_webapi.get("/logout", headers={"locale": "fr"}, status=401)
+        assert r.text == "Vous n'êtes pas connecté"
+
+        r = moulinette_webapi.get("/logout", status=401)
+        assert r.text == "You are not logged in"
+
+    def test_context_locale_is_not_shared(self, moulinette):
+        translations = {}
+
+        def translate():
+            m18n.use_locale("fr")
+            translations["thread"] = m18n.g("logged_out")
+
+        thread = threading.Thread(target=translate)
+        thread.start()
+        thread.join()
+
+        assert translations["thread"] == "Déconnecté"
+        assert m18n.g("logged_out") == "Logged out"
+
+
+class TestUploadAPI:
+    def upload(self, webapi, files, status=201):
+        return webapi.post(
+            "/test-api/upload",
+            upload_files=files,
+            headers={"X-Requested-With": ""},
+            status=status,
+        )
+
+    def test_upload(self, moulinette_webapi):
+        r = self.upload(
+            moulinette_webapi,
+            [("file", "foo.txt", b"foo"), ("path", "bar.txt", b"bar" * 100000)],
+        )
+
+        assert r.json["content"] == "foo"
+        assert r.json["path_content"] == "bar" * 100000
+        assert os.path.dirname(r.json["file"]) == os.path.dirname(r.json["path"])
+        # The spool is removed with the request
+        assert not os.path.exists(r.json["file"])
+
+    def test_upload_streamed(self, moulinette_webapi_factory, monkeypatch):
+        from moulitest import testapi
+
+        def testapi_upload(file, path=None):
+            yield {"exists": os.path.exists(path)}
+            with open(path) as f:
+                yield {"path_content": f.read()}
+
+        monkeypatch.setattr(testapi, "testapi_upload", testapi_upload)
+        api, webapi = moulinette_webapi_factory()
+        _, parser = api._actionsmap.parser._parsers[("POST", "/test-api/upload")]
+        parser.want_to_take_lock = False
+
+        r = self.upload(
+            webapi, [("file", "foo.txt", b"foo"), ("path", "bar.txt", b"bar")]
+        )
+        # The uploaded files are kept until the result is streamed
+        assert r.json == [{"exists": True}, {"path_content": "bar"}]
+
+    def test_upload_too_large(self, moulinette_webapi_factory):
+        _, webapi = moulinette_webapi_factory(upload_max_size=1000)
+        self.upload(webapi, [("file", "foo.txt", b"foo" * 1000)], status=413)
+        self.upload(webapi, [("file", "foo.txt", b"foo")])
+
+    def test_upload_path_opt_in(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory()
+        _, parser = api._actionsmap.parser._parsers[("POST", "/test-api/upload")]
+        parser.upload_path = False
+
+        r = self.upload(webapi, [("file", "foo.txt", b"foo"), ("path", "bar.txt", b"")])
+        assert r.json["content"] == "foo"
+        assert "path" not in r.json
+
+    def test_invalid_multipart(self, moulinette_webapi):
+        r = moulinette_webapi.post(
+            "/test-api/upload",
+            b"--other\r\n",
+            content_type="multipart/form-data; boundary=Boundary",
+            headers={"X-Requested-With": ""},
+            status=400,
+        )
+        assert "Invalid multipart body" in r.text
+
+    def test_too_large_while_streaming(self, monkeypatch):
+        import io
+        from bottle import HTTPResponse, request
+        from moulinette.interfaces import api
+
+        # Parts and delimiters are split across chunks
+        monkeypatch.setattr(api, "UPLOAD_CHUNK_SIZE", 7)
+        body = (
+            b"--Boundary\r\n"
+            b'Content-Disposition: form-data; name="message"\r\n'
+            b"\r\nhello\r\n--Boundary\r\n"
+            b'Content-Disposition: form-data; name="file"; filename="foo.txt"\r\n'
+            b"\r\n" + b"foo" * 1000 + b"\r\n--Boundary--\r\n"
+        )
+        # Without Content-Length, the limit is only enforced while streaming
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "CONTENT_TYPE": "multipart/form-data; boundary=Boundary",
+            "wsgi.input": io.BytesIO(body),
+        }
+        request.bind(environ)
+        spool = api._UploadSpool(max_size=1000)
+        try:
+            with pytest.raises(HTTPResponse) as e:
+                spool.read_multipart()
+            assert e.value.status_code == 413
+        finally:
+            spool.cleanup()
+
+        environ["wsgi.input"] = io.BytesIO(body)
+        request.bind(environ)
+        spool = api._UploadSpool(max_size=None)
+        try:
+            field, (name, upload) = spool.read_multipart()
+            assert field == ("message", "hello")
+            assert (name, upload.raw_filename) == ("file", "foo.txt")
+            assert upload.file.read() == b"foo" * 1000
+        finally:
+            spool.cleanup()
+
+
+class TestSessionCacheAPI:
+    def login(self, webapi):
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+
+    def test_session_is_verified_once(self, moulinette_webapi, mocker):
+        from moulitest.authenticators.dummy import Authenticator
+
+        self.login(moulinette_webapi)
+        spy = mocker.spy(Authenticator, "get_session_cookie")
+
+        for _ in range(3):
+            moulinette_webapi.get("/test-auth/default", status=200)
+
+        assert spy.call_count == 1
+
+    def test_session_cache_key(self):
+        from moulitest.authenticators.dummy import Authenticator
+
+        authenticator = Authenticator()
+        assert authenticator.get_session_cache_key(None) is None
+        key = authenticator.get_session_cache_key("token")
+        assert key == authenticator.get_session_cache_key("token")
+        assert key != authenticator.get_session_cache_key("other")
+
+    def test_logout_invalidates_session(self, moulinette_webapi):
+        plugin = next(
+            p
+            for p in moulinette_webapi.app.plugins
+            if getattr(p, "name", None) == "actionsmap"
+        )
+
+        self.login(moulinette_webapi)
+        moulinette_webapi.get("/test-auth/default", status=200)
+        assert len(plugin.sessions) == 1
+
+        moulinette_webapi.get("/logout", status=200)
+        assert len(plugin.sessions) == 0
+        moulinette_webapi.get("/test-auth/default", status=401)
+
+    def test_logout_reaches_other_workers(self, moulinette_webapi):
+        from moulinette.interfaces.api import _CacheGeneration, _TTLCache
+
+        plugin = next(
+            p
+            for p in moulinette_webapi.app.plugins
+            if getattr(p, "name", None) == "actionsmap"
+        )
+        # The cache of another worker process, sharing the generation
+        sessions = _TTLCache()
+        worker = _CacheGeneration([sessions])
+        worker._value = plugin.caches._value
+
+        self.login(moulinette_webapi)
+        moulinette_webapi.get("/test-auth/default", status=200)
+        sessions.set("session", {})
+        worker.sync()
+        assert len(sessions) == 1
+
+        moulinette_webapi.get("/logout", status=200)
+        worker.sync()
+        assert len(sessions) == 0
+
+
+class TestPreforkAPI:
+    def test_worker_pool_restarts_exited_workers(self, tmp_path):
+        from moulinette.interfaces.api import _WorkerPool
+
+        started = tmp_path / "started"
+
+        def serve():
+            with open(started, "a") as f:
+                f.write("%d\n" % os.getpid())
+            # The first worker process exits right away
+            try:
+                open(tmp_path / "exited", "x").close()
+            except FileExistsError:
+                time.sleep(30)
+
+        exited = []
+        pool = _WorkerPool(serve, 2, on_exit=exited.append)
+        pool.restart_delay = 0.1
+        timer = threading.Timer(1, pool.stop)
+        timer.start()
+        pool.run()
+        timer.join()
+
+        with open(started) as f:
+            pids = [int(pid) for pid in f.read().split()]
+        assert len(pids) == 3
+        assert sorted(exited) == sorted(pids)
+        assert pool.pids == {}
+
+    def test_invalidate_caches(self, moulinette_webapi):
+        from moulinette import Moulinette
+
+        interface = Moulinette.interface
+        sessions = interface._caches.caches[0]
+        other = {"key": "value"}
+        interface.register_cache(other)
+
+        sessions.set("session", {"id": "foo"}, 60)
+        interface.invalidate_caches()
+        moulinette_webapi.get("/test-auth/none", status=200)
+
+        assert len(sessions) == 0
+        assert other == {}
+
+    def test_release_stale_lock(self, moulinette):
+        from moulinette.core import MoulinetteLock
+
+        lock = MoulinetteLock("moulitest")
+        with open(lock._lockfile, "w") as f:
+            f.write("1234")
+
+        lock.release_stale(4321)
+        assert os.path.exists(lock._lockfile)
+
+        lock.release_stale(1234)
+        assert not os.path.exists(lock._lockfile)
+
+
+class TestAdmissionAPI:
+    def test_rejected_when_queue_is_full(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(
+            admission={"max_requests": 1, "max_waiting_requests": 0, "retry_after": 3}
+        )
+
+        with api.admission.admit(locking=False):
+            r = webapi.get("/test-auth/none", status=503)
+        assert r.headers["Retry-After"] == "3"
+        assert r.json["rejected"] == 1
+
+        webapi.get("/test-auth/none", status=200)
+        assert api.admission.stats()["admitted"] == 2
+
+    def test_rejected_after_queue_timeout(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(
+            admission={"max_locking_requests": 1, "queue_timeout": 0.1}
+        )
+
+        with api.admission.admit(locking=True):
+            # Actions not taking the lock are still admitted
+            webapi.get("/test-auth/none", status=200)
+            r = webapi.post(
+                "/test-api/job",
+                {"message": "hello"},
+                headers={"X-Requested-With": ""},
+                status=503,
+            )
+        assert r.json["timed_out"] == 1
+        assert r.json["waiting"] == 0
+
+    def test_waiting_request_is_admitted(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(admission={"max_requests": 1})
+
+        def release(slot):
+            time.sleep(0.2)
+            slot.__exit__(None, None, None)
+
+        slot = api.admission.admit(locking=False)
+        slot.__enter__()
+        threading.Thread(target=release, args=(slot,)).start()
+
+        webapi.get("/test-auth/none", status=200)
+        assert api.admission.stats()["in_flight"]["all"] == 0
+
+    def test_streamed_result_keeps_its_slot(
+        self, moulinette_webapi_factory, monkeypatch
+    ):
+        from moulitest import testapi
+
+        api, webapi = moulinette_webapi_factory(admission={"max_requests": 1})
+
+        def testapi_stream(count):
+            for i in range(count):
+                yield api.admission.stats()["in_flight"]["all"]
+
+        monkeypatch.setattr(testapi, "testapi_stream", testapi_stream)
+        r = webapi.get("/test-api/stream?count=2", status=200)
+        assert r.json == [1, 1]
+        assert api.admission.stats()["in_flight"]["all"] == 0
+
+
+class TestMetricsAPI:
+    def test_metrics_disabled_by_default(self, moulinette_webapi):
+        r = moulinette_webapi.get("/metrics", expect_errors=True)
+        assert r.status_int >= 400
+
+    def test_metrics(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(metrics=True)
+
+        webapi.get("/test-auth/none", status=200)
+        webapi.get("/test-auth/none", status=200)
+        webapi.get("/test-auth/default", status=401)
+        webapi.post(
+            "/test-api/job", {"message": "hello"}, headers={"X-Requested-With": ""}
+        )
+
+        r = webapi.get("/metrics", status=200)
+        assert r.content_type == "text/plain"
+        metrics = r.text.splitlines()
+
+        assert "# TYPE moulinette_requests_total counter" in metrics
+        assert (
+            'moulinette_requests_total{route="GET /test-auth/none",status="200"} 2'
+            in metrics
+        )
+        assert (
+            'moulinette_requests_total{route="GET /test-auth/default",status="401"} 1'
+            in metrics
+        )
+        assert (
+            'moulinette_request_duration_seconds_count{route="GET /test-auth/none"} 2'
+            in metrics
+        )
+        assert (
+            'moulinette_request_duration_seconds_bucket{route="GET /test-auth/none",le="+Inf"} 2'
+            in metrics
+        )
+        assert "moulinette_authentication_duration_seconds_count 1" in metrics
+        assert "moulinette_lock_wait_seconds_count 1" in metrics
+        assert "moulinette_lock_hold_seconds_count 1" in metrics
+        assert "moulinette_serialization_duration_seconds_count 3" in metrics
+        assert "moulinette_requests_in_flight 0" in metrics
+        assert any(
+            m.startswith("moulinette_process_resident_memory_bytes{pid=")
+            for m in metrics
+        )
+
+    def test_metrics_of_worker_processes(self, moulinette, tmp_path):
+        from moulinette.interfaces.api import _Metrics
+
+        # Fake the dumps of two worker processes
+        worker = _Metrics(str(tmp_path))
+        worker.inc("moulinette_requests_total", (("route", "GET /"), ("status", 200)))
+        worker.observe("moulinette_lock_wait_seconds", 0.2)
+        for pid in (1234, 5678):
+            worker.dump()
+            os.rename(tmp_path / f"{os.getpid()}.json", tmp_path / f"{pid}.json")
+
+        metrics = _Metrics(str(tmp_path))
+        lines = metrics.render().splitlines()
+        assert 'moulinette_requests_total{route="GET /",status="200"} 2' in lines
+        assert 'moulinette_lock_wait_seconds_bucket{le="0.1"} 0' in lines
+        assert 'moulinette_lock_wait_seconds_bucket{le="0.25"} 2' in lines
+
+        # Counters of exited workers are kept, but not their gauges
+        metrics.retire(1234)
+        assert not os.path.exists(tmp_path / "1234.json")
+        with open(tmp_path / "exited.json") as f:
+            assert json.load(f)["gauges"] == []
+        lines = metrics.render().splitlines()
+        assert 'moulinette_requests_total{route="GET /",status="200"} 2' in lines
+        assert "moulinette_lock_wait_seconds_count 2" in lines
+
+
+class TestServerTimingAPI:
+    def phases(self, r):
+        return [m.split(";")[0] for m in r.headers["Server-Timing"].split(", ")]
+
+    def test_server_timing_on_request(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-auth/none")
+        assert "Server-Timing" not in r.headers
+
+        r = moulinette_webapi.get("/test-auth/none", headers={"X-Server-Timing": "1"})
+        assert self.phases(r) == [
+            "middleware",
+            "args",
+            "auth",
+            "parse",
+            "import",
+            "action",
+            "serialize",
+            "total",
+        ]
+
+        r = moulinette_webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"X-Requested-With": "", "X-Server-Timing": "1"},
+        )
+        assert "lock_wait" in self.phases(r)
+
+    def test_server_timing_on_errors(self, moulinette_webapi):
+        r = moulinette_webapi.get(
+            "/test-auth/default", headers={"X-Server-Timing": "1"}, status=401
+        )
+        assert self.phases(r)[-1] == "total"
+
+    def test_server_timing_always(self, moulinette_webapi_factory):
+        _, webapi = moulinette_webapi_factory(server_timing=True)
+        r = webapi.get("/test-auth/none")
+        assert 'action;desc="Action";dur=' in r.headers["Server-Timing"]
+
+
+class TestPipelineAPI:
+    origin = "https://example.org"
+
+    def test_cors(self, moulinette_webapi_factory):
+        _, webapi = moulinette_webapi_factory(allowed_cors_origins=[self.origin])
+
+        r = webapi.get("/test-auth/none", headers={"Origin": self.origin})
+        assert r.headers["Access-Control-Allow-Origin"] == self.origin
+        assert r.headers["Access-Control-Allow-Credentials"] == "true"
+        assert "Access-Control-Max-Age" not in r.headers
+
+        r = webapi.get(
+            "/test-auth/default", headers={"Origin": self.origin}, status=401
+        )
+        assert r.headers["Access-Control-Allow-Origin"] == self.origin
+
+        r = webapi.get("/test-auth/none", headers={"Origin": "https://evil.org"})
+        assert "Access-Control-Allow-Origin" not in r.headers
+
+    def test_cors_preflight(self, moulinette_webapi_factory):
+        _, webapi = moulinette_webapi_factory(
+            allowed_cors_origins=[self.origin], cors_max_age=3600
+        )
+
+        r = webapi.options("/test-auth/none", headers={"Origin": self.origin})
+        assert r.status_int == 204
+        assert r.headers["Access-Control-Allow-Origin"] == self.origin
+        assert r.headers["Access-Control-Max-Age"] == "3600"
+
+        r = webapi.options("/test-auth/none", headers={"Origin": "https://evil.org"})
+        assert "Access-Control-Max-Age" not in r.headers
+
+    def test_csrf(self, moulinette_webapi_factory):
+        _, webapi = moulinette_webapi_factory(allowed_cors_origins=[self.origin])
+
+        r = webapi.post("/test-api/job", {"message": "hello"}, status=403)
+        assert "CSRF protection" in r.text
+        webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"X-Requested-With": ""},
+            status=201,
+        )
+
+
+class TestSSEHub:
+    def hub(self, **kwargs):
+        from moulinette.interfaces.api import _SSEHub
+
+        return _SSEHub(**kwargs)
+
+    def test_clients_share_the_upstream_stream(self):
+        done = threading.Event()
+        calls = []
+
+        def source():
+            calls.append(1)
+            for i in range(3):
+                yield f"data: {i}\n\n"
+            done.wait(5)
+
+        hub = self.hub(source=source)
+        first = hub.subscribe()
+        second = hub.subscribe(last_event_id=0)
+
+        expected = [f"id: {i + 1}\ndata: {i}\n\n" for i in range(3)]
+        assert [next(first) for _ in range(3)] == expected
+        assert [next(second) for _ in range(3)] == expected
+        assert calls == [1]
+        assert hub.subscribers == 2
+
+        first.close()
+        second.close()
+        done.set()
+        assert hub.subscribers == 0
+
+    def test_resume_and_lag(self):
+        hub = self.hub(source=None, size=3, heartbeat=0.01)
+        client = hub.subscribe()
+        assert next(client) == ": heartbeat\n\n"
+
+        for i in range(5):
+            hub.publish(f"data: {i}\n\n")
+
+        # The client fell behind the buffer
+        assert next(client) == 'event: lagged\ndata: {"dropped": 2}\n\n'
+        assert next(client) == "id: 3\ndata: 2\n\n"
+
+        resumed = hub.subscribe(last_event_id=4)
+        assert next(resumed) == "id: 5\ndata: 4\n\n"
+        assert next(resumed) == ": heartbeat\n\n"
+
+    def test_job_events(self, moulinette_webapi_factory):
+        _, moulinette_webapi = moulinette_webapi_factory(async_workers=1)
+        plugin = next(
+            p
+            for p in moulinette_webapi.app.plugins
+            if getattr(p, "name", None) == "actionsmap"
+        )
+        plugin.sse_hub.source = None
+        plugin.sse_hub.heartbeat = 0.01
+        client = plugin.sse_hub.subscribe()
+        assert next(client) == ": heartbeat\n\n"
+
+        r = moulinette_webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"Prefer": "respond-async", "X-Requested-With": ""},
+            status=202,
+        )
+        message = next(client)
+        assert message.startswith("id: 1\nevent: job_status\n")
+        assert f'"job": "{r.json["id"]}"' in message
+        client.close()
+
+
+class FakeWebSocket:
+    def __init__(self, messages):
+        self.messages = [json.dumps(m) if isinstance(m, dict) else m for m in messages]
+        self.sent = []
+
+    def receive(self):
+        return self.messages.pop(0) if self.messages else None
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+    def wait_for(self, count, timeout=5):
+        start = time.time()
+        while len(self.sent) < count and time.time() - start < timeout:
+            time.sleep(0.01)
+        return self.sent
+
+
+class TestWebSocketAPI:
+    def connect(self, webapi, messages, status=200):
+        wsock = FakeWebSocket(messages)
+        webapi.get("/ws", extra_environ={"wsgi.websocket": wsock}, status=status)
+        return wsock
+
+    def login(self, webapi):
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+
+    def test_websocket_request_expected(self, moulinette_webapi):
+        r = moulinette_webapi.get("/ws", status=400)
+        assert r.text == m18n.g("websocket_request_expected")
+
+    def test_websocket_authentication_required(self, moulinette_webapi):
+        self.connect(moulinette_webapi, [], status=401)
+
+    def test_websocket_calls(self, moulinette_webapi):
+        self.login(moulinette_webapi)
+        wsock = self.connect(
+            moulinette_webapi,
+            [
+                {
+                    "id": 1,
+                    "method": "POST",
+                    "path": "/test-api/job",
+                    "args": {"message": "hello"},
+                },
+                {"id": 2, "method": "GET", "path": "/test-auth/default"},
+                {"id": 3, "method": "GET", "path": "/unknown"},
+                "not json",
+            ],
+        )
+        sent = wsock.wait_for(6)
+
+        assert {"type": "error", "status": 400, "error": "Invalid message"} in sent
+        assert {"id": 2, "type": "result", "result": "some_data_from_default"} in sent
+        assert any(m.get("id") == 3 and m["status"] == 404 for m in sent)
+
+        call = [m for m in sent if m.get("id") == 1]
+        assert call == [
+            {"id": 1, "type": "log", "level": "info", "message": "processing hello"},
+            {"id": 1, "type": "log", "level": "success", "message": "done"},
+            {"id": 1, "type": "result", "result": {"message": "hello"}},
+        ]
+
+    def test_websocket_call_other_profile(self, moulinette_webapi, caplog):
+        self.login(moulinette_webapi)
+        wsock = self.connect(
+            moulinette_webapi,
+            [{"id": 1, "method": "GET", "path": "/test-auth/other-profile"}],
+        )
+        [message] = wsock.wait_for(1)
+        assert message == {
+            "id": 1,
+            "type": "error",
+            "status": 401,
+            "error": m18n.g("authentication_required"),
+        }
+        assert "action called through a WebSocket failed" not in caplog.text
+
+    def test_websocket_call_error(self, moulinette_webapi):
+        self.login(moulinette_webapi)
+        wsock = self.connect(
+            moulinette_webapi,
+            [
+                {
+                    "id": "a",
+                    "method": "GET",
+                    "path": "/test-api/process",
+                    "args": {"fail": True},
+                }
+            ],
+        )
+        [message] = wsock.wait_for(1)
+        assert message["id"] == "a"
+        assert message["type"] == "error"
+        assert message["status"] == 400
+
+    def test_websocket_authenticated_once(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory()
+        self.login(webapi)
+        plugin = api._actionsmapplugin
+        verify_session = plugin._verify_session
+        verified = []
+
+        def counting_verify_session(authenticator):
+            verified.append(authenticator)
+            return verify_session(authenticator)
+
+        plugin._verify_session = counting_verify_session
+        wsock = self.connect(
+            webapi,
+            [
+                {"id": i, "method": "GET", "path": "/test-auth/default"}
+                for i in range(3)
+            ],
+        )
+        sent = wsock.wait_for(3)
+
+        assert all(m["result"] == "some_data_from_default" for m in sent)
+        assert len(verified) == 1
+
+    def test_websocket_calls_bounded(self, moulinette_webapi, monkeypatch):
+        import moulinette.interfaces.api
+
+        monkeypatch.setattr(moulinette.interfaces.api, "WEBSOCKET_MAX_CALLS", 1)
+        self.login(moulinette_webapi)
+        wsock = self.connect(
+            moulinette_webapi,
+            [
+                {"id": i, "method": "GET", "path": "/test-auth/with_arg/%d" % i}
+                for i in range(5)
+            ],
+        )
+        sent = wsock.wait_for(5)
+
+        # Each message is only read once the previous call is done
+        assert [m["id"] for m in sent] == list(range(5))
+
+    def test_websocket_cross_origin(self, moulinette_webapi):
+        self.login(moulinette_webapi)
+        wsock = FakeWebSocket([])
+        moulinette_webapi.get(
+            "/ws",
+            headers={"Origin": "https://evil.org"},
+            extra_environ={"wsgi.websocket": wsock},
+            status=403,
+        )
+        # The test app is served on localhost:80
+        moulinette_webapi.get(
+            "/ws",
+            headers={"Origin": "http://localhost:80"},
+            extra_environ={"wsgi.websocket": wsock},
+            status=200,
+        )
+
+    def test_cross_origin(self):
+        from moulinette.interfaces.api import is_cross_origin
+
+        environ = {"HTTP_HOST": "example.org"}
+        assert not is_cross_origin(environ, [])
+        environ["HTTP_ORIGIN"] = "https://example.org"
+        assert not is_cross_origin(environ, [])
+        environ["HTTP_ORIGIN"] = "https://evil.org"
+        assert is_cross_origin(environ, [])
+        assert not is_cross_origin(environ, ["https://evil.org"])
+        environ["HTTP_X_FORWARDED_HOST"] = "evil.org"
+        assert not is_cross_origin(environ, [])
+
+    def test_handler_rejects_cross_origin(self):
+        from moulinette.interfaces.api import websocket_handler
+
+        handler_class = websocket_handler(frozenset(["https://example.org"]))
+        handler = handler_class.__new__(handler_class)
+        handler.environ = {
+            "HTTP_UPGRADE": "websocket",
+            "HTTP_HOST": "localhost",
+            "HTTP_ORIGIN": "https://evil.org",
+        }
+        statuses = []
+        handler.start_response = lambda status, headers: statuses.append(status)
+
+        assert handler.upgrade_websocket() == [b"Origin not allowed"]
+        assert statuses == ["403 Forbidden"]
+
+
+class TestBatchAPI:
+    def batch(self, webapi, entries, status=200):
+        return webapi.post_json(
+            "/batch", entries, headers={"X-Requested-With": ""}, status=status
+        )
+
+    def test_batch(self, moulinette_webapi):
+        moulinette_webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        r = self.batch(
+            moulinette_webapi,
+            [
+                {"method": "GET", "path": "/test-auth/default"},
+                {"path": "/test-auth/with_arg/yoloswag"},
+                {
+                    "method": "POST",
+                    "path": "/test-api/job",
+                    "params": {"message": "hi"},
+                },
+                {"path": "/test-api/stream", "params": {"count": "2"}},
+                {"path": "/test-api/process", "params": {"fail": True}},
+                {"path": "/unknown"},
+            ],
+        )
+
+        results = r.json["results"]
+        assert results[0] == {"status": 200, "body": "some_data_from_default"}
+        assert results[1] == {"status": 200, "body": "yoloswag"}
+        assert results[2] == {"status": 201, "body": {"message": "hi"}}
+        assert results[3] == {"status": 200, "body": [{"id": 0}, {"id": 1}]}
+        assert results[4]["status"] == 400
+        assert results[5] == {"status": 404, "body": "Unknown action"}
+
+    def test_batch_authenticated_once(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory()
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        plugin = api._actionsmapplugin
+        verify_session = plugin._verify_session
+        verified = []
+
+        def counting_verify_session(authenticator):
+            verified.append(authenticator)
+            return verify_session(authenticator)
+
+        plugin._verify_session = counting_verify_session
+        r = self.batch(webapi, [{"path": "/test-auth/default"}] * 3)
+
+        assert (
+            r.json["results"] == [{"status": 200, "body": "some_data_from_default"}] * 3
+        )
+        assert len(verified) == 1
+
+    def test_response_status(self):
+        from moulinette.interfaces.api import response_status
+
+        assert response_status("POST", None) == 201
+        assert response_status("GET", None) == 200
+        assert response_status("PUT", {"a": 1}) == 200
+        assert response_status("PUT", {}) == 204
+        assert response_status("DELETE", None) == 204
+
+    def test_batch_other_profile(self, moulinette_webapi, caplog):
+        moulinette_webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        moulinette_webapi.get("/test-auth/other-profile", status=401)
+
+        r = self.batch(
+            moulinette_webapi,
+            [{"path": "/test-auth/other-profile"}, {"path": "/test-auth/default"}],
+        )
+        assert r.json["results"] == [
+            {"status": 401, "body": m18n.g("authentication_required")},
+            {"status": 200, "body": "some_data_from_default"},
+        ]
+        assert "action called within a batch failed" not in caplog.text
+
+    def test_batch_bounded(self, moulinette_webapi, monkeypatch):
+        import moulinette.interfaces.api
+
+        monkeypatch.setattr(moulinette.interfaces.api, "BATCH_MAX_ENTRIES", 3)
+        monkeypatch.setattr(moulinette.interfaces.api, "BATCH_MAX_CALLS", 1)
+        moulinette_webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        self.batch(moulinette_webapi, [{"path": "/test-auth/none"}] * 4, status=413)
+
+        r = self.batch(
+            moulinette_webapi,
+            [{"path": f"/test-auth/with_arg/{i}"} for i in range(3)],
+        )
+        assert r.json["results"] == [{"status": 200, "body": str(i)} for i in range(3)]
+
+    def test_batch_authentication_required(self, moulinette_webapi):
+        self.batch(moulinette_webapi, [{"path": "/test-auth/none"}], status=401)
+
+    def test_batch_invalid(self, moulinette_webapi):
+        self.batch(moulinette_webapi, {"path": "/test-auth/none"}, status=400)
+        self.batch(moulinette_webapi, ["/test-auth/none"], status=400)
+
+    def test_batch_csrf(self, moulinette_webapi):
+        moulinette_webapi.post("/batch", "[]", content_type="text/plain", status=403)
+
+
+class TestRouteTable:
+    def table(self, *rules):
+        from moulinette.interfaces.api import _RouteTable
+
+        table = _RouteTable()
+        for rule in rules:
+            assert table.add("GET", rule, rule)
+        return table
+
+    def test_match(self):
+        table = self.table(
+            "/",
+            "/users",
+            "/users/<username>",
+            "/users/me",
+            "/users/<username>/groups",
+            "/users/<name>/perms",
+        )
+
+        assert table.match("GET", "/") == ("/", {})
+        assert table.match("GET", "/users") == ("/users", {})
+        assert table.match("GET", "/users/me") == ("/users/me", {})
+        assert table.match("GET", "/users/alice") == (
+            "/users/<username>",
+            {"username": "alice"},
+        )
+        assert table.match("GET", "/users/me/groups") == (
+            "/users/<username>/groups",
+            {"username": "me"},
+        )
+        assert table.match("GET", "/users/bob/perms") == (
+            "/users/<name>/perms",
+            {"name": "bob"},
+        )
+        assert table.match("GET", "/users/") is None
+        assert table.match("GET", "/groups") is None
+        assert table.match("POST", "/users") is None
+        assert table.match("HEAD", "/users") == ("/users", {})
+
+    def test_filters(self):
+        table = self.table(
+            "/apps/<id:int>", "/files/<path:path>", "/tags/<tag:re:[a-z]+>"
+        )
+
+        assert table.match("GET", "/apps/42") == ("/apps/<id:int>", {"id": "42"})
+        assert table.match("GET", "/apps/abc") is None
+        assert table.match("GET", "/files/etc/hosts") == (
+            "/files/<path:path>",
+            {"path": "etc/hosts"},
+        )
+        assert table.match("GET", "/tags/abc") == (
+            "/tags/<tag:re:[a-z]+>",
+            {"tag": "abc"},
+        )
+        assert table.match("GET", "/tags/ABC") is None
+
+    def test_unsupported_rules(self):
+        from moulinette.interfaces.api import _RouteTable
+
+        table = _RouteTable()
+        assert not table.add("GET", "/files/<name>.json", "partial")
+        assert not table.add("GET", "/files/<path:path>/info", "path")
+        assert table.match("GET", "/files/abc.json") is None
+
+    def test_re_matching_slash(self, moulinette_webapi_factory, actionsmap):
+        from moulinette.interfaces.api import _RouteTable, _may_match_slash
+
+        rule = "/x/<super_arg:re:.+>"
+        table = _RouteTable()
+        assert not table.add("GET", rule, rule)
+
+        # The route is left to the router of Bottle
+        actionsmap.write_text(
+            actionsmap.read_text().replace("/test-auth/with_arg/<super_arg>", rule)
+        )
+        _, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        r = webapi.get("/x/a/b", status=200)
+        assert r.json == "a/b"
+
+        for pattern in (r"a/b", r"[^a]+", r"\D", r"[!-z]", r"(a|.)", r"x*\W", r"[^\w]"):
+            assert _may_match_slash(pattern), pattern
+        for pattern in (r"[a-z]+", r"\d+", r"[^/]+", r"(?:ab|c)*", r"\w+\.json"):
+            assert not _may_match_slash(pattern), pattern
+
+    def test_re_parser_unavailable(self, monkeypatch):
+        import re
+        import sys
+        from moulinette.interfaces.api import _may_match_slash
+
+        # Every re wildcard is left to Bottle without a usable parser
+        monkeypatch.setattr(re._parser, "parse", lambda pattern: 1 / 0)
+        assert _may_match_slash(r"[a-z]+")
+
+        monkeypatch.delattr(re, "_parser")
+        monkeypatch.setitem(sys.modules, "re._parser", None)
+        monkeypatch.setitem(sys.modules, "sre_parse", None)
+        assert _may_match_slash(r"[a-z]+")
+
+    def test_allowed_methods(self):
+        table = self.table("/users/<username>")
+        table.add("DELETE", "/users/<username>", "delete")
+
+        assert table.allowed_methods("/users/alice") == ["GET", "DELETE"]
+        assert table.allowed_methods("/groups") == []
+
+    def test_method_not_allowed(self, moulinette_webapi):
+        r = moulinette_webapi.post("/test-auth/none", status=405)
+        assert "GET" in r.headers["Allow"].split(",")
+
+
+class TestReloadAPI:
+    def test_reload_actionsmap(self, moulinette_webapi_factory, actionsmap):
+        interface, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+        webapi.get("/test-auth/none", status=200)
+
+        actionsmap.write_text(
+            actionsmap.read_text().replace(
+                "GET /test-auth/none", "GET /test-auth/renamed"
+            )
+        )
+        assert interface.reload_actionsmap()
+
+        # Only the catch-all route of the CORS preflight requests is left
+        r = webapi.get("/test-auth/none", status=405)
+        assert r.headers["Allow"] == "OPTIONS"
+        r = webapi.get("/test-auth/renamed", status=200)
+        assert r.json == "some_data_from_none"
+
+    def test_reload_invalid_actionsmap(
+        self, moulinette_webapi_factory, actionsmap, caplog
+    ):
+        interface, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+
+        actionsmap.write_text("_global: {}\n")
+        assert not interface.reload_actionsmap()
+        assert "unable to reload the actions map" in caplog.text
+
+        webapi.get("/test-auth/none", status=200)
+
+    def test_inflight_requests_keep_their_actionsmap(
+        self, moulinette_webapi_factory, actionsmap
+    ):
+        interface, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/test-auth/none"}
+        interface._app.router.match(environ)
+        current = environ["moulinette.actionsmap"]
+
+        assert interface.reload_actionsmap()
+        assert interface._actionsmap is not current
+        assert environ["moulinette.actionsmap"] is current
+        assert interface._actionsmap.executor is current.executor
+
+    def test_reload_adding_process_executor(
+        self, moulinette_webapi_factory, actionsmap, caplog
+    ):
+        content = actionsmap.read_text()
+        actionsmap.write_text(content.replace("executor: process", ""))
+        interface, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+
+        actionsmap.write_text(content)
+        assert not interface.reload_actionsmap()
+        assert "the process executor can only be used" in caplog.text
+        assert "process" not in interface._actionsmap.executor.declared
+
+    def test_watch_every_file(self, moulinette_webapi_factory, actionsmap, monkeypatch):
+        interface, _ = moulinette_webapi_factory(actionsmap=str(actionsmap))
+        extension = actionsmap.parent / "extension.yml"
+        extension.write_text("{}\n")
+        interface._actionsmap.files.append(str(extension))
+
+        class Reloaded(Exception):
+            pass
+
+        def reload_actionsmap():
+            raise Reloaded()
+
+        monkeypatch.setattr(time, "sleep", lambda seconds: extension.write_text("{}"))
+        monkeypatch.setattr(interface, "reload_actionsmap", reload_actionsmap)
+        with pytest.raises(Reloaded):
+            interface.watch_actionsmap()
+
+
+class TestPaginationAPI:
+    def test_no_paging(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/list", status=200)
+
+        assert len(r.json["items"]) == 5
+        assert r.headers["X-Total-Count"] == "5"
+        assert "X-Next-Cursor" not in r.headers
+
+    def test_limit_offset(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/list?limit=2&offset=1", status=200)
+
+        assert r.json == {
+            "items": {"item1": {"id": 1}, "item2": {"id": 2}},
+            "count": 5,
+        }
+        assert r.headers["X-Total-Count"] == "5"
+        assert "X-Next-Cursor" in r.headers
+
+    def test_cursor(self, moulinette_webapi):
+        pages = []
+        cursor = ""
+        while cursor is not None:
+            r = moulinette_webapi.get(
+                f"/test-api/list?count=5&limit=2&cursor={cursor}", status=200
+            )
+            pages.append(list(r.json["items"]))
+            cursor = r.headers.get("X-Next-Cursor")
+
+        assert pages == [["item0", "item1"], ["item2", "item3"], ["item4"]]
+
+    def test_invalid_paging(self, moulinette_webapi):
+        moulinette_webapi.get("/test-api/list?limit=two", status=400)
+        moulinette_webapi.get("/test-api/list?offset=-1", status=400)
+        moulinette_webapi.get("/test-api/list?cursor=invalid", status=400)
+
+    def test_action_paging_itself(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/paged?limit=3&offset=3", status=200)
+
+        assert r.json == [3, 4, 5]
+        assert "X-Total-Count" not in r.headers
+        assert "X-Next-Cursor" in r.headers
+
+        r = moulinette_webapi.get("/test-api/paged?limit=3&offset=9", status=200)
+        assert r.json == [9]
+        assert "X-Next-Cursor" not in r.headers
+
+    def test_stream_paging(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/stream?count=10&limit=2&offset=4")
+
+        assert r.json == [{"id": 4}, {"id": 5}]
+        assert "X-Total-Count" not in r.headers
+
+
+class TestProjectionAPI:
+    def test_no_fields(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/users", status=200)
+
+        assert r.json["count"] == 2
+        assert r.json["requested_fields"] is None
+        assert set(r.json["users"]["bob"]) == {"username", "mail", "groups"}
+
+    def test_fields(self, moulinette_webapi):
+        r = moulinette_webapi.get(
+            "/test-api/users?fields=users.*.username,users.bob.groups,count",
+            status=200,
+        )
+
+        assert r.json == {
+            "users": {
+                "alice": {"username": "alice"},
+                "bob": {"username": "bob", "groups": ["admins"]},
+            },
+            "count": 2,
+        }
+
+    def test_fields_forwarded(self, moulinette_webapi):
+        r = moulinette_webapi.get(
+            "/test-api/users?fields=requested_fields&fields=count", status=200
+        )
+
+        assert r.json == {"requested_fields": "requested_fields,count", "count": 2}
+
+    def test_fields_of_list_items(self, moulinette_webapi):
+        r = moulinette_webapi.get("/test-api/stream?count=2&fields=id", status=200)
+
+        assert r.json == [{"id": 0}, {"id": 1}]
+
+        r = moulinette_webapi.get("/test-api/stream?count=2&fields=name", status=200)
+        assert r.json == [{}, {}]
+
+    def test_invalid_fields(self, moulinette_webapi):
+        moulinette_webapi.get("/test-api/users?fields=users..mail", status=400)
+
+
+class TestIntrospectionAPI:
+    def routes(self, r):
+        return {(d["method"], d["path"]): d for d in r.json["routes"]}
+
+    def test_describe_routes(self, moulinette_webapi):
+        r = moulinette_webapi.get("/actionsmap", status=200)
+
+        assert r.headers["Cache-Control"] == "no-cache"
+        routes = self.routes(r)
+        route = routes[("GET", "/test-auth/with_extra_str_only/<only_a_str>")]
+        assert route["action"] == "testauth with_extra_str_only"
+        assert route["authentication"] == "dummy"
+        assert route["lock"] is False
+        assert route["arguments"] == [
+            {
+                "name": "only_a_str",
+                "required": True,
+                "help": "Only a String",
+                "pattern": {
+                    "regex": "^[a-zA-Z]",
+                    "message": "Must start with a letter",
+                },
+            }
+        ]
+
+        route = routes[("GET", "/test-api/stream")]
+        assert route["paginate"] is True
+        assert route["validator"] is False
+        assert routes[("GET", "/test-api/version")]["validator"] is True
+        assert route["authentication"] is None
+        assert route["arguments"] == [
+            {
+                "name": "count",
+                "required": False,
+                "help": "Number of items to stream",
+                "type": "int",
+                "default": 3,
+            }
+        ]
+
+        (fail,) = routes[("GET", "/test-api/process")]["arguments"]
+        assert fail["type"] == "bool"
+        file, path = routes[("POST", "/test-api/upload")]["arguments"]
+        assert file["type"] == "file"
+        assert routes[("POST", "/test-api/job")]["lock"] is True
+
+    def test_etag(self, moulinette_webapi):
+        r = moulinette_webapi.get("/actionsmap", status=200)
+        etag = r.headers["ETag"]
+
+        r = moulinette_webapi.get(
+            "/actionsmap", headers={"If-None-Match": etag}, status=304
+        )
+        assert r.headers["ETag"] == etag
+        assert r.body == b""
+
+        r = moulinette_webapi.get(
+            "/actionsmap", headers={"If-None-Match": '"stale"'}, status=200
+        )
+        assert r.headers["ETag"] == etag
+
+    def test_localized(self, moulinette_webapi):
+        r = moulinette_webapi.get("/actionsmap", status=200)
+        assert r.json["locale"] == "en"
+        assert r.headers["Vary"] == "Locale"
+
+        fr = moulinette_webapi.get("/actionsmap", headers={"locale": "fr"}, status=200)
+        assert fr.json["locale"] == "fr"
+        assert fr.json["routes"] == r.json["routes"]
+        assert fr.headers["ETag"] != r.headers["ETag"]
+
+    def test_new_version_on_reload(self, moulinette_webapi_factory, actionsmap):
+        interface, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+        r = webapi.get("/actionsmap", status=200)
+        etag = r.headers["ETag"]
+
+        actionsmap.write_text(
+            actionsmap.read_text().replace(
+                "GET /test-auth/none", "GET /test-auth/renamed"
+            )
+        )
+        assert interface.reload_actionsmap()
+
+        r = webapi.get("/actionsmap", headers={"If-None-Match": etag}, status=200)
+        assert r.headers["ETag"] != etag
+        assert ("GET", "/test-auth/renamed") in self.routes(r)
+        assert ("GET", "/test-auth/none") not in self.routes(r)
+
+
+class TestAccessLog:
+    def records(self, path):
+        return [json.loads(line) for line in path.read_text().splitlines()]
+
+    def test_records(self, moulinette_webapi_factory, tmp_path):
+        path = tmp_path / "access.log"
+        interface, webapi = moulinette_webapi_factory(access_log=str(path))
+        access_log = interface._access_log
+
+        r = webapi.post(
+            "/test-api/job",
+            {"message": "hello"},
+            headers={"X-Requested-With": ""},
+            status=201,
+        )
+        webapi.get("/test-auth/default", status=401)
+        access_log.flush()
+
+        job, denied = self.records(path)
+        assert job["method"] == "POST"
+        assert job["path"] == "/test-api/job"
+        assert job["route"] == "POST /test-api/job"
+        assert job["tid"] == "moulitest.testapi.job"
+        assert job["status"] == 201
+        assert job["bytes"] == len(r.body)
+        assert job["latency"] > 0
+        assert job["lock_wait"] >= 0
+        assert job["user"] is None
+        assert denied["status"] == 401
+        assert denied["tid"] == "moulitest.testauth.default"
+        assert denied["lock_wait"] is None
+
+    def test_streamed_response(self, moulinette_webapi_factory, tmp_path):
+        path = tmp_path / "access.log"
+        interface, webapi = moulinette_webapi_factory(access_log=str(path))
+        access_log = interface._access_log
+
+        r = webapi.get("/test-api/stream?count=50", status=200)
+        access_log.flush()
+
+        (record,) = self.records(path)
+        assert record["bytes"] == len(r.body)
+
+    def test_rotation(self, tmp_path):
+        from moulinette.interfaces.api import _AccessLog
+
+        path = tmp_path / "access.log"
+        access_log = _AccessLog(str(path), max_size=100, backups=2)
+        for i in range(4):
+            access_log.record({"i": i, "padding": "x" * 50})
+            access_log.flush()
+
+        assert self.records(path) == [{"i": 3, "padding": "x" * 50}]
+        assert json.loads((tmp_path / "access.log.1").read_text())["i"] == 2
+        assert json.loads((tmp_path / "access.log.2").read_text())["i"] == 1
+        assert not (tmp_path / "access.log.3").exists()
+
+    def test_writer(self, tmp_path):
+        from moulinette.interfaces.api import _AccessLog
+
+        path = tmp_path / "access.log"
+        access_log = _AccessLog(str(path), flush_interval=0.01)
+        access_log.start()
+        access_log.record({"i": 0})
+        for _ in range(100):
+            if path.exists() and path.read_text():
+                break
+            time.sleep(0.01)
+        access_log.record({"i": 1})
+        access_log.stop()
+
+        assert self.records(path) == [{"i": 0}, {"i": 1}]
+
+
+class TestDiagnosticsAPI:
+    def test_disabled(self, moulinette_webapi):
+        moulinette_webapi.get("/diagnostics", status=405)
+
+    def test_report(self, moulinette_webapi_factory):
+        interface, webapi = moulinette_webapi_factory(diagnostics=True)
+        diagnostics = interface._diagnostics
+
+        webapi.get("/diagnostics", status=401)
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        r = webapi.get("/diagnostics", status=200)
+
+        assert r.content_type == "text/plain"
+        assert "Lock of 'moulitest' free" in r.text
+        # The request of the report is being processed
+        assert "1 request(s) being processed:" in r.text
+        assert "  GET /diagnostics for " in r.text
+        assert "Thread 0x" in r.text
+        assert diagnostics.requests == {}
+
+    def test_run_times(self, moulinette_webapi_factory):
+        import greenlet
+
+        interface, _ = moulinette_webapi_factory(diagnostics=True)
+        diagnostics = interface._diagnostics
+        previous = greenlet.gettrace()
+        diagnostics.start()
+        try:
+            glet = greenlet.greenlet(lambda: time.sleep(0.01))
+            glet.switch()
+            assert diagnostics.run_times[glet] >= 0.01
+            assert "Run time of the greenlets:" in diagnostics.report()
+        finally:
+            diagnostics.stop()
+        assert greenlet.gettrace() is previous
+
+    def test_hub_blocked(self, moulinette_webapi_factory, caplog):
+        from greenlet import getcurrent
+
+        interface, _ = moulinette_webapi_factory(max_blocking_time=0.1)
+        diagnostics = interface._diagnostics
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": "/test-api/process",
+            "moulinette.tid": ("moulitest", "testapi", "process"),
+        }
+        diagnostics.requests[id(environ)] = (environ, time.perf_counter(), getcurrent())
+
+        diagnostics.start()
+        try:
+            # Block without switching to another greenlet
+            time.sleep(0.4)
+        finally:
+            diagnostics.stop()
+        assert (
+            "processing GET /test-api/process (moulitest.testapi.process) for "
+            in caplog.text
+        )
+        assert "in test_hub_blocked" in caplog.text
+        assert caplog.text.count("the event loop has been blocked") == 1
+
+
+class TestSingleFlight:
+    def test_coalesce(self):
+        from moulinette.interfaces.api import _SingleFlight
+
+        single_flight = _SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def func(value):
+            calls.append(value)
+            release.wait(5)
+            return value * 2
+
+        results = []
+
+        def call():
+            results.append(single_flight.do("key", func, 21))
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while single_flight.coalesced < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert calls == [21]
+        assert sorted(results) == [(42, False), (42, True), (42, True)]
+
+        # Calls are not coalesced once the first one is done
+        assert single_flight.do("key", func, 1) == (2, False)
+
+    def test_error_is_shared(self):
+        from moulinette.interfaces.api import _SingleFlight
+
+        single_flight = _SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def func():
+            release.wait(5)
+            raise ValueError("failed")
+
+        def call():
+            try:
+                single_flight.do("key", func)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while single_flight.coalesced < 1:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(errors) == 2 and errors[0] is errors[1]
+
+
+class TestSingleFlightAPI:
+    def test_identical_requests_are_coalesced(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(single_flight=True, metrics=True)
+        plugin = api._actionsmapplugin
+        process = plugin._process
+        release = threading.Event()
+
+        def slow_process(*args):
+            release.wait(5)
+            return process(*args)
+
+        plugin._process = slow_process
+        responses = []
+
+        def get():
+            responses.append(webapi.get("/test-api/list?limit=2", status=200))
+
+        threads = [threading.Thread(target=get) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while plugin.single_flight.coalesced < 1:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert responses[0].body == responses[1].body
+        for r in responses:
+            assert r.content_type == "application/json"
+            assert r.headers["X-Total-Count"] == "5"
+            assert list(r.json["items"]) == ["item0", "item1"]
+
+        r = webapi.get("/metrics", status=200)
+        assert (
+            'moulinette_single_flight_coalesced_total{route="GET /test-api/list"} 1'
+            in r.text.splitlines()
+        )
+
+    def test_streamed_results(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(single_flight=True, metrics=True)
+
+        r = webapi.get("/test-api/stream?count=2", status=200)
+        assert r.json == [{"id": 0}, {"id": 1}]
+
+    def test_authentication(self, moulinette_webapi_factory):
+        api, webapi = moulinette_webapi_factory(single_flight=True, metrics=True)
+
+        webapi.get("/test-auth/default", status=401)
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        r = webapi.get("/test-auth/default", status=200)
+        assert r.json == "some_data_from_default"
+
+
+class TestIdempotencyStore:
+    def test_in_flight(self):
+        from moulinette.interfaces.api import _IdempotencyStore
+
+        store = _IdempotencyStore()
+        calls = []
+        release = threading.Event()
+
+        def func():
+            calls.append(None)
+            release.wait(5)
+            return 201, [], b"created"
+
+        results = []
+
+        def call():
+            results.append(store.do("key", "fingerprint", func))
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while not calls:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert sorted(replayed for _, replayed in results) == [False, True]
+        assert store.do("key", "fingerprint", func) == ((201, [], b"created"), True)
+        assert len(calls) == 1
+
+    def test_reused_key(self):
+        from moulinette.interfaces.api import (
+            _IdempotencyKeyReused,
+            _IdempotencyStore,
+        )
+
+        store = _IdempotencyStore()
+        store.do("key", "fingerprint", lambda: (200, [], b""))
+        with pytest.raises(_IdempotencyKeyReused):
+            store.do("key", "other", lambda: (200, [], b""))
+
+    def test_server_errors_not_stored(self):
+        from moulinette.interfaces.api import _IdempotencyStore
+
+        store = _IdempotencyStore()
+        store.do("key", "fingerprint", lambda: (500, [], b""))
+        assert store.do("key", "fingerprint", lambda: (200, [], b"")) == (
+            (200, [], b""),
+            False,
+        )
+
+    def test_expiration(self):
+        from moulinette.interfaces.api import _IdempotencyStore
+
+        store = _IdempotencyStore(ttl=0)
+        store.do("key", "fingerprint", lambda: (200, [], b""))
+        assert store.do("key", "fingerprint", lambda: (201, [], b"")) == (
+            (201, [], b""),
+            False,
+        )
+
+
+class TestIdempotencyAPI:
+    @pytest.fixture
+    def calls(self, monkeypatch):
+        from moulitest import testapi
+
+        calls = []
+        job = testapi.testapi_job
+
+        def testapi_job(message):
+            calls.append(message)
+            return job(message)
+
+        monkeypatch.setattr(testapi, "testapi_job", testapi_job)
+        return calls
+
+    def post(self, webapi, message, key=None, status=201):
+        headers = {"X-Requested-With": ""}
+        if key is not None:
+            headers["Idempotency-Key"] = key
+        return webapi.post(
+            "/test-api/job", {"message": message}, headers=headers, status=status
+        )
+
+    def test_replay(self, moulinette_webapi, calls):
+        r = self.post(moulinette_webapi, "hello", "key")
+        assert r.json == {"message": "hello"}
+        assert "Idempotent-Replayed" not in r.headers
+
+        replay = self.post(moulinette_webapi, "hello", "key")
+        assert replay.headers["Idempotent-Replayed"] == "true"
+        assert replay.body == r.body
+        assert replay.content_type == "application/json"
+        assert calls == ["hello"]
+
+        self.post(moulinette_webapi, "hello", "other")
+        self.post(moulinette_webapi, "hello")
+        assert calls == ["hello"] * 3
+
+    def test_replay_repeated_headers(self, moulinette_webapi, monkeypatch):
+        from bottle import response
+        from moulitest import testapi
+
+        job = testapi.testapi_job
+
+        def testapi_job(message):
+            response.set_cookie("first", "1")
+            response.set_cookie("second", "2")
+            response.add_header("Link", "</a>")
+            response.add_header("Link", "</b>")
+            return job(message)
+
+        monkeypatch.setattr(testapi, "testapi_job", testapi_job)
+
+        for _ in range(2):
+            r = self.post(moulinette_webapi, "hello", "key")
+            assert sorted(r.headers.getall("Set-Cookie")) == [
+                "first=1",
+                "second=2",
+            ]
+            assert r.headers.getall("Link") == ["</a>", "</b>"]
+        assert r.headers["Idempotent-Replayed"] == "true"
+
+    def test_reused_key(self, moulinette_webapi, calls):
+        self.post(moulinette_webapi, "hello", "key")
+        r = self.post(moulinette_webapi, "bye", "key", status=422)
+        assert r.json["error"] == m18n.g("idempotency_key_reused")
+        assert calls == ["hello"]
+
+    def test_lock_free_routes(self, moulinette_webapi):
+        r = moulinette_webapi.get(
+            "/test-api/users", headers={"Idempotency-Key": "key"}, status=200
+        )
+        r = moulinette_webapi.get(
+            "/test-api/users", headers={"Idempotency-Key": "key"}, status=200
+        )
+        assert "Idempotent-Replayed" not in r.headers
+
+    def test_disabled(self, moulinette_webapi_factory, calls):
+        _, webapi = moulinette_webapi_factory(idempotency_keys=0)
+        self.post(webapi, "hello", "key")
+        self.post(webapi, "hello", "key")
+        assert calls == ["hello", "hello"]
+
+    def test_cors(self, moulinette_webapi_factory, calls):
+        origin = "https://example.org"
+        _, webapi = moulinette_webapi_factory(allowed_cors_origins=[origin])
+
+        r = webapi.options("/test-api/job", headers={"Origin": origin})
+        allowed = r.headers["Access-Control-Allow-Headers"].split(", ")
+        assert "Idempotency-Key" in allowed
+
+        headers = {"Origin": origin, "X-Requested-With": "", "Idempotency-Key": "key"}
+        webapi.post("/test-api/job", {"message": "hello"}, headers=headers)
+        r = webapi.post("/test-api/job", {"message": "hello"}, headers=headers)
+        assert r.headers["Idempotent-Replayed"] == "true"
+        exposed = r.headers["Access-Control-Expose-Headers"].split(", ")
+        assert "Idempotent-Replayed" in exposed
+
+
+class TestListeners:
+    def test_unix_listener(self, tmp_path):
+        import socket
+        import stat
+        from moulinette.interfaces.api import _GeventSocketServer, unix_listener
+
+        path = str(tmp_path / "api.sock")
+        umask = os.umask(0o022)
+        try:
+            listener = unix_listener(path, 0o600)
+        finally:
+            restored = os.umask(umask)
+        # The umask of the process is restored
+        assert restored == 0o022
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+            server = _GeventSocketServer(listener)
+            assert (server.host, server.port) == (path, 0)
+
+            # The socket of a running instance is not replaced
+            with pytest.raises(OSError):
+                unix_listener(path)
+        finally:
+            listener.close()
+
+        # The socket file left by a previous instance is replaced
+        listener = unix_listener(path)
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(path)
+        listener.close()
+
+    def test_systemd_listener(self, monkeypatch):
+        import socket
+        from moulinette.interfaces import api
+
+        server = socket.create_server(("127.0.0.1", 0))
+        monkeypatch.setattr(api, "SD_LISTEN_FDS_START", os.dup(server.fileno()))
+
+        monkeypatch.setenv("LISTEN_FDS", "1")
+        monkeypatch.setenv("LISTEN_PID", "1")
+        assert api.systemd_listener() is None
+        assert "LISTEN_FDS" not in os.environ
+
+        monkeypatch.setenv("LISTEN_FDS", "1")
+        monkeypatch.setenv("LISTEN_PID", str(os.getpid()))
+        listener = api.systemd_listener()
+        assert listener.getsockname() == server.getsockname()
+        assert "LISTEN_PID" not in os.environ
+        listener.close()
+        server.close()
+
+    def test_no_systemd_listener(self, monkeypatch):
+        from moulinette.interfaces.api import systemd_listener
+
+        monkeypatch.delenv("LISTEN_FDS", raising=False)
+        monkeypatch.delenv("LISTEN_PID", raising=False)
+        assert systemd_listener() is None
+
+
+class TestConditionalAPI:
+    @pytest.fixture
+    def testapi(self, monkeypatch):
+        from moulitest import testapi
+
+        monkeypatch.setattr(testapi, "versions", {"default": 1})
+        monkeypatch.setattr(testapi, "reads", [])
+        return testapi
+
+    def test_etag(self, moulinette_webapi, testapi):
+        r = moulinette_webapi.get("/test-api/version", status=200)
+        etag = r.headers["ETag"]
+        assert r.json == {"name": "default", "version": 1}
+
+        r = moulinette_webapi.get(
+            "/test-api/version", headers={"If-None-Match": etag}, status=304
+        )
+        assert r.headers["ETag"] == etag
+        assert testapi.reads == ["default"]
+
+        testapi.versions["default"] = 2
+        r = moulinette_webapi.get(
+            "/test-api/version", headers={"If-None-Match": etag}, status=200
+        )
+        assert r.headers["ETag"] != etag
+        assert r.json == {"name": "default", "version": 2}
+
+    def test_etag_per_arguments(self, moulinette_webapi, testapi):
+        testapi.versions["other"] = 1
+        r = moulinette_webapi.get("/test-api/version", status=200)
+        other = moulinette_webapi.get("/test-api/version?name=other", status=200)
+        assert other.headers["ETag"] == r.headers["ETag"]
+
+        # Without a validated version, the action is processed as usual
+        r = moulinette_webapi.get("/test-api/version?name=unknown", status=200)
+        assert "ETag" not in r.headers
+        assert r.json == {"name": "unknown", "version": None}
+
+    def test_validated_once(
+        self, moulinette_webapi_factory, actionsmap, testapi, mocker
+    ):
+        from moulinette.actionsmap import ActionsMap
+
+        actionsmap.write_text(
+            actionsmap.read_text().replace(
+                "validator: testapi_version_validator\n"
+                "            authentication:\n"
+                "                api: null",
+                "validator: testapi_version_validator\n"
+                "            authentication:\n"
+                "                api: dummy",
+            )
+        )
+        interface, webapi = moulinette_webapi_factory(actionsmap=str(actionsmap))
+        webapi.post(
+            "/login",
+            {"credentials": "dummy"},
+            headers={"X-Requested-With": ""},
+            status=200,
+        )
+        authenticate = mocker.spy(interface, "authenticate")
+        parse_action = mocker.spy(ActionsMap, "parse_action")
+
+        r = webapi.get("/test-api/version", status=200)
+        assert r.headers["ETag"]
+        assert r.json == {"name": "default", "version": 1}
+        assert authenticate.call_count == 1
+        assert parse_action.call_count == 1
+
+    def test_head_with_validator(self, moulinette_webapi, testapi):
+        r = moulinette_webapi.head("/test-api/version", status=200)
+        assert r.headers["ETag"]
+        assert r.content_type == "application/json"
+        assert r.body == b""
+        assert testapi.reads == []
+
+        moulinette_webapi.head(
+            "/test-api/version",
+            headers={"If-None-Match": r.headers["ETag"]},
+            status=304,
+        )
+        assert testapi.reads == []
+
+    def test_head_without_validator(self, moulinette_webapi):
+        r = moulinette_webapi.head("/test-api/list?limit=2", status=200)
+        assert r.content_type == "application/json"
+        assert r.headers["X-Total-Count"] == "5"
+        assert "ETag" not in r.headers
+        assert r.body == b""
+
+    def test_head_not_encoded(self, moulinette_webapi, monkeypatch):
+        from moulinette.interfaces import api
+
+        def json_encode(*args, **kwargs):
+            raise AssertionError("the body of a HEAD response was encoded")
+
+        monkeypatch.setattr(api, "json_encode", json_encode)
+        moulinette_webapi.head("/test-api/users", status=200)
+
+    def test_healthz(self, moulinette_webapi, monkeypatch):
+        from moulinette.core import MoulinetteLock
+
+        def acquire(*args, **kwargs):
+            raise AssertionError("the lock was taken")
+
+        monkeypatch.setattr(MoulinetteLock, "acquire", acquire)
+        r = moulinette_webapi.get("/healthz", status=200)
+        assert r.json == {"status": "ok"}
+        assert r.headers["Cache-Control"] == "no-store"
+        moulinette_webapi.head("/healthz", status=200)